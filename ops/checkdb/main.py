@@ -4,32 +4,47 @@ from pkg.utils import set_max_memory
 import pymysql
 import sqlite3
 import argparse
+import os
 import getpass
 import shutil
 from pathlib import Path
 import yaml
 from pkg.dbinfo import *
 from datetime import datetime, timedelta
-from pkg.report import report as report_html
+from pkg.report import report as report_html, compare_report, REPORT_INDEXES
+from pkg.sqlite3_writer import finalize_db
+from pkg.warehouse import append_snapshot, warehouse_path
 from dbutils.pooled_db import PooledDB
-from concurrent.futures import ThreadPoolExecutor
+from pkg.collector import CollectTask, ConnectionLimiter, run_collect_tasks
+from pkg.incremental import IncrementalTarget, create_watermark_table, load_watermarks, parse_watermark_time
+from pkg.watch import default_sources, watch as watch_cluster
+from pkg.timeseries import SeriesTarget, series_collector
+from pkg import metrics
+from pkg.metrics import MetricFetcher, load_metric_cache, server_time
+from pkg.topology import Topology, get_topology
+from pkg.budget import BudgetStore, DEFAULT_MAX_EXECUTION_MS
+from pkg.replay import Recorder, StandInServer
+from pkg.utils import get_peak_rss_mb
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import time
 
 functions_to_save = [
+    get_topology,
     get_connection_info,
     # get_active_session_count,
     get_lock_chain,
     get_lock_source_change,
     get_metadata_lock_wait,
     get_active_connection_info,
-    get_qps,
-    get_avg_response_time,
-    get_io_response_time,
+    metrics.get_qps,
+    metrics.get_avg_response_time,
+    metrics.get_io_response_time,
     get_node_info,
     get_os_info,
     get_cpu_usage,
     get_disk_info,
     get_table_info,
-    get_memory_detail,
+    metrics.get_memory_detail,
     get_statement_history,
     get_slow_query_info,
 ]
@@ -42,6 +57,35 @@ functions_to_save = [
     get_duplicate_indexes,
     """
 
+# 监控指标按--since的时间窗口从METRICS_SCHEMA并发查询，按序列列式存储到tidb_metric_series
+# key:按时间窗口查询的采集函数，value:(指标名, 标签字段, 值字段)
+# get_cpu_usage只取当前时刻的值，仍然按行存储
+METRIC_SERIES = {
+    metrics.get_qps: ("qps", [], ["qps"]),
+    metrics.get_avg_response_time: ("avg_response_time", ["instance"], ["avg_response_time_ms"]),
+    metrics.get_io_response_time: ("io_response_time", ["instance", "hostname", "device", "mount_point"],
+                                   ["iops", "io_util", "io_size_kb", "read_latency_ms", "write_latency_ms",
+                                    "disk_read_bytes_mb", "disk_write_bytes_mb", "cpu_used"]),
+    metrics.get_memory_detail: ("memory_usage", ["ip_address", "hostname"], ["used_percent"]),
+}
+
+# 需要主机拓扑的采集函数，拓扑在一次采集中只查询一次，各函数在本地关联主机名和节点类型
+TOPOLOGY_FUNCTIONS = {get_topology, get_os_info, get_cpu_usage, get_disk_info, metrics.get_io_response_time,
+                      metrics.get_memory_detail}
+
+# 支持按预算分页执行的采集函数，通过budget参数获取剩余预算
+BUDGET_FUNCTIONS = {get_table_info, get_statement_history}
+
+# 增量采集的水位线名称
+SLOW_QUERY_WATERMARK = "slow_query_time"  # 上次采集慢查询的结束时间
+STATEMENT_HISTORY_WATERMARK = "statement_history_summary_end_time"  # 已采集的最大SUMMARY_END_TIME
+# 增量采集时文件中累积的表和区分每次采集数据的时间字段，追加到仓库时只复制比上一个快照新的行
+WAREHOUSE_INCREMENTAL_COLUMNS = {
+    SlowQuery().class_to_table_name: "first_seen",
+    StatementHistory().class_to_table_name: "summary_end_time",
+    CollectorStats().class_to_table_name: "collect_time",
+}
+
 # 初始化sqlite3中的表
 def init_sqlite3_db(conn):
     # 如果在这里不初始化表，那么会在数据插入时自动创建表，但是要注意如果没有数据插入，那么表也不会创建
@@ -57,10 +101,11 @@ def init_sqlite3_db(conn):
     table['tidb_diskinfo'] = 'CREATE TABLE if not exists tidb_diskinfo (time varchar(512),ip_address varchar(512),hostname varchar(512),types_count varchar(512),fstype varchar(512),mountpoint varchar(512),aval_size_gb float,total_size_gb float,used_percent float)'
     table['tidb_memoryusagedetail'] = 'CREATE TABLE if not exists tidb_memoryusagedetail (time varchar(512),ip_address varchar(512),hostname varchar(512),types_count varchar(512),used_percent float)'
     table['tidb_lockchain'] = 'CREATE TABLE if not exists tidb_lockchain (waiting_instance varchar(512),waiting_user varchar(512),waiting_client_ip varchar(512),waiting_transaction varchar(512),waiting_duration_sec int,waiting_current_sql_digest varchar(512),waiting_sql varchar(512),lock_chain_node_type varchar(512),holding_session_id int,kill_holding_session_cmd varchar(512),holding_instance varchar(512),holding_user varchar(512),holding_client_ip varchar(512),holding_transaction varchar(512),holding_sql_digest varchar(512),holding_sql_source varchar(512),holding_sql varchar(512))'
-    table['tidb_locksourcechange'] = 'CREATE TABLE if not exists tidb_locksourcechange (source_session_id int,cycle1 int,cycle2 int,cycle3 int,status varchar(512))'
+    table['tidb_locksourcechange'] = 'CREATE TABLE if not exists tidb_locksourcechange (source_session_id int,source_trx_id int,hit_count int,sample_count int,persistence float,max_blocked_count int,in_cycle int,status varchar(512))'
     table['tidb_metadatalockwait'] = 'CREATE TABLE if not exists tidb_metadatalockwait (holding_session_id int,holding_sqls varchar(1024),waiting_ddl_job int,cancel_ddl_job varchar(512),ddl_job_dbname varchar(512),ddl_job_tablename varchar(512),ddl_sql varchar(512),ddl_is_locksource varchar(512),ddl_blocking_count int)'
     for table_name, sql in table.items():
         conn.execute(sql)
+    create_watermark_table(conn)
 
 def set_logger(log_level):
     """
@@ -134,11 +179,12 @@ def collect(args):
     :param args: 命令行参数
     :type args: argparse.Namespace
     """
-    def create_connection_pool(host, port, user, password):
-        return PooledDB(
-            creator=pymysql,
-            maxconnections=10,
-            mincached=2,
+    def create_connection_pool(host, port, user, password, recorder=None):
+        # 不预先创建空闲连接，多个集群并发时打开的连接数由limiter统一控制
+        return limiter.wrap(PooledDB(
+            creator=recorder or pymysql,
+            maxconnections=min(max(10, args.parallel), args.max_connections),
+            mincached=0,
             maxcached=5,
             blocking=True,
             host=host,
@@ -147,130 +193,302 @@ def collect(args):
             password=password,
             database='information_schema',
             charset='utf8mb4',
-            init_command="set session max_execution_time=30000"
-        )
-
-    def execute_tasks(out_conn, pool, functions_to_save):
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            futures = []
-            new_conns = []
-            # 记录总的需要打印的函数个数和已经打印的函数个数
-            logging.info(f"一共有{len(functions_to_save)}个任务需要执行")
-            for i,func in enumerate(functions_to_save):
-                logging.info(f"开始执行{func.__name__},剩余任务数:{len(functions_to_save)-i-1}，剩余异步执行任务数:{len(futures)}")
-                if func == get_slow_query_info:
-                    conn2 = pool.connection()
-                    new_conns.append(conn2)
-                    futures.append(executor.submit(SaveData, out_conn, func, conn2, datetime.now() - timedelta(days=10),
-                                                   datetime.now()))
-                elif func in [get_lock_source_change,get_metadata_lock_wait]:
-                    conn2 = pool.connection()
-                    new_conns.append(conn2)
-                    futures.append(executor.submit(SaveData, out_conn, func, conn2))
-                else:
-                    # 其它场景串型处理
-                    conn = pool.connection()
-                    SaveData(out_conn, func, conn)
-                    conn.close()
-            for i,future in enumerate(futures):
-                try:
-                    future.result()
-                except Exception as e:
-                    logging.error(f"任务执行时出错: {e}")
-                logging.info(f"剩余异步执行任务数:{len(futures)-i-1}")
-            for conn in new_conns:
-                conn.close()
+            init_command=f"set session max_execution_time={DEFAULT_MAX_EXECUTION_MS}"
+        ))
+
+    def build_tasks(functions_to_save, watermarks, fetcher, topology, budgets):
+        now = datetime.now()
+        tasks = []
+        for func in functions_to_save:
+            if func == get_slow_query_info:
+                start_time = now - timedelta(days=10)
+                last_time = watermarks.get(SLOW_QUERY_WATERMARK)
+                if last_time:
+                    # 时间窗口包含两端，从上次结束时间的下一微秒开始，最多仍然只查最近10天
+                    start_time = max(start_time, parse_watermark_time(last_time) + timedelta(microseconds=1))
+                # 按时间切片从连接池并发聚合，使用连接池而不是单个连接
+                task = CollectTask(get_slow_query_info_concurrently, start_time, now, max_workers=max(1, args.parallel // 2))
+                task.pass_pool = True
+                if args.incremental:
+                    # 水位线取已经采集到的慢查询的最大时间，而不是客户端的当前时间，避免两边时钟不一致时漏掉数据
+                    task.incremental = IncrementalTarget(SLOW_QUERY_WATERMARK, SlowQuery().class_to_table_name, "first_seen",
+                                                         last_time, value_column="last_seen")
+            elif func == get_lock_source_change:
+                # 采样间隔内不占用连接，每次采样从连接池获取
+                task = CollectTask(func, sample_count=args.lock_sample_count, interval=args.lock_sample_interval)
+                task.pass_pool = True
+            elif func == get_statement_history and args.incremental:
+                last_end_time = watermarks.get(STATEMENT_HISTORY_WATERMARK)
+                task = CollectTask(func, start_time=last_end_time)
+                task.incremental = IncrementalTarget(STATEMENT_HISTORY_WATERMARK, StatementHistory().class_to_table_name,
+                                                     "summary_end_time", last_end_time)
+            elif func in METRIC_SERIES:
+                # 多个指标写入同一张表，每个任务只替换自己指标的序列
+                metric, label_fields, value_fields = METRIC_SERIES[func]
+                extra_args = (topology,) if func in TOPOLOGY_FUNCTIONS else ()
+                task = CollectTask(series_collector(func, metric, label_fields, value_fields), fetcher, *extra_args)
+                task.pass_pool = True
+                task.incremental = SeriesTarget(metric)
+            elif func in TOPOLOGY_FUNCTIONS:
+                task = CollectTask(func, topology)
+            else:
+                task = CollectTask(func)
+            # 使用连接池的任务自己管理连接，不设置会话级的预算
+            if not task.pass_pool:
+                task.budget = budgets.budget(task.name)
+                if func in BUDGET_FUNCTIONS:
+                    task.kwargs["budget"] = task.budget
+            tasks.append(task)
+        return tasks
 
     def process_cluster(cluster_name, ip, port, user, password):
         logging.info(f"开始获取{cluster_name}信息，ip:{ip}, port:{port}")
+        summary = ClusterSummary(cluster_name)
+        start = time.time()
         try:
-            pool = create_connection_pool(ip, port, user, password)
-            # conn = pool.connection()
-            # todo 先设置check_same_thread=False允许并行写入，后续考虑SQLiteConnectionManager替代
+            # 录制时连接由Recorder创建，记录每条SQL的响应用于离线回放
+            recorder = Recorder(f"{args.output_dir}/{cluster_name}_fixture.sqlite3", meta={"since": args.since}) if args.record else None
+            pool = create_connection_pool(ip, port, user, password, recorder)
             sqlite3_file = f"{args.output_dir}/{cluster_name}.sqlite3"
-            # 如果存在先删除
-            if Path(sqlite3_file).exists():
+            # 如果存在先删除，增量采集时保留原文件，慢查询和历史SQL从水位线之后开始追加
+            watermarks = {}
+            # 监控指标的时间块缓存在删除文件前读取，采集完成后写回；时间窗口按服务端的当前时间计算
+            now = server_time(pool)
+            fetcher = MetricFetcher(now - int(parse_since(args.since).total_seconds()), now, load_metric_cache(sqlite3_file),
+                                    max_workers=max(1, args.parallel // 2))
+            if args.incremental:
+                watermarks = load_watermarks(sqlite3_file)
+                logging.info(f"{cluster_name}增量采集，水位线:{watermarks or '无'}")
+            elif Path(sqlite3_file).exists():
                 Path(sqlite3_file).unlink()
-            out_conn = sqlite3.connect(sqlite3_file,check_same_thread=False)
-            out_conn.text_factory = str
+            # 所有采集函数并发执行，只有写线程会打开sqlite3连接
             # 初始化数据表，为了让活动连接数，锁等待的汇总数据和明细数据对齐，会采用明细数据做汇总的方式计算汇总数据
-            init_sqlite3_db(out_conn)
-            execute_tasks(out_conn, pool, functions_to_save)
-            # conn.close()
-            out_conn.close()
+            # 每个任务的预算来自之前采集耗时的EWMA
+            budgets = BudgetStore(f"{args.output_dir}/{cluster_name}_budgets.json", max_seconds=args.max_budget)
+            tasks = build_tasks(functions_to_save, watermarks, fetcher, Topology(), budgets)
+            results = run_collect_tasks(sqlite3_file, pool, tasks, max_workers=args.parallel, batch_size=args.batch_size,
+                                        init_db=init_sqlite3_db, label=cluster_name, append=args.incremental)
+            for result in results:
+                budgets.record_result(result)
+            budgets.save()
+            fetcher.save(sqlite3_file)
+            # 写入完成后再建索引和收集统计信息，比边写边维护索引快
+            finalize_db(sqlite3_file, REPORT_INDEXES)
+            if args.warehouse:
+                # 快照追加到仓库，仓库失败不影响本次采集结果
+                try:
+                    append_snapshot(warehouse_path(args.warehouse, cluster_name), sqlite3_file, cluster_name,
+                                    retention_days=args.retention_days,
+                                    incremental_columns=WAREHOUSE_INCREMENTAL_COLUMNS if args.incremental else None)
+                except Exception as e:
+                    logging.error(f"{cluster_name}快照追加到仓库失败: {e}")
+            pool.close()
+            if recorder is not None:
+                recorder.save()
+            summary.failed_tasks = [result.name for result in results if not result.success]
+            summary.partial_tasks = [result.name for result in results if result.partial]
             if args.with_report:
                 logging.info(f"开始生成{cluster_name}报表")
                 report_html(f"{args.output_dir}/{cluster_name}.sqlite3", f"{args.output_dir}/{cluster_name}.html")
         except Exception as e:
             logging.error(f"获取{cluster_name}信息失败: {e}")
+            summary.error = str(e)
+        summary.elapsed = time.time() - start
+        return summary
 
     user = args.user
     ip = args.host
     port = args.port
     password = args.password or getpass.getpass("请输入密码:")
+    limiter = ConnectionLimiter(args.max_connections)
 
     Path(args.output_dir).mkdir(exist_ok=True)
     logging.info(f"输出目录: {args.output_dir}")
+    if args.warehouse:
+        Path(args.warehouse).mkdir(parents=True, exist_ok=True)
 
+    summaries = []
     if ip and ip != "127.0.0.1":
         args.cluster = args.cluster or "default"
-        process_cluster(args.cluster, ip, port, user, password)
+        summaries.append(process_cluster(args.cluster, ip, port, user, password))
     else:
-        for cluster_info in get_cluster_infos():
-            if not args.cluster or cluster_info.cluster_name in args.cluster.split(","):
-                process_cluster(cluster_info.cluster_name, cluster_info.ip, cluster_info.port, user, password)
+        cluster_infos = [cluster_info for cluster_info in get_cluster_infos()
+                         if not args.cluster or cluster_info.cluster_name in args.cluster.split(",")]
+        # 每个集群独立的sqlite3文件和报表，集群之间并发采集
+        with ThreadPoolExecutor(max_workers=max(1, args.cluster_parallel), thread_name_prefix="cluster") as executor:
+            futures = [executor.submit(process_cluster, cluster_info.cluster_name, cluster_info.ip, cluster_info.port,
+                                       user, password) for cluster_info in cluster_infos]
+            for future in futures:
+                summaries.append(future.result())
+    print_cluster_summaries(summaries)
 
 
-class Qps(BaseTable):
-    def __init__(self):
-        self.time = datetime.now()
-        self.qps = 0.0
-        super().__init__()
-
-def get_qps(conn):
-    sql_text = """select time,
-       round(sum(value), 2) as qps
-from METRICS_SCHEMA.tidb_qps
-where type in ('StmtSendLongData', 'Query', 'StmtExecute', 'StmtPrepare', 'StmtFetch')
-  and time between now() - interval 60 minute and now()
-group by time
-order by time;"""
-    qps: List[Qps] = []
-    cursor = conn.cursor()
-    cursor.execute(sql_text)
-    for row in cursor:
-        qps_instance = Qps()
-        qps_instance.time = row[0]
-        qps_instance.qps = row[1]
-        qps.append(qps_instance)
-    cursor.close()
-    return qps
-
-class AvgResponseTime(BaseTable):
-    def __init__(self):
-        self.instance = ""
-        self.time = datetime.now()
-        self.avg_response_time_ms = 0.0
-        super().__init__()
-
-def get_avg_response_time(conn):
-    sql_text = """select instance, time, round(1000 * avg(value), 2) as avg_response_time_ms
-from METRICS_SCHEMA.tidb_query_duration
-where quantile = 0.5
-  and time between now() - interval 60 minute and now()
-group by time, instance
-order by instance, time;"""
-    avg_response_times: List[AvgResponseTime] = []
-    cursor = conn.cursor()
-    cursor.execute(sql_text)
-    for row in cursor:
-        avg_response_time = AvgResponseTime()
-        avg_response_time.instance = row[0]
-        avg_response_time.time = row[1]
-        avg_response_time.avg_response_time_ms = row[2]
-        avg_response_times.append(avg_response_time)
-    cursor.close()
-    return avg_response_times
+def watch(args):
+    """
+    常驻运行，定时轮询锁等待和活动连接，状态变化时追加写入sqlite3
+    :param args: 命令行参数
+    :type args: argparse.Namespace
+    """
+    password = args.password or getpass.getpass("请输入密码:")
+    Path(args.output_dir).mkdir(exist_ok=True)
+    sqlite3_file = f"{args.output_dir}/{args.cluster}_watch.sqlite3"
+    # 只使用一个连接，单次轮询的SQL超过间隔时间就中止，避免长时间运行给集群带来额外压力
+    pool = PooledDB(
+        creator=pymysql,
+        maxconnections=1,
+        mincached=0,
+        maxcached=1,
+        blocking=True,
+        ping=1,
+        host=args.host,
+        port=args.port,
+        user=args.user,
+        password=password,
+        database='information_schema',
+        charset='utf8mb4',
+        init_command=f"set session max_execution_time={max(1000, int(args.interval * 1000))}"
+    )
+    logging.info(f"开始观察{args.cluster}，间隔:{args.interval}s，输出文件:{sqlite3_file}")
+    try:
+        watch_cluster(pool, sqlite3_file, interval=args.interval, sources=default_sources(args.active_every),
+                      max_bytes=int(args.max_mb * 1024 * 1024), duration=args.duration)
+    finally:
+        pool.close()
+
+
+def compare(args):
+    """
+    对比仓库中的两个快照
+    :param args: 命令行参数
+    :type args: argparse.Namespace
+    """
+    if not Path(args.warehouse).exists():
+        raise FileNotFoundError(f"{args.warehouse} not found")
+    out_file = args.output or str(Path(args.warehouse).with_suffix(".compare.html"))
+    compare_report(args.warehouse, out_file, args.snapshot, args.baseline, args.min_ratio)
+    logging.info(f"对比报表:{out_file}")
+
+
+def bench_run(argv, sqlite3_file, html_file):
+    """
+    在子进程中执行一次完整的采集和报表，每个数据规模使用新的进程，内存峰值互不影响
+    :param argv: collect子命令的参数
+    :type argv: List[str]
+    :return: (采集耗时, 报表耗时, 内存峰值MB)
+    :rtype: tuple
+    """
+    args = build_parser().parse_args(argv)
+    set_logger(args.log)
+    start = time.time()
+    collect(args)
+    collect_seconds = time.time() - start
+    start = time.time()
+    report_html(sqlite3_file, html_file)
+    return collect_seconds, time.time() - start, get_peak_rss_mb()
+
+
+def bench(args):
+    """
+    使用录制的fixture在本地回放服务端上按不同的数据规模执行采集和报表，不需要真实的集群
+    :param args: 命令行参数
+    :type args: argparse.Namespace
+    """
+    if not Path(args.fixture).exists():
+        raise FileNotFoundError(f"{args.fixture} not found")
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    results = []
+    for scale in [int(scale) for scale in args.scales.split(",")]:
+        cluster_name = f"bench_{scale}x"
+        sqlite3_file = f"{args.output_dir}/{cluster_name}.sqlite3"
+        html_file = f"{args.output_dir}/{cluster_name}.html"
+        # 上次的sqlite3文件中有监控指标缓存，预算文件会改变超时设置，都会影响结果的可重复性
+        for path in [sqlite3_file, f"{args.output_dir}/{cluster_name}_budgets.json"]:
+            if Path(path).exists():
+                Path(path).unlink()
+        server = StandInServer(args.fixture, scale=scale).start()
+        try:
+            # 127.0.0.1会被当作从tiup查找集群，这里使用localhost；监控指标的时间窗口和录制时一致，SQL才能对应上
+            argv = ["--log", args.log, "collect", "--cluster", cluster_name, "--host", "localhost", "--port", str(server.port),
+                    "--password", "bench", "-o", args.output_dir, "--parallel", str(args.parallel),
+                    "--since", server.meta.get("since", "1d")]
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                collect_seconds, report_seconds, peak_rss_mb = executor.submit(bench_run, argv, sqlite3_file, html_file).result()
+        finally:
+            server.stop()
+        if server.misses:
+            logging.warning(f"{len(server.misses)}条SQL在fixture中没有录制，返回空结果: {list(server.misses)[:5]}")
+        results.append((scale, collect_seconds, report_seconds, peak_rss_mb, server.query_count,
+                        Path(sqlite3_file).stat().st_size / 1024 / 1024))
+    logging.info("scale  collect_s  report_s  peak_rss_mb  queries  sqlite3_mb")
+    for scale, collect_seconds, report_seconds, peak_rss_mb, query_count, sqlite3_mb in results:
+        logging.info(f"{scale:>4}x  {collect_seconds:>9.2f}  {report_seconds:>8.2f}  {peak_rss_mb:>11.1f}  "
+                     f"{query_count:>7}  {sqlite3_mb:>10.2f}")
+
+
+class ClusterSummary:
+    """
+    单个集群的采集结果汇总
+    """
+
+    def __init__(self, cluster_name):
+        self.cluster_name = cluster_name
+        self.elapsed = 0.0
+        self.error = ""
+        self.failed_tasks: List[str] = []
+        self.partial_tasks: List[str] = []  # 超出执行时间预算，只保存了部分结果的任务
+
+
+def print_cluster_summaries(summaries):
+    """
+    打印每个集群的采集耗时和失败情况
+    :type summaries: List[ClusterSummary]
+    """
+    logging.info(f"采集完成，集群数:{len(summaries)}，失败集群数:{len([s for s in summaries if s.error])}")
+    for summary in sorted(summaries, key=lambda s: s.elapsed, reverse=True):
+        if summary.error:
+            status = f"失败: {summary.error}"
+        elif summary.failed_tasks:
+            status = f"部分任务失败: {','.join(summary.failed_tasks)}"
+        elif summary.partial_tasks:
+            status = f"部分任务超出预算: {','.join(summary.partial_tasks)}"
+        else:
+            status = "成功"
+        logging.info(f"集群:{summary.cluster_name}，耗时:{summary.elapsed:.2f}s，{status}")
+
+
+SQLITE3_HEADER = b"SQLite format 3\x00"
+# 和采集结果写在同一个输出目录中、但不是采集快照的sqlite3文件：录制文件、watch记录、快照仓库
+NON_SNAPSHOT_SUFFIXES = ("_fixture", "_watch", "_warehouse")
+
+
+def is_sqlite3_file(path):
+    """
+    通过文件头判断是否为sqlite3文件，不需要打开数据库
+    :type path: Path
+    :rtype: bool
+    """
+    try:
+        with open(path, "rb") as file:
+            return file.read(len(SQLITE3_HEADER)) == SQLITE3_HEADER
+    except OSError:
+        return False
+
+
+def render_report(in_file, out_file):
+    """
+    生成单个报表，在子进程中执行，返回耗时
+    先写临时文件，成功后再改名，避免生成失败的报表因为比数据库新而在下次被跳过
+    :rtype: float
+    """
+    start = time.time()
+    tmp_file = f"{out_file}.tmp"
+    try:
+        report_html(in_file, tmp_file)
+        os.replace(tmp_file, out_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return time.time() - start
 
 
 def report(args):
@@ -284,30 +502,44 @@ def report(args):
         raise FileNotFoundError(f"{in_file} not found")
     in_files = []
     if in_file.is_dir():
-        for each_file in in_file.iterdir():
-            # 用sqlite3 尝试打开文件，如果不是sqlite3文件则跳过
-            try:
-                conn = sqlite3.connect(f'file:{each_file}?mode=ro', uri=True)
-                conn.execute("select count(*) from sqlite_master limit 1")
-                conn.close()
-                in_files.append(each_file)
-            except sqlite3.DatabaseError:
+        for each_file in sorted(in_file.iterdir()):
+            # 只检查文件头，不是sqlite3文件则跳过
+            if not (each_file.is_file() and is_sqlite3_file(each_file)):
                 logging.warning(f"{each_file}不是sqlite3文件，跳过")
-                continue
+            elif each_file.stem.endswith(NON_SNAPSHOT_SUFFIXES):
+                logging.info(f"{each_file}不是采集快照，跳过")
+            else:
+                in_files.append(each_file)
     else:
         in_files.append(in_file)
-    logging.info("共需要解析文件数:%d", len(in_files))
+    Path(args.output).mkdir(parents=True, exist_ok=True)
+    jobs = []
     for in_file in in_files:
         out_file = Path(args.output).joinpath(in_file.stem).with_suffix(".html")
-        logging.info(f"开始解析{in_file}，输出文件:{out_file}")
-        report_html(str(in_file), str(out_file))
+        # 报表比数据库新说明数据库在上次生成报表之后没有变化，重复执行时跳过
+        if not args.force and out_file.exists() and out_file.stat().st_mtime >= in_file.stat().st_mtime:
+            logging.info(f"{out_file}比{in_file}新，跳过")
+            continue
+        jobs.append((in_file, out_file))
+    logging.info("共需要解析文件数:%d，跳过文件数:%d", len(jobs), len(in_files) - len(jobs))
+    if not jobs:
+        return
+    # 每个文件在独立的进程中生成报表，互不影响
+    with ProcessPoolExecutor(max_workers=max(1, min(args.jobs, len(jobs)))) as executor:
+        futures = {}
+        for in_file, out_file in jobs:
+            logging.info(f"开始解析{in_file}，输出文件:{out_file}")
+            futures[executor.submit(render_report, str(in_file), str(out_file))] = in_file
+        for future in as_completed(futures):
+            try:
+                logging.info(f"{futures[future]}解析完成，耗时:{future.result():.2f}s")
+            except Exception as e:
+                logging.error(f"{futures[future]}解析失败: {e}")
 
-def main():
+def build_parser():
     """
-    支持从单个TiDB中获取信息并储存到sqlite3中
-    支持从多个TiDB中获取信息并储存到sqlite3中，每一个集群一个文件
-    可解析sqlite3，从中获取信息生成html报表
-    :return:
+    命令行参数定义，bench在子进程中也用它构造collect的参数
+    :rtype: argparse.ArgumentParser
     """
     parser = argparse.ArgumentParser(description="Check TiDB cluster info", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("--log", type=str, default="INFO", help="打印日志级别")
@@ -319,11 +551,57 @@ def main():
     collect_parser.add_argument("--user", type=str, help="集群用户名", default="root")
     collect_parser.add_argument("--password", type=str, help="集群密码")
     collect_parser.add_argument("-o", "--output-dir", type=str, help="输出sqlite3文件路径,如果是多个集群则会在这个目录下生成多个文件，以集群名称命名", default="output")
-    collect_parser.add_argument("--since", type=str, help="慢查询开始时间,格式为1d,1h,1m，比如查询最近10分钟慢日志则：--since=10m", default="1d")
+    collect_parser.add_argument("--since", type=str, help="监控指标的时间窗口,格式为1d,1h,1m，比如查询最近10分钟的监控指标则：--since=10m，窗口越长采样间隔越大", default="1d")
     collect_parser.add_argument("--with-report", action="store_true", help="是否同时生成html报表")
+    collect_parser.add_argument("--parallel", type=int, help="并发执行的采集任务数", default=8)
+    collect_parser.add_argument("--batch-size", type=int, help="每批写入sqlite3的行数", default=2000)
+    collect_parser.add_argument("--cluster-parallel", type=int, help="未指定--host时并发采集的集群个数", default=1)
+    collect_parser.add_argument("--max-connections", type=int, help="所有集群同时打开的TiDB连接总数上限", default=40)
+    collect_parser.add_argument("--lock-sample-count", type=int, help="判断锁源头是否变化时的采样次数", default=LOCK_SAMPLE_COUNT)
+    collect_parser.add_argument("--lock-sample-interval", type=float, help="锁等待采样间隔（秒）", default=LOCK_SAMPLE_INTERVAL)
+    collect_parser.add_argument("--incremental", action="store_true", help="增量采集，保留已有的sqlite3文件，慢查询和历史SQL只获取上次采集之后的数据并追加写入")
+    collect_parser.add_argument("--max-budget", type=float, help="单个采集任务执行时间预算的上限（秒），预算按之前采集的耗时自动调整", default=300)
+    collect_parser.add_argument("--record", action="store_true", help="录制每条SQL的响应到{集群名称}_fixture.sqlite3，用于bench离线回放")
+    collect_parser.add_argument("--warehouse", type=str, help="仓库目录，指定后每次采集的快照追加到{集群名称}_warehouse.sqlite3中，用于跨快照对比")
+    collect_parser.add_argument("--retention-days", type=int, help="仓库中快照的保留天数，0表示不清理", default=30)
+    compare_parser = subparsers.add_parser("compare", help="对比仓库中的两个快照，列出退化的SQL")
+    compare_parser.add_argument("-w", "--warehouse", type=str, required=True, help="仓库文件路径")
+    compare_parser.add_argument("--snapshot", type=int, help="当前快照ID，默认为最新的快照")
+    compare_parser.add_argument("--baseline", type=int, help="基线快照ID，默认为当前快照的前一个快照")
+    compare_parser.add_argument("--min-ratio", type=float, help="平均耗时达到基线的多少倍认为退化", default=1.5)
+    compare_parser.add_argument("-o", "--output", type=str, help="输出html文件路径，默认和仓库文件同目录")
+    watch_parser = subparsers.add_parser("watch", help="常驻运行，定时轮询锁等待和活动连接，只记录变化")
+    watch_parser.add_argument("--cluster", type=str, help="集群名称，用于输出文件命名", default="default")
+    watch_parser.add_argument("--host", type=str, help="集群ip地址", default="127.0.0.1")
+    watch_parser.add_argument("--port", type=int, help="集群端口", default=4000)
+    watch_parser.add_argument("--user", type=str, help="集群用户名", default="root")
+    watch_parser.add_argument("--password", type=str, help="集群密码")
+    watch_parser.add_argument("-o", "--output-dir", type=str, help="输出目录，文件名为{集群名称}_watch.sqlite3", default="output")
+    watch_parser.add_argument("--interval", type=float, help="轮询间隔（秒）", default=5)
+    watch_parser.add_argument("--active-every", type=int, help="活动连接信息每隔多少次轮询采集一次", default=6)
+    watch_parser.add_argument("--max-mb", type=float, help="观察记录的大小上限（MB），超过后删除最早的记录", default=64)
+    watch_parser.add_argument("--duration", type=float, help="运行时长（秒），0表示一直运行直到Ctrl+C", default=0)
     report_parser = subparsers.add_parser("report", help="从sqlite3中获取信息生成html报表")
     report_parser.add_argument("-i","--db", type=str, help="sqlite3文件路径，如果是目录则会查找目录下的所有sqlite3文件")
     report_parser.add_argument("-o", "--output", type=str, help="输出html文件路径,默认当前路径", default=".")
+    report_parser.add_argument("-j", "--jobs", type=int, help="并发生成报表的进程数，每个sqlite3文件一个进程", default=os.cpu_count() or 1)
+    report_parser.add_argument("--force", action="store_true", help="即使报表比sqlite3文件新也重新生成")
+    bench_parser = subparsers.add_parser("bench", help="回放录制的fixture，按不同数据规模测试采集和报表的耗时和内存")
+    bench_parser.add_argument("-f", "--fixture", type=str, required=True, help="collect --record录制的fixture文件")
+    bench_parser.add_argument("--scales", type=str, help="数据规模，结果集的数据行重复的倍数，以逗号分隔", default="1,10,100")
+    bench_parser.add_argument("-o", "--output-dir", type=str, help="输出目录，文件名为bench_{倍数}x.sqlite3", default="output/bench")
+    bench_parser.add_argument("--parallel", type=int, help="并发执行的采集任务数", default=8)
+    return parser
+
+
+def main():
+    """
+    支持从单个TiDB中获取信息并储存到sqlite3中
+    支持从多个TiDB中获取信息并储存到sqlite3中，每一个集群一个文件
+    可解析sqlite3，从中获取信息生成html报表
+    :return:
+    """
+    parser = build_parser()
     args = parser.parse_args()
     # todo 打开内存控制参数
     set_max_memory()
@@ -332,6 +610,12 @@ def main():
         collect(args)
     elif args.command == "report":
         report(args)
+    elif args.command == "watch":
+        watch(args)
+    elif args.command == "compare":
+        compare(args)
+    elif args.command == "bench":
+        bench(args)
     else:
         parser.print_help()
 
@@ -0,0 +1,154 @@
+"""
+采集任务的执行时间预算
+连接池的init_command对所有语句统一设置max_execution_time，开销小的采集函数用不到这么长，
+大集群上的get_table_info、get_statement_history又经常超时导致表为空。这里为每个采集任务单独设置预算：
+1. 预算来自之前几次采集耗时的EWMA，保存在输出目录的json文件中，没有历史时使用默认值；
+2. 任务执行前按预算设置会话的max_execution_time，分页查询的采集函数按剩余预算执行每一页；
+3. 超时前已经写入数据的任务保留这些数据，状态标记为partial，没有数据的任务仍然为failed，下次采集的预算相应增加
+"""
+import json
+import logging
+import time
+from pathlib import Path
+
+import pymysql
+
+from .dbinfo import ER_QUERY_TIMEOUT
+
+DEFAULT_MAX_EXECUTION_MS = 30000  # 连接池init_command中的默认值，任务结束后恢复
+DEFAULT_BUDGET_SECONDS = 30
+MIN_BUDGET_SECONDS = 30  # 和原来固定的max_execution_time一致，开销小的任务不会因为短暂的负载波动超时
+MAX_BUDGET_SECONDS = 300
+BUDGET_FACTOR = 3  # 预算为历史耗时EWMA的倍数
+EWMA_ALPHA = 0.3
+
+
+def is_timeout(error):
+    """
+    :type error: Exception
+    :rtype: bool
+    """
+    return isinstance(error, pymysql.err.OperationalError) and bool(error.args) and error.args[0] == ER_QUERY_TIMEOUT
+
+
+class Budget:
+    """
+    单个采集任务的执行时间预算
+    """
+
+    def __init__(self, name, seconds):
+        """
+        :param name: 任务名
+        :type name: str
+        :param seconds: 预算，单位：秒
+        :type seconds: float
+        """
+        self.name = name
+        self.seconds = seconds
+        self.deadline = None
+        self.partial = False
+        self.reason = ""
+
+    def start(self):
+        self.deadline = time.time() + self.seconds
+
+    def remaining(self):
+        if self.deadline is None:
+            return self.seconds
+        return max(0.0, self.deadline - time.time())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def statement_ms(self):
+        """
+        下一条语句可用的max_execution_time，至少1秒
+        :rtype: int
+        """
+        return max(1000, int(self.remaining() * 1000))
+
+    def apply(self, conn):
+        """
+        按剩余预算设置会话的max_execution_time
+        :type conn: pymysql.connections.Connection
+        """
+        cursor = conn.cursor()
+        cursor.execute(f"set session max_execution_time = {self.statement_ms()}")
+        cursor.close()
+
+    @staticmethod
+    def reset(conn):
+        """
+        恢复连接池的默认值，连接归还后会被其它任务复用
+        """
+        cursor = conn.cursor()
+        cursor.execute(f"set session max_execution_time = {DEFAULT_MAX_EXECUTION_MS}")
+        cursor.close()
+
+    def mark_partial(self, reason):
+        if not self.partial:
+            logging.warning(f"任务{self.name}在{self.seconds:.0f}s预算内未完成，保留部分结果: {reason}")
+        self.partial = True
+        self.reason = reason
+
+
+class BudgetStore:
+    """
+    按任务名保存历史耗时的EWMA，每个集群一个json文件
+    """
+
+    def __init__(self, path, max_seconds=MAX_BUDGET_SECONDS):
+        """
+        :param path: json文件路径
+        :type path: str
+        :param max_seconds: 预算上限，单位：秒
+        :type max_seconds: float
+        """
+        self.path = path
+        self.max_seconds = max_seconds
+        self.ewma = {}  # key:任务名，value:耗时的EWMA（秒）
+        if Path(path).exists():
+            try:
+                with open(path, "r", encoding="utf-8") as file:
+                    self.ewma = json.load(file)
+            except (OSError, ValueError) as e:
+                logging.warning(f"读取{path}失败，使用默认预算: {e}")
+
+    def budget(self, name):
+        """
+        :rtype: Budget
+        """
+        if name in self.ewma:
+            seconds = min(self.max_seconds, max(MIN_BUDGET_SECONDS, self.ewma[name] * BUDGET_FACTOR))
+        else:
+            seconds = min(self.max_seconds, DEFAULT_BUDGET_SECONDS)
+        return Budget(name, seconds)
+
+    def record(self, name, seconds, budget_seconds, partial):
+        """
+        :param seconds: 本次的耗时
+        :param budget_seconds: 本次的预算
+        :param partial: 是否超时，超时时实际耗时未知，按预算的两倍计算，下次预算会明显增加
+        """
+        observed = max(seconds, budget_seconds * 2) if partial else seconds
+        previous = self.ewma.get(name)
+        self.ewma[name] = observed if previous is None else EWMA_ALPHA * observed + (1 - EWMA_ALPHA) * previous
+
+    def record_result(self, result):
+        """
+        按采集任务的执行结果更新EWMA，成功、partial以及超时失败的任务都会记录，
+        超时失败的任务按partial计算，否则需要更长预算的任务永远使用默认预算，每次都会超时
+        :type result: pkg.collector.TaskResult
+        """
+        if not result.budget_seconds or not (result.success or result.timed_out):
+            return
+        # 等待写线程的时间不计入任务自身的耗时
+        self.record(result.name, result.elapsed - result.wait_seconds, result.budget_seconds,
+                    result.partial or result.timed_out)
+
+    def save(self):
+        try:
+            with open(self.path, "w", encoding="utf-8") as file:
+                json.dump({name: round(value, 3) for name, value in sorted(self.ewma.items())}, file, indent=2)
+        except OSError as e:
+            logging.warning(f"保存{self.path}失败: {e}")
@@ -0,0 +1,260 @@
+"""
+采集任务调度
+每个采集函数作为一个任务，从连接池获取连接并发取数，结果按批次通过有界队列交给唯一的sqlite3写线程，
+总耗时取决于最慢的采集函数而不是所有采集函数耗时之和
+"""
+import logging
+import sqlite3
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from .budget import Budget, is_timeout
+from .dbinfo import CollectorStats
+from .sqlite3_writer import APPEND_PRAGMAS, BulkWriter, LOAD_PRAGMAS, SQLiteWriter, DEFAULT_BATCH_SIZE, chunked
+from .utils import get_peak_rss_mb
+
+
+class CollectTask:
+    """
+    定义采集任务，func的第一个参数为数据库连接，其余参数通过args和kwargs传入
+    pass_pool为True时第一个参数为连接池，由采集函数自己按需获取连接（比如需要多个连接并发查询）
+    budget为执行时间预算，执行前按预算设置会话的max_execution_time，支持分页的采集函数通过kwargs中的budget按剩余预算执行每一页
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.name = func.__name__
+        self.incremental = None  # 追加写入的目标，增量采集时为pkg.incremental.IncrementalTarget，指标序列为pkg.timeseries.SeriesTarget
+        self.pass_pool = False
+        self.budget = None  # pkg.budget.Budget
+
+
+class TaskResult:
+    """
+    采集任务的执行结果
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.row_count = 0
+        self.byte_count = 0
+        self.elapsed = 0.0  # 从获取连接到数据全部提交给写线程的耗时（秒）
+        self.query_seconds = 0.0  # 执行SQL和从TiDB读取数据的耗时（秒）
+        self.wait_seconds = 0.0  # 等待写线程队列的耗时（秒）
+        self.write_seconds = 0.0  # 写线程写入sqlite3的耗时（秒）
+        self.rss_delta_mb = 0.0  # 进程内存峰值的增量（MB）
+        self.budget_seconds = 0.0  # 执行时间预算（秒），0表示没有单独的预算
+        self.partial = False  # 超出预算，只保存了部分结果
+        self.timed_out = False  # 超出预算被中断，没有数据时状态仍然为failed，但下次采集的预算需要增加
+        self.error = ""
+
+    @property
+    def success(self):
+        return not self.error
+
+    @property
+    def status(self):
+        if self.error:
+            return "failed"
+        return "partial" if self.partial else "success"
+
+
+class ConnectionLimiter:
+    """
+    限制所有集群同时使用的TiDB连接总数，多个集群并发采集时共用一个ConnectionLimiter
+    """
+
+    def __init__(self, max_connections):
+        self.max_connections = max_connections
+        self._semaphore = threading.BoundedSemaphore(max_connections)
+
+    def wrap(self, pool):
+        """
+        :param pool: 数据库连接池
+        :type pool: dbutils.pooled_db.PooledDB
+        :rtype: LimitedPool
+        """
+        return LimitedPool(pool, self._semaphore)
+
+
+class LimitedPool:
+    """
+    包装连接池，获取连接前需要先拿到全局许可，连接关闭时归还许可
+    """
+
+    def __init__(self, pool, semaphore):
+        self._pool = pool
+        self._semaphore = semaphore
+
+    def connection(self):
+        self._semaphore.acquire()
+        try:
+            conn = self._pool.connection()
+        except Exception:
+            self._semaphore.release()
+            raise
+        return _LimitedConnection(conn, self._semaphore)
+
+    def close(self):
+        self._pool.close()
+
+
+class _LimitedConnection:
+    def __init__(self, conn, semaphore):
+        self._conn = conn
+        self._semaphore = semaphore
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._semaphore is not None:
+            self._conn.close()
+            self._semaphore.release()
+            self._semaphore = None
+
+
+def _produce(pool, writer, task, batch_size, result):
+    """
+    执行采集任务并把结果分批提交给写线程，同时记录取数和等待写线程的耗时
+    :type result: TaskResult
+    """
+    start = time.time()
+    peak_rss_mb = get_peak_rss_mb()
+    conn = None
+    budget = task.budget
+    produced = False  # 是否已经有数据提交给写线程
+    if budget is not None:
+        result.budget_seconds = budget.seconds
+        budget.start()
+    try:
+        if task.pass_pool:
+            call_start = time.time()
+            rows = task.func(pool, *task.args, **task.kwargs)
+        else:
+            conn = pool.connection()
+            if budget is not None:
+                budget.apply(conn)
+            call_start = time.time()
+            rows = task.func(conn, *task.args, **task.kwargs)
+        # 返回列表的采集函数在调用时就已经执行完SQL，生成器则在下面取数据时执行
+        result.query_seconds += time.time() - call_start
+        chunks = chunked(rows or [], batch_size)
+        while True:
+            # 采集函数是生成器时，SQL执行和读取数据都发生在取下一批数据的时候
+            fetch_start = time.time()
+            chunk = next(chunks, None)
+            result.query_seconds += time.time() - fetch_start
+            if chunk is None:
+                break
+            produced = True
+            put_start = time.time()
+            writer.put_rows(task.name, chunk)
+            result.wait_seconds += time.time() - put_start
+        writer.finish(task.name)
+        result.partial = budget is not None and budget.partial
+    except Exception as e:
+        result.timed_out = budget is not None and is_timeout(e)
+        # 超时前已经产生数据的任务保留已经提交给写线程的数据，标记为partial；
+        # 没有产生任何数据的任务，以及水位线依赖完整数据的增量任务，仍然按失败处理
+        if result.timed_out and task.incremental is None and produced:
+            budget.mark_partial(str(e))
+            result.partial = True
+            writer.finish(task.name)
+        else:
+            logging.error(f"任务{task.name}执行时出错: {e}, {traceback.format_exc()}")
+            writer.fail(task.name, e)
+    finally:
+        if conn is not None:
+            if budget is not None:
+                try:
+                    Budget.reset(conn)
+                except Exception as e:
+                    logging.warning(f"任务{task.name}恢复max_execution_time失败: {e}")
+            conn.close()
+    result.elapsed = time.time() - start
+    result.rss_delta_mb = get_peak_rss_mb() - peak_rss_mb
+
+
+def save_collector_stats(db_path, results, collect_time):
+    """
+    将采集任务的统计信息追加写入tidb_collector_stats，在写线程关闭后调用
+    :type results: List[TaskResult]
+    :type collect_time: datetime
+    """
+    rows = []
+    for result in results:
+        stats = CollectorStats()
+        stats.collect_time = collect_time.strftime("%Y-%m-%d %H:%M:%S")
+        stats.task_name = result.name
+        stats.status = result.status
+        stats.elapsed_s = round(result.elapsed, 3)
+        stats.query_s = round(result.query_seconds, 3)
+        stats.wait_s = round(result.wait_seconds, 3)
+        stats.write_s = round(result.write_seconds, 3)
+        stats.row_count = result.row_count
+        stats.bytes = result.byte_count
+        stats.peak_rss_delta_mb = round(result.rss_delta_mb, 2)
+        stats.budget_s = round(result.budget_seconds, 1)
+        stats.error = result.error
+        rows.append(stats)
+    conn = sqlite3.connect(db_path)
+    try:
+        BulkWriter(conn).save(rows, append=True)
+    except Exception as e:
+        logging.error(f"Save collector stats failed: {e}, {traceback.format_exc()}")
+    finally:
+        conn.close()
+
+
+def run_collect_tasks(db_path, pool, tasks, max_workers=8, batch_size=DEFAULT_BATCH_SIZE, init_db=None, label="",
+                      append=False):
+    """
+    并发执行采集任务，并由单独的写线程写入sqlite3
+    :param db_path: sqlite3文件路径
+    :type db_path: str
+    :param pool: 数据库连接池
+    :type pool: dbutils.pooled_db.PooledDB
+    :param tasks: 采集任务列表
+    :type tasks: List[CollectTask]
+    :param max_workers: 并发执行的任务数，不应超过连接池的最大连接数
+    :type max_workers: int
+    :param batch_size: 每批提交给写线程的行数
+    :type batch_size: int
+    :param init_db: sqlite3初始化函数，在写线程中执行
+    :type init_db: Callable[[sqlite3.Connection], None]
+    :param label: 日志前缀，多个集群并发采集时用于区分集群
+    :type label: str
+    :param append: 是否追加写入已有的文件（增量采集），追加时使用APPEND_PRAGMAS
+    :type append: bool
+    :rtype: List[TaskResult]
+    """
+    collect_time = datetime.now()
+    incremental = {task.name: task.incremental for task in tasks if task.incremental is not None}
+    writer = SQLiteWriter(db_path, batch_size=batch_size, init_db=init_db, incremental=incremental,
+                          pragmas=APPEND_PRAGMAS if append else LOAD_PRAGMAS)
+    writer.start()
+    results = {task.name: TaskResult(task.name) for task in tasks}
+    prefix = f"[{label}]" if label else ""
+    logging.info(f"{prefix}一共有{len(tasks)}个任务需要执行")
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tasks)))) as executor:
+            futures = {executor.submit(_produce, pool, writer, task, batch_size, results[task.name]): task for task in tasks}
+            for i, future in enumerate(as_completed(futures)):
+                task = futures[future]
+                future.result()
+                logging.info(f"{prefix}{task.name}执行完成，耗时:{results[task.name].elapsed:.2f}s，剩余任务数:{len(tasks) - i - 1}")
+    finally:
+        writer.close()
+    for name, result in results.items():
+        result.row_count = writer.row_counts.get(name, 0)
+        result.byte_count = writer.byte_counts.get(name, 0)
+        result.write_seconds = writer.write_seconds.get(name, 0.0)
+        result.error = writer.errors.get(name, "")
+    save_collector_stats(db_path, list(results.values()), collect_time)
+    return list(results.values())
@@ -1,13 +1,16 @@
 import logging
 from datetime import datetime, timedelta
 import pymysql
-from typing import List
+from typing import Iterator, List
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from .utils import set_max_memory
 import sqlite3
 from .duplicate_index import Index, get_tableindexes, CONST_DUPLICATE_INDEX, CONST_SUSPECTED_DUPLICATE_INDEX
 
 from .utils import catch_exception
+from .sqlite3_writer import BulkWriter
 # 关键字，实例变量不能使用这些关键字
 KEYWORDS = ["class_to_table_name", "fields"]
 # 实例变量是字符串，如果值长度比较长，创建表结构时需要特殊处理
@@ -15,35 +18,73 @@ LONG_VARCHAR_TABLE_COLUMNS = ["plan", "query", "table_names", "index_names", "di
 
 # 从数据库获取的数据保存到sqlite3的数据表中
 # 创建基类，用于生成建表语句和insert语句，让其它类继承
+# 子类通过__slots__声明字段（顺序即为表字段顺序），实例不再携带__dict__；
+# 表名和字段类型只在每个类第一次实例化时根据__init__中的默认值推断一次，之后所有实例共用
 class BaseTable:
+    __slots__ = ()
+    _table_name = None  # 子类可以指定表名，为空时表名为tidb_加类名小写
+
     def __init__(self):
-        self.class_to_table_name = "tidb_" + self.__class__.__name__.lower()
-        self.fields = {}
-        # 字段排除这里基表定义的变量，以及系统变量
-        for key, value in self.__dict__.items():
-            if key in ["class_to_table_name", "fields"]:
+        cls = self.__class__
+        # 只看当前类自己的缓存，避免子类继承到父类的表结构
+        if "_schema" not in cls.__dict__:
+            cls._schema = (cls._table_name or "tidb_" + cls.__name__.lower(), self._infer_fields())
+
+    def _field_names(self):
+        """
+        按照MRO从基类到子类的顺序收集__slots__，未声明__slots__的类则取实例变量
+        :rtype: List[str]
+        """
+        names = []
+        for klass in reversed(self.__class__.__mro__):
+            slots = klass.__dict__.get("__slots__", ())
+            names.extend([slots] if isinstance(slots, str) else slots)
+        names.extend(getattr(self, "__dict__", {}).keys())
+        return list(dict.fromkeys(name for name in names if not name.startswith("__")))
+
+    def _infer_fields(self):
+        fields = {}
+        # 字段排除这里基表定义的变量，以及未赋初值的slot
+        for key in self._field_names():
+            if key in KEYWORDS or not hasattr(self, key):
                 continue
+            value = getattr(self, key)
             if isinstance(value, str):
                 # 对超长字段做特殊处理
                 if key in LONG_VARCHAR_TABLE_COLUMNS:
-                    self.fields[key] = "text"
+                    fields[key] = "text"
                 else:
-                    self.fields[key] = "varchar(512)"  # variable的optimizer_switch字段比较长，这里要支持
+                    fields[key] = "varchar(512)"  # variable的optimizer_switch字段比较长，这里要支持
             elif isinstance(value, int):
-                self.fields[key] = "int"
+                fields[key] = "int"
             elif isinstance(value, float):
-                self.fields[key] = "float"
+                fields[key] = "float"
             elif isinstance(value, bool):
-                self.fields[key] = "tinyint"
+                fields[key] = "tinyint"
+            elif isinstance(value, bytes):
+                fields[key] = "blob"
             elif isinstance(value, dict):
-                self.fields[key] = "text"
+                fields[key] = "text"
             elif isinstance(value, list):
-                self.fields[key] = "text"
+                fields[key] = "text"
             # 如果是自定义的类则打印__str__方法
             elif hasattr(value, "__str__"):
-                self.fields[key] = "text"
+                fields[key] = "text"
             else:
-                self.fields[key] = "datetime"
+                fields[key] = "datetime"
+        return fields
+
+    @property
+    def class_to_table_name(self):
+        return self.__class__._schema[0]
+
+    @property
+    def fields(self):
+        """
+        字段名到sqlite3类型的映射，同一个类的所有实例共用，不要修改
+        :rtype: dict
+        """
+        return self.__class__._schema[1]
 
     def drop_table_sql(self):
         return f"drop table if exists {self.class_to_table_name}"
@@ -64,9 +105,8 @@ class BaseTable:
         for key in self.fields.keys():
             sql += f"{key},"
         sql = sql[:-1] + ") values ("
-        for key, value in self.__dict__.items():
-            if key in ["class_to_table_name", "fields"]:
-                continue
+        for key in self.fields.keys():
+            value = getattr(self, key)
             if isinstance(value, str):
                 # 对字符串进行转义
                 v = value.replace("'", "''")
@@ -85,8 +125,39 @@ class BaseTable:
         sql = sql[:-1] + ")"
         return sql
 
+    def bulk_insert_sql(self):
+        """
+        生成带?占位符的插入语句，同一个表类只需要生成一次，配合insert_values使用
+        :return:
+        """
+        columns = ",".join(self.fields.keys())
+        placeholders = ",".join(["?"] * len(self.fields))
+        return f"insert into {self.class_to_table_name} ({columns}) values ({placeholders})"
+
+    def insert_values(self):
+        """
+        生成参数化插入的值，顺序和fields一致，类型转换规则和insert_sql保持一致
+        :rtype: tuple
+        """
+        return tuple(to_sqlite_value(getattr(self, key)) for key in self.fields.keys())
+
+
+def to_sqlite_value(value):
+    """
+    将实例变量的值转换为sqlite3可以直接绑定的类型
+    """
+    if isinstance(value, bool):
+        return int(value)
+    if value is None or isinstance(value, (str, int, float, bytes)):
+        return value
+    if isinstance(value, (list, dict)):
+        return ",".join(value)
+    return str(value)
+
 
 class DuplicateIndex(BaseTable, Index):
+    __slots__ = ()
+
     def __init__(self):
         Index.__init__(self)
         BaseTable.__init__(self)
@@ -97,11 +168,10 @@ def get_duplicate_indexes(conn):
     获取数据库中所有重复索引
     :param conn: 数据库连接
     :type conn: pymysql.connections.Connection
-    :rtype: List[DuplicateIndex]
+    :rtype: Iterator[DuplicateIndex]
     """
-    duplicate_indexes = []
-    table_indexes = get_tableindexes(conn)
-    for table_index in table_indexes:
+    # 逐表读取并分析，内存中只保留当前表的索引
+    for table_index in get_tableindexes(conn):
         table_index.analyze_indexes()
         for index in table_index.indexes:
             if index.state == CONST_DUPLICATE_INDEX or index.state == CONST_SUSPECTED_DUPLICATE_INDEX:
@@ -112,11 +182,12 @@ def get_duplicate_indexes(conn):
                 duplicate_index.columns = index.columns
                 duplicate_index.state = index.state
                 duplicate_index.covered_by = index.covered_by
-                duplicate_indexes.append(duplicate_index)
-    return duplicate_indexes
+                yield duplicate_index
 
 
 class Variable(BaseTable):
+    __slots__ = ("type", "name", "value")
+
     def __init__(self):
         self.type = ""  # 如果是系统参数则为variable,如果是集群参数则为：tidb,pd,tikv,tiflash
         self.name = ""
@@ -157,6 +228,8 @@ def get_variables(conn):
 
 
 class ColumnCollation(BaseTable):
+    __slots__ = ("table_schema", "table_name", "column_name", "collation_name")
+
     def __init__(self):
         self.table_schema = ""
         self.table_name = ""
@@ -188,6 +261,8 @@ def get_column_collations(conn):
 
 
 class UserPrivilege(BaseTable):
+    __slots__ = ("user", "host", "privilege")
+
     def __init__(self):
         self.user = ""
         self.host = ""
@@ -231,6 +306,8 @@ class NodeVersion(BaseTable):
     节点版本信息,如果集群中各节点版本不一致，则抛出异常，如果同一节点类型的git_hash不一致，则抛出异常
     """
 
+    __slots__ = ("node_type", "version", "git_hash")
+
     def __init__(self):
         self.node_type = ""  # 节点类型
         self.version = ""  # 版本号
@@ -276,6 +353,12 @@ def get_node_versions(conn):
 
 
 class SlowQuery(BaseTable):
+    __slots__ = (
+        "digest", "exec_count", "avg_query_time", "succ_count", "sum_query_time", "sum_total_keys",
+        "avg_total_keys", "sum_process_keys", "avg_process_keys", "first_seen", "last_seen", "mem_max", "disk_max",
+        "avg_result_rows", "max_result_rows", "plan_from_binding", "plan_digest", "query", "plan"
+    )
+
     def __init__(self):
         self.digest = ""
         self.exec_count = 0
@@ -299,120 +382,270 @@ class SlowQuery(BaseTable):
         super().__init__()
 
 
-# 获取慢查询信息,默认查询最近一天的慢查询
-def get_slow_query_info(conn, start_time=None, end_time=None):
+# 慢查询按时间切片聚合，每个切片单独执行一条聚合SQL，结果在客户端按(Digest,Plan_digest)合并，
+# 避免整个时间窗口的一条大SQL超过MAX_EXECUTION_TIME后什么都拿不到
+SLOW_QUERY_TOP_N = 35  # 按总执行时间取前35条
+SLOW_QUERY_SLICE_MINUTES = 360  # 默认每个切片6小时
+SLOW_QUERY_MIN_SLICE_MINUTES = 5  # 切片超时后对半拆分，最小拆到5分钟
+ER_QUERY_TIMEOUT = 3024  # Query execution was interrupted, maximum statement execution time exceeded
+
+
+def split_time_range(start_time, end_time, slice_minutes):
     """
-    获取慢查询信息
-    :param conn: 数据库连接
-    :type conn: pymysql.connections.Connection
-    :param start_time: 慢查询开始时间
-    :type start_time: datetime
-    :param end_time: 慢查询结束时间
-    :type end_time: datetime
-    :rtype: List[SlowQuery]
-    """
-    # mysql> select time from information_schema.cluster_slow_query limit 1;
-    # +----------------------------+
-    # | time                       |
-    # +----------------------------+
-    # | 2024-08-01 20:40:08.948763 |
-    # +----------------------------+
-    # 1 row in set (0.01 sec)
-    # 将时间转换为字符串用于SQL查询
-    if not start_time or not end_time or start_time >= end_time:
-        # 查询最近一天的慢查询
-        start_time_str = "adddate(now(),INTERVAL -1 DAY)"
-        end_time_str = "now()"
-    else:
-        start_time_str = start_time.strftime("%Y-%m-%d %H:%M:%S")
-        end_time_str = end_time.strftime("%Y-%m-%d %H:%M:%S")
-    slow_queries = []
-    # get from https://tidb.net/blog/90e27aa0
-    # Binary_plan在v6.5才开始引入，所以这里不做处理
-    slow_query_sql = f"""
-    WITH ss AS
-    (SELECT s.Digest ,s.Plan_digest,
+    将[start_time, end_time]按slice_minutes切分，相邻切片首尾相差1微秒，不重复也不遗漏
+    :rtype: List[Tuple[datetime, datetime]]
+    """
+    step = timedelta(minutes=slice_minutes)
+    slices = []
+    slice_start = start_time
+    while True:
+        slice_end = min(slice_start + step - timedelta(microseconds=1), end_time)
+        # 剩余不足1微秒时并入当前切片，避免最后出现一个空切片
+        if end_time - slice_end <= timedelta(microseconds=1):
+            slices.append((slice_start, end_time))
+            return slices
+        slices.append((slice_start, slice_end))
+        slice_start = slice_end + timedelta(microseconds=1)
+
+
+def _aggregate_slow_query_slice(conn, start_time, end_time):
+    """
+    聚合一个时间切片内的慢查询，不做LIMIT，返回可以直接累加的中间结果；超时则对半拆分后重试
+    :rtype: List[dict]
+    """
+    # get from https://tidb.net/blog/90e27aa0，avg统一在合并后用sum/count计算
+    sql = f"""
+    SELECT /*+ MAX_EXECUTION_TIME(30000) MEMORY_QUOTA(2048 MB) */ s.Digest, s.Plan_digest,
     count(1) exec_count,
     sum(s.Succ) succ_count,
-    round(sum(s.Query_time),4) sum_query_time,
-    round(avg(s.Query_time),4) avg_query_time,
+    sum(s.Query_time) sum_query_time,
     sum(s.Total_keys) sum_total_keys,
-    avg(s.Total_keys) avg_total_keys,
     sum(s.Process_keys) sum_process_keys,
-    avg(s.Process_keys) avg_process_keys,
     min(s.`Time`) min_time,
     max(s.`Time`) max_time,
-    round(max(s.Mem_max)/1024/1024,4) Mem_max,
-    round(max(s.Disk_max)/1024/1024,4) Disk_max,
-    avg(s.Result_rows) avg_Result_rows,
-    max(s.Result_rows) max_Result_rows,
-    sum(Plan_from_binding) Plan_from_binding
+    max(s.Mem_max) mem_max,
+    max(s.Disk_max) disk_max,
+    sum(s.Result_rows) sum_result_rows,
+    max(s.Result_rows) max_result_rows,
+    sum(s.Plan_from_binding) plan_from_binding
     FROM information_schema.cluster_slow_query s
-    WHERE s.time>='{start_time_str}'
-    AND s.time<= '{end_time_str}'
+    WHERE s.time>='{start_time.strftime("%Y-%m-%d %H:%M:%S.%f")}'
+    AND s.time<= '{end_time.strftime("%Y-%m-%d %H:%M:%S.%f")}'
     AND s.Is_internal =0
-    -- AND UPPER(s.query) NOT LIKE '%ANALYZE TABLE%'
-    -- AND UPPER(s.query) NOT LIKE '%DBEAVER%'
-    -- AND UPPER(s.query) NOT LIKE '%ADD INDEX%'
-    -- AND UPPER(s.query) NOT LIKE '%CREATE INDEX%'
     GROUP BY s.Digest ,s.Plan_digest
-    ORDER BY sum(s.Query_time) desc
-    LIMIT 35)
-    SELECT /*+ MAX_EXECUTION_TIME(30000) MEMORY_QUOTA(2048 MB) */
-    ss.Digest,         -- SQL Digest
-    ss.Plan_digest,           -- PLAN Digest
-    (SELECT s1.Query FROM information_schema.cluster_slow_query s1 WHERE s1.Digest=ss.digest AND s1.time>=ss.min_time AND s1.time<=ss.max_time LIMIT 1) query,  -- SQL文本
-    (SELECT s2.plan FROM information_schema.cluster_slow_query s2 WHERE s2.Plan_digest=ss.plan_digest AND s2.time>=ss.min_time AND s2.time<=ss.max_time LIMIT 1) plan, -- 执行计划
-    ss.exec_count,            -- SQL总执行次数
-    ss.succ_count,            -- SQL执行成功次数
-    ss.sum_query_time,        -- 总执行时间（秒）
-    ss.avg_query_time,        -- 平均单次执行时间（秒）
-    ss.sum_total_keys,        -- 总扫描key数量
-    ss.avg_total_keys,        -- 平均单次扫描key数量
-    ss.sum_process_keys,      -- 总处理key数量
-    ss.avg_process_keys,      -- 平均单次处理key数量
-    ss.min_time,              -- 查询时间段内第一次SQL执行结束时间
-    ss.max_time,              -- 查询时间段内最后一次SQL执行结束时间
-    ss.Mem_max,               -- 单次执行中内存占用最大值（MB）
-    ss.Disk_max,              -- 单次执行中磁盘占用最大值（MB）
-    ss.avg_Result_rows,       -- 平均返回行数
-    ss.max_Result_rows,       -- 单次最大返回行数
-    ss.Plan_from_binding      -- 走SQL binding的次数
-    FROM ss;
     """
     cursor = conn.cursor(pymysql.cursors.DictCursor)
     try:
-        cursor.execute(slow_query_sql)
-    except Exception as e:
-        logging.error(f"Get slow query failed: {e}, {traceback.format_exc()}")
-        return slow_queries
-    for row in cursor:
+        cursor.execute(sql)
+        return list(cursor.fetchall())
+    except pymysql.err.OperationalError as e:
+        if e.args[0] != ER_QUERY_TIMEOUT or end_time - start_time <= timedelta(minutes=SLOW_QUERY_MIN_SLICE_MINUTES):
+            raise
+        middle = start_time + (end_time - start_time) / 2
+        logging.warning(f"Aggregate slow query timeout in [{start_time}, {end_time}], split at {middle}")
+        return (_aggregate_slow_query_slice(conn, start_time, middle) +
+                _aggregate_slow_query_slice(conn, middle + timedelta(microseconds=1), end_time))
+    finally:
+        cursor.close()
+
+
+def _merge_slow_query_slices(slice_results):
+    """
+    将各切片的聚合结果按(Digest,Plan_digest)合并，返回总执行时间最长的前SLOW_QUERY_TOP_N条
+    :param slice_results: 每个切片的聚合结果
+    :type slice_results: Iterable[List[dict]]
+    :rtype: List[dict]
+    """
+    merged = {}
+    for rows in slice_results:
+        for row in rows:
+            key = (row["Digest"], row["Plan_digest"])
+            total = merged.get(key)
+            if total is None:
+                merged[key] = dict(row)
+                continue
+            for name in ["exec_count", "succ_count", "sum_query_time", "sum_total_keys", "sum_process_keys",
+                         "sum_result_rows", "plan_from_binding"]:
+                total[name] = (total[name] or 0) + (row[name] or 0)
+            for name in ["mem_max", "disk_max", "max_result_rows"]:
+                total[name] = max(total[name] or 0, row[name] or 0)
+            total["min_time"] = min(total["min_time"], row["min_time"])
+            total["max_time"] = max(total["max_time"], row["max_time"])
+    return sorted(merged.values(), key=lambda r: float(r["sum_query_time"] or 0), reverse=True)[:SLOW_QUERY_TOP_N]
+
+
+def _fetch_slow_query_sample_group(conn, rows):
+    """
+    获取一组top SQL最近一次执行的SQL文本和执行计划，每个(Digest,Plan_digest)最后一次执行的时间就是它的max_time，
+    只需要扫描这组SQL的max_time之间的时间段；超时则对半拆分后重试，拆到单条SQL仍超时时抛出异常
+    :param rows: 按max_time排序的top SQL
+    :type rows: List[dict]
+    :return: key:(Digest,Plan_digest)，value:(query,plan)
+    :rtype: dict
+    """
+    keys = [(row["Digest"], row["Plan_digest"]) for row in rows]
+    placeholders = ",".join(["(%s,%s)"] * len(keys))
+    sql = f"""
+    SELECT /*+ MAX_EXECUTION_TIME(30000) MEMORY_QUOTA(2048 MB) */ Digest, Plan_digest, Query, Plan
+    FROM (SELECT s.Digest, s.Plan_digest, s.Query, s.Plan,
+                 row_number() over(partition by s.Digest, s.Plan_digest order by s.`Time` desc) as nbr
+          FROM information_schema.cluster_slow_query s
+          WHERE s.time>=%s AND s.time<=%s AND s.Is_internal =0
+          AND (s.Digest, s.Plan_digest) in ({placeholders})) a
+    WHERE a.nbr = 1
+    """
+    params = [rows[0]["max_time"], rows[-1]["max_time"]] + [value for key in keys for value in key]
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        return {(row[0], row[1]): (row[2], row[3]) for row in cursor.fetchall()}
+    except pymysql.err.OperationalError as e:
+        if e.args[0] != ER_QUERY_TIMEOUT or len(rows) == 1:
+            raise
+        middle = len(rows) // 2
+        logging.warning(f"Get slow query samples timeout in [{rows[0]['max_time']}, {rows[-1]['max_time']}], "
+                        f"split into two groups")
+        samples = _fetch_slow_query_sample_group(conn, rows[:middle])
+        samples.update(_fetch_slow_query_sample_group(conn, rows[middle:]))
+        return samples
+    finally:
+        cursor.close()
+
+
+def _fetch_slow_query_samples(conn, top_rows):
+    """
+    获取所有top SQL最近一次执行的SQL文本和执行计划
+    按max_time排序后，相差不超过一个切片（SLOW_QUERY_SLICE_MINUTES）的SQL为一组，每组只扫描组内max_time之间的时间段，
+    不会因为某条SQL很早之前执行过而扫描整个时间窗口
+    :return: key:(Digest,Plan_digest)，value:(query,plan)
+    :rtype: dict
+    """
+    groups = []
+    for row in sorted(top_rows, key=lambda r: r["max_time"]):
+        if groups and row["max_time"] - groups[-1][0]["max_time"] <= timedelta(minutes=SLOW_QUERY_SLICE_MINUTES):
+            groups[-1].append(row)
+        else:
+            groups.append([row])
+    samples = {}
+    for rows in groups:
+        try:
+            samples.update(_fetch_slow_query_sample_group(conn, rows))
+        except Exception as e:
+            # 文本和执行计划只是辅助信息，获取失败时仍然保留聚合结果
+            logging.error(f"Get slow query samples failed: {e}, {traceback.format_exc()}")
+    return samples
+
+
+def _to_slow_queries(top_rows, samples):
+    """
+    :rtype: Iterator[SlowQuery]
+    """
+    for row in top_rows:
+        exec_count = row["exec_count"] or 0
+        query, plan = samples.get((row["Digest"], row["Plan_digest"]), ("", ""))
         slow_query = SlowQuery()
         slow_query.digest = row["Digest"]
         slow_query.plan_digest = row["Plan_digest"]
-        slow_query.query = row["query"]
-        slow_query.plan = row["plan"]
-        slow_query.exec_count = row["exec_count"]
+        slow_query.query = query
+        slow_query.plan = plan
+        slow_query.exec_count = exec_count
         slow_query.succ_count = row["succ_count"]
-        slow_query.sum_query_time = row["sum_query_time"]
-        slow_query.avg_query_time = row["avg_query_time"]
+        slow_query.sum_query_time = round(float(row["sum_query_time"] or 0), 4)
+        slow_query.avg_query_time = round(float(row["sum_query_time"] or 0) / exec_count, 4) if exec_count else 0.0
         slow_query.sum_total_keys = row["sum_total_keys"]
-        slow_query.avg_total_keys = row["avg_total_keys"]
+        slow_query.avg_total_keys = float(row["sum_total_keys"] or 0) / exec_count if exec_count else 0.0
         slow_query.sum_process_keys = row["sum_process_keys"]
-        slow_query.avg_process_keys = row["avg_process_keys"]
+        slow_query.avg_process_keys = float(row["sum_process_keys"] or 0) / exec_count if exec_count else 0.0
         slow_query.first_seen = row["min_time"]
         slow_query.last_seen = row["max_time"]
-        slow_query.mem_max = row["Mem_max"]
-        slow_query.disk_max = row["Disk_max"]
-        slow_query.avg_result_rows = row["avg_Result_rows"]
-        slow_query.max_result_rows = row["max_Result_rows"]
-        slow_query.plan_from_binding = row["Plan_from_binding"]
-        slow_queries.append(slow_query)
-    cursor.close()
-    return slow_queries
+        slow_query.mem_max = round(float(row["mem_max"] or 0) / 1024 / 1024, 4)
+        slow_query.disk_max = round(float(row["disk_max"] or 0) / 1024 / 1024, 4)
+        slow_query.avg_result_rows = float(row["sum_result_rows"] or 0) / exec_count if exec_count else 0.0
+        slow_query.max_result_rows = row["max_result_rows"]
+        slow_query.plan_from_binding = row["plan_from_binding"]
+        yield slow_query
+
+
+def _slow_query_time_range(start_time, end_time):
+    if not start_time or not end_time or start_time >= end_time:
+        # 查询最近一天的慢查询
+        end_time = datetime.now()
+        start_time = end_time - timedelta(days=1)
+    return start_time, end_time
+
+
+# 获取慢查询信息,默认查询最近一天的慢查询
+def get_slow_query_info(conn, start_time=None, end_time=None, slice_minutes=SLOW_QUERY_SLICE_MINUTES):
+    """
+    获取慢查询信息，在同一个连接上按时间切片依次聚合
+    :param conn: 数据库连接
+    :type conn: pymysql.connections.Connection
+    :param start_time: 慢查询开始时间
+    :type start_time: datetime
+    :param end_time: 慢查询结束时间
+    :type end_time: datetime
+    :param slice_minutes: 每个时间切片的长度，单位：分钟
+    :type slice_minutes: int
+    :rtype: Iterator[SlowQuery]
+    """
+    start_time, end_time = _slow_query_time_range(start_time, end_time)
+    slices = split_time_range(start_time, end_time, slice_minutes)
+    try:
+        top_rows = _merge_slow_query_slices(_aggregate_slow_query_slice(conn, s, e) for s, e in slices)
+    except Exception as e:
+        logging.error(f"Get slow query failed: {e}, {traceback.format_exc()}")
+        return
+    yield from _to_slow_queries(top_rows, _fetch_slow_query_samples(conn, top_rows))
+
+
+def get_slow_query_info_concurrently(pool, start_time=None, end_time=None, slice_minutes=SLOW_QUERY_SLICE_MINUTES,
+                                     max_workers=4):
+    """
+    获取慢查询信息，各时间切片从连接池获取连接并发聚合，总耗时随时间窗口长度线性增长而不会超过单条SQL的执行时间限制
+    :param pool: 数据库连接池
+    :type pool: dbutils.pooled_db.PooledDB
+    :param start_time: 慢查询开始时间
+    :type start_time: datetime
+    :param end_time: 慢查询结束时间
+    :type end_time: datetime
+    :param slice_minutes: 每个时间切片的长度，单位：分钟
+    :type slice_minutes: int
+    :param max_workers: 同时聚合的切片数
+    :type max_workers: int
+    :rtype: Iterator[SlowQuery]
+    """
+    def aggregate(time_slice):
+        conn = pool.connection()
+        try:
+            return _aggregate_slow_query_slice(conn, *time_slice)
+        finally:
+            conn.close()
+
+    start_time, end_time = _slow_query_time_range(start_time, end_time)
+    slices = split_time_range(start_time, end_time, slice_minutes)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(slices))), thread_name_prefix="slow-query") as executor:
+            top_rows = _merge_slow_query_slices(executor.map(aggregate, slices))
+    except Exception as e:
+        logging.error(f"Get slow query failed: {e}, {traceback.format_exc()}")
+        return
+    conn = pool.connection()
+    try:
+        samples = _fetch_slow_query_samples(conn, top_rows)
+    finally:
+        conn.close()
+    yield from _to_slow_queries(top_rows, samples)
 
 
 class StatementHistory(BaseTable):
+    __slots__ = (
+        "digest", "exec_count", "stmt_type", "avg_latency", "instance", "summary_begin_time", "summary_end_time",
+        "first_seen", "last_seen", "plan_digest", "sum_latency", "avg_mem", "avg_disk", "avg_result_rows",
+        "avg_affected_rows", "avg_processed_keys", "avg_total_keys", "avg_rocksdb_delete_skipped_count",
+        "avg_rocksdb_key_skipped_count", "avg_rocksdb_block_read_count", "schema_name", "table_names",
+        "index_names", "digest_text", "query_sample_text", "prev_sample_text", "plan"
+    )
+
     def __init__(self):
         self.digest = ""
         self.exec_count = 0
@@ -444,70 +677,176 @@ class StatementHistory(BaseTable):
         super().__init__()
 
 
-# 查询当前数据库中INFORMATION_SCHEMA.CLUSTER_STATEMENTS_SUMMARY_HISTORY表数据
-def get_statement_history(conn, min_latency=50):
+# 历史SQL按统计窗口（SUMMARY_BEGIN_TIME）分页，每页若干个窗口，超时的页对半拆分，拆到单个窗口仍超时则停止
+STATEMENT_HISTORY_PAGE_WINDOWS = 8
+STATEMENT_HISTORY_MAX_ROWS = 100000  # 控制最多返回10万条
+
+
+def _max_execution_ms(budget, default):
     """
-    获取数据库中INFORMATION_SCHEMA.CLUSTER_STATEMENTS_SUMMARY_HISTORY视图中的SQL
-    :param min_latency: 高于该值的SQL才会被返回，单位：毫秒
-    :type min_latency: int
-    :param conn: pymysql.connections.Connection
-    :type conn: pymysql.connections.Connection
-    :return: List[StatementHistory]
+    语句的MAX_EXECUTION_TIME，有预算时为剩余预算
+    :type budget: pkg.budget.Budget
+    :rtype: int
     """
-    statement_histories = []
-    statement_history_sql = f"""
+    return default if budget is None else budget.statement_ms()
+
+
+def _to_statement_history(row):
+    statement_history = StatementHistory()
+    statement_history.exec_count = row["EXEC_COUNT"]
+    statement_history.stmt_type = row["STMT_TYPE"]
+    statement_history.avg_latency = row["AVG_LATENCY"]
+    statement_history.instance = row["INSTANCE"]
+    statement_history.summary_begin_time = row["SUMMARY_BEGIN_TIME"]
+    statement_history.summary_end_time = row["SUMMARY_END_TIME"]
+    statement_history.first_seen = row["FIRST_SEEN"]
+    statement_history.last_seen = row["LAST_SEEN"]
+    statement_history.digest = row["DIGEST"]
+    statement_history.plan_digest = row["PLAN_DIGEST"]
+    statement_history.sum_latency = row["SUM_LATENCY"]
+    statement_history.avg_mem = row["AVG_MEM"]
+    statement_history.avg_disk = row["AVG_DISK"]
+    statement_history.avg_result_rows = row["AVG_RESULT_ROWS"]
+    statement_history.avg_affected_rows = row["AVG_AFFECTED_ROWS"]
+    statement_history.avg_processed_keys = row["AVG_PROCESSED_KEYS"]
+    statement_history.avg_total_keys = row["AVG_TOTAL_KEYS"]
+    statement_history.avg_rocksdb_delete_skipped_count = row["AVG_ROCKSDB_DELETE_SKIPPED_COUNT"]
+    statement_history.avg_rocksdb_key_skipped_count = row["AVG_ROCKSDB_KEY_SKIPPED_COUNT"]
+    statement_history.avg_rocksdb_block_read_count = row["AVG_ROCKSDB_BLOCK_READ_COUNT"]
+    statement_history.schema_name = row["SCHEMA_NAME"]
+    statement_history.table_names = row["TABLE_NAMES"]
+    statement_history.index_names = row["INDEX_NAMES"]
+    statement_history.digest_text = row["DIGEST_TEXT"]
+    statement_history.query_sample_text = row["QUERY_SAMPLE_TEXT"]
+    statement_history.prev_sample_text = row["PREV_SAMPLE_TEXT"]
+    statement_history.plan = row["PLAN"]
+    return statement_history
+
+
+def _iter_statement_history_windows(conn, latency_filter, begin_times, max_rows, budget):
+    """
+    使用不缓存结果集的游标按SUMMARY_BEGIN_TIME顺序读取一页统计窗口的历史SQL，每读完一个窗口返回该窗口的所有行，
+    内存中只保留一个窗口的数据。超时则对还没有读完的窗口对半拆分后重试，单个窗口仍超时时抛出异常，已经返回的窗口都是完整的。
+    最多读取max_rows + 1行，读取的行数超过max_rows时最后返回的窗口可能不完整，由调用方丢弃
+    :type begin_times: List[datetime]
+    :type max_rows: int
+    :rtype: Iterator[List[dict]]
+    """
+    placeholders = ",".join(["%s"] * len(begin_times))
+    sql = f"""
     with top_sql as (select *
                  from (select *, row_number() over(partition by INSTANCE,SUMMARY_BEGIN_TIME order by EXEC_COUNT desc) as nbr
                        from INFORMATION_SCHEMA.CLUSTER_STATEMENTS_SUMMARY_HISTORY
-                       where AVG_LATENCY/1000000 >= {min_latency}) a -- 超过50ms的SQL
+                       where {latency_filter} and SUMMARY_BEGIN_TIME in ({placeholders})) a -- 超过50ms的SQL
                  where a.nbr <= 30) -- 取每个批次的前30条SQL
 
-    select /*+ MAX_EXECUTION_TIME(10000) MEMORY_QUOTA(1024 MB) */ EXEC_COUNT,STMT_TYPE,round(AVG_LATENCY/1000000000,3) as AVG_LATENCY,INSTANCE,SUMMARY_BEGIN_TIME,SUMMARY_END_TIME,FIRST_SEEN,LAST_SEEN,DIGEST,PLAN_DIGEST,round(SUM_LATENCY/1000000000,3) as SUM_LATENCY,AVG_MEM,AVG_DISK,AVG_RESULT_ROWS,AVG_AFFECTED_ROWS,AVG_PROCESSED_KEYS,AVG_TOTAL_KEYS,AVG_ROCKSDB_DELETE_SKIPPED_COUNT,AVG_ROCKSDB_KEY_SKIPPED_COUNT,AVG_ROCKSDB_BLOCK_READ_COUNT,SCHEMA_NAME,TABLE_NAMES,INDEX_NAMES,DIGEST_TEXT,QUERY_SAMPLE_TEXT,PREV_SAMPLE_TEXT,PLAN
-    from top_sql limit 100000 -- 控制最多返回10万条
+    select /*+ MAX_EXECUTION_TIME({_max_execution_ms(budget, 10000)}) MEMORY_QUOTA(1024 MB) */ EXEC_COUNT,STMT_TYPE,round(AVG_LATENCY/1000000000,3) as AVG_LATENCY,INSTANCE,SUMMARY_BEGIN_TIME,SUMMARY_END_TIME,FIRST_SEEN,LAST_SEEN,DIGEST,PLAN_DIGEST,round(SUM_LATENCY/1000000000,3) as SUM_LATENCY,AVG_MEM,AVG_DISK,AVG_RESULT_ROWS,AVG_AFFECTED_ROWS,AVG_PROCESSED_KEYS,AVG_TOTAL_KEYS,AVG_ROCKSDB_DELETE_SKIPPED_COUNT,AVG_ROCKSDB_KEY_SKIPPED_COUNT,AVG_ROCKSDB_BLOCK_READ_COUNT,SCHEMA_NAME,TABLE_NAMES,INDEX_NAMES,DIGEST_TEXT,QUERY_SAMPLE_TEXT,PREV_SAMPLE_TEXT,PLAN
+    from top_sql order by SUMMARY_BEGIN_TIME limit {max_rows + 1}
     """
-    cursor = conn.cursor(pymysql.cursors.DictCursor)
+    done_times = set()  # 已经返回的窗口
+    row_count = 0  # 已经返回的行数
+    error = None
+    cursor = conn.cursor(pymysql.cursors.SSDictCursor)
     try:
-        cursor.execute(statement_history_sql)
+        cursor.execute(sql, begin_times)
+        window_rows = []
+        for row in cursor:
+            if window_rows and row["SUMMARY_BEGIN_TIME"] != window_rows[0]["SUMMARY_BEGIN_TIME"]:
+                done_times.add(window_rows[0]["SUMMARY_BEGIN_TIME"])
+                row_count += len(window_rows)
+                yield window_rows
+                window_rows = []
+            window_rows.append(row)
+        if window_rows:
+            yield window_rows
+    except pymysql.err.OperationalError as e:
+        rest_times = [begin_time for begin_time in begin_times if begin_time not in done_times]
+        if e.args[0] != ER_QUERY_TIMEOUT or len(rest_times) <= 1:
+            raise
+        error = e
+    finally:
+        cursor.close()
+    if error is None:
+        return
+    # 未读完的窗口对半拆分后重试
+    middle = len(rest_times) // 2
+    logging.warning(f"Get statement history timeout in {len(rest_times)} windows from {rest_times[0]}, split into two pages")
+    for page_times in (rest_times[:middle], rest_times[middle:]):
+        for window_rows in _iter_statement_history_windows(conn, latency_filter, page_times, max_rows - row_count, budget):
+            row_count += len(window_rows)
+            yield window_rows
+            if row_count > max_rows:
+                return
+
+
+# 查询当前数据库中INFORMATION_SCHEMA.CLUSTER_STATEMENTS_SUMMARY_HISTORY表数据
+def get_statement_history(conn, min_latency=50, start_time=None, budget=None):
+    """
+    获取数据库中INFORMATION_SCHEMA.CLUSTER_STATEMENTS_SUMMARY_HISTORY视图中的SQL
+    按SUMMARY_BEGIN_TIME从早到晚分页获取，超时、超出预算或超过STATEMENT_HISTORY_MAX_ROWS行时保留已经获取的窗口并标记为部分结果，
+    已返回的窗口都是完整的，增量采集的水位线不会越过未获取的窗口，下次采集从这里继续
+    :param min_latency: 高于该值的SQL才会被返回，单位：毫秒
+    :type min_latency: int
+    :param start_time: 只获取SUMMARY_END_TIME大于该时间的统计窗口，增量采集时为上次的水位线，None表示获取全部
+    :type start_time: str
+    :param budget: 执行时间预算，None表示只受会话的max_execution_time限制
+    :type budget: pkg.budget.Budget
+    :param conn: pymysql.connections.Connection
+    :type conn: pymysql.connections.Connection
+    :return: Iterator[StatementHistory]
+    """
+    latency_filter = f"AVG_LATENCY/1000000 >= {min_latency}"
+    if start_time:
+        latency_filter += f" and SUMMARY_END_TIME > '{start_time}'"
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"select /*+ MAX_EXECUTION_TIME({_max_execution_ms(budget, 10000)}) */ distinct SUMMARY_BEGIN_TIME "
+                       f"from INFORMATION_SCHEMA.CLUSTER_STATEMENTS_SUMMARY_HISTORY where {latency_filter} order by SUMMARY_BEGIN_TIME")
+        begin_times = [row[0] for row in cursor.fetchall()]
     except Exception as e:
         logging.error(f"Get statement history failed: {e}, {traceback.format_exc()}")
-        return statement_histories
-    for row in cursor:
-        statement_history = StatementHistory()
-        statement_history.exec_count = row["EXEC_COUNT"]
-        statement_history.stmt_type = row["STMT_TYPE"]
-        statement_history.avg_latency = row["AVG_LATENCY"]
-        statement_history.instance = row["INSTANCE"]
-        statement_history.summary_begin_time = row["SUMMARY_BEGIN_TIME"]
-        statement_history.summary_end_time = row["SUMMARY_END_TIME"]
-        statement_history.first_seen = row["FIRST_SEEN"]
-        statement_history.last_seen = row["LAST_SEEN"]
-        statement_history.digest = row["DIGEST"]
-        statement_history.plan_digest = row["PLAN_DIGEST"]
-        statement_history.sum_latency = row["SUM_LATENCY"]
-        statement_history.avg_mem = row["AVG_MEM"]
-        statement_history.avg_disk = row["AVG_DISK"]
-        statement_history.avg_result_rows = row["AVG_RESULT_ROWS"]
-        statement_history.avg_affected_rows = row["AVG_AFFECTED_ROWS"]
-        statement_history.avg_processed_keys = row["AVG_PROCESSED_KEYS"]
-        statement_history.avg_total_keys = row["AVG_TOTAL_KEYS"]
-        statement_history.avg_rocksdb_delete_skipped_count = row["AVG_ROCKSDB_DELETE_SKIPPED_COUNT"]
-        statement_history.avg_rocksdb_key_skipped_count = row["AVG_ROCKSDB_KEY_SKIPPED_COUNT"]
-        statement_history.avg_rocksdb_block_read_count = row["AVG_ROCKSDB_BLOCK_READ_COUNT"]
-        statement_history.schema_name = row["SCHEMA_NAME"]
-        statement_history.table_names = row["TABLE_NAMES"]
-        statement_history.index_names = row["INDEX_NAMES"]
-        statement_history.digest_text = row["DIGEST_TEXT"]
-        statement_history.query_sample_text = row["QUERY_SAMPLE_TEXT"]
-        statement_history.prev_sample_text = row["PREV_SAMPLE_TEXT"]
-        statement_history.plan = row["PLAN"]
-        statement_histories.append(statement_history)
-    cursor.close()
-    return statement_histories
+        if budget is not None:
+            budget.mark_partial(f"获取统计窗口失败: {e}")
+        return
+    finally:
+        cursor.close()
+    remaining = STATEMENT_HISTORY_MAX_ROWS
+    for i in range(0, len(begin_times), STATEMENT_HISTORY_PAGE_WINDOWS):
+        if budget is not None and budget.expired():
+            budget.mark_partial(f"剩余{len(begin_times) - i}个统计窗口未获取，从{begin_times[i]}开始")
+            return
+        last_time = None
+        windows = _iter_statement_history_windows(conn, latency_filter, begin_times[i:i + STATEMENT_HISTORY_PAGE_WINDOWS],
+                                                  remaining, budget)
+        try:
+            for window_rows in windows:
+                if len(window_rows) > remaining:
+                    # 超过最大行数时最后一个窗口可能不完整，整个窗口丢弃，水位线停在之前的窗口
+                    reason = f"超过{STATEMENT_HISTORY_MAX_ROWS}行，从{window_rows[0]['SUMMARY_BEGIN_TIME']}开始的窗口未获取"
+                    logging.warning(f"Get statement history stopped: {reason}")
+                    if budget is not None:
+                        budget.mark_partial(reason)
+                    return
+                remaining -= len(window_rows)
+                last_time = window_rows[0]["SUMMARY_BEGIN_TIME"]
+                for row in window_rows:
+                    yield _to_statement_history(row)
+        except Exception as e:
+            # 超时前已经获取的窗口已经返回
+            if not (isinstance(e, pymysql.err.OperationalError) and e.args[0] == ER_QUERY_TIMEOUT):
+                logging.error(f"Get statement history failed: {e}, {traceback.format_exc()}")
+            if budget is not None:
+                budget.mark_partial(f"统计窗口获取到{last_time or '无'}，之后的窗口未获取: {e}")
+            return
+        finally:
+            windows.close()
 
 # 获取集群节点信息
 # -- 以节点为视角查询集群所有节点信息,包括端口号信息
 # select type,instance,STATUS_ADDRESS,version,START_TIME,uptime,SERVER_ID from INFORMATION_SCHEMA.CLUSTER_INFO;
 class NodeInfo(BaseTable):
+    __slots__ = ("type", "instance", "status_address", "version", "start_time", "uptime", "server_id")
+
     def __init__(self):
         self.type = ""
         self.instance = ""
@@ -542,6 +881,30 @@ def get_node_info(conn):
     return node_infos
 
 
+# 采集任务自身的耗时和资源统计，每次采集追加写入，用于按集群调整functions_to_save
+class CollectorStats(BaseTable):
+    __slots__ = (
+        "collect_time", "task_name", "status", "elapsed_s", "query_s", "wait_s", "write_s", "row_count", "bytes",
+        "peak_rss_delta_mb", "budget_s", "error",
+    )
+    _table_name = "tidb_collector_stats"
+
+    def __init__(self):
+        self.collect_time = ""  # 本次采集的开始时间，同一次采集的所有任务相同
+        self.task_name = ""
+        self.status = ""  # success/partial/failed，partial表示超出执行时间预算，只保存了部分结果
+        self.elapsed_s = 0.0  # 从获取连接到数据全部提交给写线程的耗时
+        self.query_s = 0.0  # 执行SQL和从TiDB读取数据的耗时
+        self.wait_s = 0.0  # 写线程繁忙时等待队列的耗时
+        self.write_s = 0.0  # 写线程建表、写入和提交的耗时
+        self.row_count = 0
+        self.bytes = 0  # 估算的数据量，字符串按字符数、数值按8字节计算
+        self.peak_rss_delta_mb = 0.0  # 任务执行前后进程内存峰值的增量，多个任务并发时只能作为参考
+        self.budget_s = 0.0  # 本次的执行时间预算，0表示没有单独的预算
+        self.error = ""
+        super().__init__()
+
+
 # 将所有的函数输出写到sqlite3的数据表中
 
 def SaveData(conn, callback, *args, **kwargs):
@@ -559,28 +922,8 @@ def SaveData(conn, callback, *args, **kwargs):
     """
     try:
         rows = callback(*args, **kwargs)
-        logging.debug(f"Get data from callback[{callback.__name__}]: {len(rows)}")
-        cursor = conn.cursor()
-        table_created = False
-        # 500条数据一次提交
-        batch_size = 500
-        for (i, row) in enumerate(rows):
-            try:
-                if not table_created:
-                    # logging.debug(f"Create table sql: {create_table_sql}")
-                    cursor.execute(row.drop_table_sql())
-                    cursor.execute(row.create_table_sql())
-                    table_created = True
-                cursor.execute(row.insert_sql())
-                if i != 0 and i % batch_size == 0:
-                    # logging.debug(f"insert sql: {row.insert_sql()}")
-                    conn.commit()
-            except Exception as e:
-                logging.error(
-                    f"Save data failed: {e}, {traceback.format_exc()}, {row.create_table_sql()}, {row.insert_sql()}")
-                return False
-        conn.commit()
-        cursor.close()
+        row_count = BulkWriter(conn).save(rows)
+        logging.debug(f"Save data from callback[{callback.__name__}]: {row_count}")
         return True
     except Exception as e:
         logging.error(f"Save data failed: {e}, {traceback.format_exc()}")
@@ -620,6 +963,8 @@ def SaveData(conn, callback, *args, **kwargs):
 #               on a.ip_address = b.ip_address
 #          join ip_hostname_map c on a.ip_address = c.ip_address;
 class OSInfo(BaseTable):
+    __slots__ = ("hostname", "ip_address", "types_count", "cpu_arch", "cpu_cores", "memory_capacity_gb")
+
     def __init__(self):
         self.hostname = ""
         self.ip_address = ""
@@ -629,58 +974,29 @@ class OSInfo(BaseTable):
         self.memory_capacity_gb = 0.0
         super().__init__()
 
-def get_os_info(conn):
+def get_os_info(conn, topology):
     """
-    获取数据库中所有节点的操作系统信息
+    获取数据库中所有节点的操作系统信息，直接取自主机拓扑
     :param conn: 数据库连接
     :type conn: pymysql.connections.Connection
+    :param topology: 主机拓扑
+    :type topology: pkg.topology.Topology
     :rtype: List[OSInfo]
     """
     os_infos: List[OSInfo] = []
-    cursor = conn.cursor()
-    cursor.execute("""
-    WITH ip_node_map as (SELECT ip_address,
-                                GROUP_CONCAT(CONCAT(TYPE, '(', TYPE_COUNT, ')') ORDER BY TYPE) AS TYPES_COUNT
-                         FROM (SELECT SUBSTRING_INDEX(INSTANCE, ':', 1) AS ip_address,
-                                      TYPE,
-                                      COUNT(*)                          AS TYPE_COUNT
-                               FROM INFORMATION_SCHEMA.CLUSTER_INFO
-                               GROUP BY SUBSTRING_INDEX(INSTANCE, ':', 1), TYPE) node_type_count
-                         GROUP BY ip_address),
-         os_info AS (SELECT SUBSTRING_INDEX(INSTANCE, ':', 1)                         AS IP_ADDRESS,
-                            MAX(CASE WHEN NAME = 'cpu-physical-cores' THEN VALUE END) AS CPU_CORES,
-                            MAX(CASE WHEN NAME = 'capacity' THEN VALUE END)           AS MEMORY_CAPACITY,
-                            MAX(CASE WHEN NAME = 'cpu-arch' THEN VALUE END)           AS CPU_ARCH
-                     FROM INFORMATION_SCHEMA.CLUSTER_HARDWARE
-                     WHERE (DEVICE_TYPE = 'cpu' AND DEVICE_NAME = 'cpu' AND NAME IN ('cpu-arch', 'cpu-physical-cores'))
-                        OR (DEVICE_TYPE = 'memory' AND DEVICE_NAME = 'memory' AND NAME = 'capacity')
-                     GROUP BY SUBSTRING_INDEX(INSTANCE, ':', 1)),
-         ip_hostname_map as (select substring_index(instance, ':', 1) as ip_address,
-                                    value                             as hostname
-                             from INFORMATION_SCHEMA.CLUSTER_SYSTEMINFO
-                             where name = 'kernel.hostname'
-                             group by ip_address, hostname)
-    select c.hostname,
-           a.ip_address,
-           types_count,
-           cpu_arch,
-           cpu_cores,
-           round(memory_capacity / 1024 / 1024 / 1024, 1) as memory_capacity_gb
-    from ip_node_map a
-             join os_info b
-                  on a.ip_address = b.ip_address
-             join ip_hostname_map c on a.ip_address = c.ip_address;
-    """)
-    for row in cursor:
+    topology.load(conn)
+    for ip, host in topology.hosts.items():
+        # 和原来的内连接一致，只保留同时有节点、主机名和硬件信息的主机
+        if not host.types_count or not host.hostname or ip not in topology.hardware_ips:
+            continue
         os_info = OSInfo()
-        os_info.hostname = row[0]
-        os_info.ip_address = row[1]
-        os_info.types_count = row[2]
-        os_info.cpu_arch = row[3]
-        os_info.cpu_cores = row[4]
-        os_info.memory_capacity_gb = row[5]
+        os_info.hostname = host.hostname
+        os_info.ip_address = ip
+        os_info.types_count = host.types_count
+        os_info.cpu_arch = host.cpu_arch
+        os_info.cpu_cores = host.cpu_cores
+        os_info.memory_capacity_gb = host.memory_capacity_gb
         os_infos.append(os_info)
-    cursor.close()
     return os_infos
 
 # -- 查看磁盘使用率情况
@@ -728,6 +1044,11 @@ def get_os_info(conn):
 #          left join ip_node_map c on a.ip_address = c.ip_address
 # order by a.time, a.device, a.instance;
 class DiskInfo(BaseTable):
+    __slots__ = (
+        "time", "ip_address", "hostname", "types_count", "fstype", "mountpoint", "aval_size_gb", "total_size_gb",
+        "used_percent"
+    )
+
     def __init__(self):
         self.time = ""
         self.ip_address = ""
@@ -740,77 +1061,55 @@ class DiskInfo(BaseTable):
         self.used_percent = 0.0
         super().__init__()
 
-def get_disk_info(conn):
+def get_disk_info(conn, topology):
     """
-    获取数据库中所有节点的磁盘使用率信息
+    获取数据库中所有节点的磁盘使用率信息，主机名和节点类型从主机拓扑中关联
     :param conn: 数据库连接
     :type conn: pymysql.connections.Connection
+    :param topology: 主机拓扑
+    :type topology: pkg.topology.Topology
     :rtype: List[DiskInfo]
     """
     disk_infos: List[DiskInfo] = []
+    topology.load(conn)
     cursor = conn.cursor()
     cursor.execute("""
-    with disk_info as (select a.time,
-                              a.device,
-                              a.instance,
-                              substring_index(a.instance, ':', 1)     as ip_address,
-                              a.fstype,
-                              a.mountpoint,
-                              round(a.value / 1024 / 1024 / 1024, 2)  as aval_size_gb,
-                              round(a.value / 1024 / 1024 / 1024, 2)  as total_size_gb,
-                              round((b.value - a.value) / b.value, 2) as used_percent
-                       from METRICS_SCHEMA.node_disk_available_size a,
-                            METRICS_SCHEMA.node_disk_size b
-                       where a.time = b.time
-                         and a.instance = b.instance
-                         and a.device = b.device
-                         and a.mountpoint = b.mountpoint
-                         and a.time = now()
-                         and a.mountpoint like '%%'),
-         ip_host_map as (select substring_index(instance, ':', 1) as ip_address,
-                                value                             as hostname
-                         from INFORMATION_SCHEMA.CLUSTER_SYSTEMINFO
-                         where name = 'kernel.hostname'
-                         group by ip_address, hostname),
-         ip_node_map as (SELECT ip_address,
-                                GROUP_CONCAT(CONCAT(TYPE, '(', TYPE_COUNT, ')') ORDER BY TYPE) AS TYPES_COUNT
-                         FROM (SELECT SUBSTRING_INDEX(INSTANCE, ':', 1) AS ip_address,
-                                      TYPE,
-                                      COUNT(*)                          AS TYPE_COUNT
-                               FROM INFORMATION_SCHEMA.CLUSTER_INFO
-                               GROUP BY SUBSTRING_INDEX(INSTANCE, ':', 1), TYPE) node_type_count
-                         GROUP BY ip_address)
     select a.time,
-           a.ip_address,
-           b.hostname,
-           c.TYPES_COUNT,
+           substring_index(a.instance, ':', 1)     as ip_address,
            a.fstype,
            a.mountpoint,
-           a.aval_size_gb,
-           a.total_size_gb,
-           a.used_percent
-    from disk_info a
-             left join ip_host_map b on a.ip_address = b.ip_address
-             left join ip_node_map c on a.ip_address = c.ip_address
+           round(a.value / 1024 / 1024 / 1024, 2)  as aval_size_gb,
+           round(a.value / 1024 / 1024 / 1024, 2)  as total_size_gb,
+           round((b.value - a.value) / b.value, 2) as used_percent
+    from METRICS_SCHEMA.node_disk_available_size a,
+         METRICS_SCHEMA.node_disk_size b
+    where a.time = b.time
+      and a.instance = b.instance
+      and a.device = b.device
+      and a.mountpoint = b.mountpoint
+      and a.time = now()
     order by a.time, a.device, a.instance;
     """)
     for row in cursor:
+        host = topology.hosts.get(row[1])
         disk_info = DiskInfo()
         disk_info.time = row[0]
         disk_info.ip_address = row[1]
-        disk_info.hostname = row[2]
-        disk_info.types_count = row[3]
-        disk_info.fstype = row[4]
-        disk_info.mountpoint = row[5]
-        disk_info.aval_size_gb = row[6]
-        disk_info.total_size_gb = row[7]
-        disk_info.used_percent = row[8]
+        disk_info.hostname = host.hostname if host else None
+        disk_info.types_count = host.types_count if host else None
+        disk_info.fstype = row[2]
+        disk_info.mountpoint = row[3]
+        disk_info.aval_size_gb = row[4]
+        disk_info.total_size_gb = row[5]
+        disk_info.used_percent = row[6]
         disk_infos.append(disk_info)
     cursor.close()
     return disk_infos
 
 # select TABLE_SCHEMA,TABLE_NAME, table_rows,avg_row_length as avg_row_length_byte,round((DATA_LENGTH + INDEX_LENGTH) / 1024/1024/1024,2) as table_size_gb from INFORMATION_SCHEMA.tables where table_type='BASE TABLE' and (DATA_LENGTH + INDEX_LENGTH) / 1024/1024/1024 > 10 or  table_rows > 5000000;
 class TableInfo(BaseTable):
+    __slots__ = ("table_schema", "table_name", "table_rows", "avg_row_length_byte", "table_size_gb")
+
     def __init__(self):
         self.table_schema = ""
         self.table_name = ""
@@ -819,28 +1118,52 @@ class TableInfo(BaseTable):
         self.table_size_gb = 0.0
         super().__init__()
 
-def get_table_info(conn):
+def get_table_info(conn, budget=None):
     """
     获取数据库中所有表的信息
+    按schema分页查询，某个schema超时时跳过并标记为部分结果，超出预算时不再查询剩余的schema
     :param conn: 数据库连接
     :type conn: pymysql.connections.Connection
-    :rtype: List[TableInfo]
+    :param budget: 执行时间预算，None表示只受会话的max_execution_time限制
+    :type budget: pkg.budget.Budget
+    :rtype: Iterator[TableInfo]
     """
-    table_infos: List[TableInfo] = []
     cursor = conn.cursor()
-    cursor.execute("""
-    select TABLE_SCHEMA,TABLE_NAME, table_rows,avg_row_length as avg_row_length_byte,round((DATA_LENGTH + INDEX_LENGTH) / 1024/1024/1024,2) as table_size_gb from INFORMATION_SCHEMA.tables where table_type='BASE TABLE' and (DATA_LENGTH + INDEX_LENGTH) / 1024/1024/1024 > 10 or  table_rows > 5000000;
-    """)
-    for row in cursor:
-        table_info = TableInfo()
-        table_info.table_schema = row[0]
-        table_info.table_name = row[1]
-        table_info.table_rows = row[2]
-        table_info.avg_row_length_byte = row[3]
-        table_info.table_size_gb = row[4]
-        table_infos.append(table_info)
-    cursor.close()
-    return table_infos
+    try:
+        cursor.execute("select schema_name from INFORMATION_SCHEMA.SCHEMATA order by schema_name")
+        schemas = [row[0] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+    skipped = []
+    for i, schema in enumerate(schemas):
+        if budget is not None and budget.expired():
+            budget.mark_partial(f"剩余{len(schemas) - i}个schema未获取，跳过的schema:{skipped}")
+            return
+        cursor = conn.cursor()
+        try:
+            # table_schema条件可以下推，每次只读取一个schema的表
+            cursor.execute("""
+    select TABLE_SCHEMA,TABLE_NAME, table_rows,avg_row_length as avg_row_length_byte,round((DATA_LENGTH + INDEX_LENGTH) / 1024/1024/1024,2) as table_size_gb from INFORMATION_SCHEMA.tables where table_schema = %s and (table_type='BASE TABLE' and (DATA_LENGTH + INDEX_LENGTH) / 1024/1024/1024 > 10 or  table_rows > 5000000);
+    """, (schema,))
+            rows = cursor.fetchall()
+        except pymysql.err.OperationalError as e:
+            if e.args[0] != ER_QUERY_TIMEOUT:
+                raise
+            logging.warning(f"Get table info of schema {schema} timeout, skip it")
+            skipped.append(schema)
+            continue
+        finally:
+            cursor.close()
+        for row in rows:
+            table_info = TableInfo()
+            table_info.table_schema = row[0]
+            table_info.table_name = row[1]
+            table_info.table_rows = row[2]
+            table_info.avg_row_length_byte = row[3]
+            table_info.table_size_gb = row[4]
+            yield table_info
+    if skipped and budget is not None:
+        budget.mark_partial(f"超时跳过的schema:{skipped}")
 
 # -- 数据库内存增长率，只查看最近1周的各os内存增长率情况，每小时打印一次
 # set @@tidb_metric_query_step = 3600;
@@ -876,6 +1199,8 @@ def get_table_info(conn):
 #          join ip_hostname_map c on substring_index(instance, ':', 1) = c.ip_address
 # where a.time between date_sub(now(), interval 7 day) and now();
 class MemoryUsageDetail(BaseTable):
+    __slots__ = ("time", "ip_address", "hostname", "types_count", "used_percent")
+
     def __init__(self):
         self.time = ""
         self.ip_address = ""
@@ -884,58 +1209,6 @@ class MemoryUsageDetail(BaseTable):
         self.used_percent = 0.0
         super().__init__()
 
-def get_memory_detail(conn):
-    """
-    获取数据库中所有节点的内存使用率信息
-    :param conn: 数据库连接
-    :type conn: pymysql.connections.Connection
-    :rtype: List[MemoryUsageDetail]
-    """
-    memory_infos: List[MemoryUsageDetail] = []
-    cursor = conn.cursor()
-    cursor.execute("""
-    WITH ip_node_map as (SELECT ip_address,
-                                GROUP_CONCAT(CONCAT(TYPE, '(', TYPE_COUNT, ')') ORDER BY TYPE) AS TYPES_COUNT
-                         FROM (SELECT SUBSTRING_INDEX(INSTANCE, ':', 1) AS ip_address,
-                                      TYPE,
-                                      COUNT(*)                          AS TYPE_COUNT
-                               FROM INFORMATION_SCHEMA.CLUSTER_INFO
-                               GROUP BY SUBSTRING_INDEX(INSTANCE, ':', 1), TYPE) node_type_count
-                         GROUP BY ip_address),
-         os_info AS (SELECT SUBSTRING_INDEX(INSTANCE, ':', 1)                         AS IP_ADDRESS,
-                            MAX(CASE WHEN NAME = 'cpu-physical-cores' THEN VALUE END) AS CPU_CORES,
-                            MAX(CASE WHEN NAME = 'capacity' THEN VALUE END)           AS MEMORY_CAPACITY,
-                            MAX(CASE WHEN NAME = 'cpu-arch' THEN VALUE END)           AS CPU_ARCH
-                     FROM INFORMATION_SCHEMA.CLUSTER_HARDWARE
-                     WHERE (DEVICE_TYPE = 'cpu' AND DEVICE_NAME = 'cpu' AND NAME IN ('cpu-arch', 'cpu-physical-cores'))
-                        OR (DEVICE_TYPE = 'memory' AND DEVICE_NAME = 'memory' AND NAME = 'capacity')
-                     GROUP BY SUBSTRING_INDEX(INSTANCE, ':', 1)),
-         ip_hostname_map as (select substring_index(instance, ':', 1) as ip_address,
-                                value                             as hostname
-                         from INFORMATION_SCHEMA.CLUSTER_SYSTEMINFO
-                         where name = 'kernel.hostname'
-                         group by ip_address, hostname)
-    select time,
-           substring_index(instance, ':', 1) as ip_address,
-           c.hostname,
-           b.TYPES_COUNT,
-           round(value / 100, 2)             as used_percent
-    from METRICS_SCHEMA.node_memory_usage a
-             join ip_node_map b on substring_index(instance, ':', 1) = b.ip_address
-             join ip_hostname_map c on substring_index(instance, ':', 1) = c.ip_address
-    where a.time between date_sub(now(), interval 7 day) and now();
-    """)
-    for row in cursor:
-        memory_info = MemoryUsageDetail()
-        memory_info.time = row[0]
-        memory_info.ip_address = row[1]
-        memory_info.hostname = row[2]
-        memory_info.types_count = row[3]
-        memory_info.used_percent = row[4]
-        memory_infos.append(memory_info)
-    cursor.close()
-    return memory_infos
-
 # -- 下面语句统计每个节点的，连接数总量、活跃连接数，对于整个集群的只需要汇总即可
 # select b.type, b.hostname, a.instance, a.connection_count,a.active_connection_count
 # from (select instance,
@@ -992,6 +1265,10 @@ def get_memory_detail(conn):
 #                           where `key` in ('max-server-connections', 'instance.max_connections')) c
 #                          on b.INSTANCE = c.INSTANCE and c.nbr = 1) a;
 class ConnectionInfo(BaseTable):
+    __slots__ = (
+        "type", "hostname", "instance", "connection_count", "configured_max_counnection_count", "connection_ratio"
+    )
+
     def __init__(self):
         self.type = ""
         self.hostname = ""
@@ -1070,6 +1347,8 @@ from (select b.type,
 #          join INFORMATION_SCHEMA.CLUSTER_TIDB_TRX ctt on cp.INSTANCE = ctt.INSTANCE and cp.ID = ctt.SESSION_ID
 # where cp.COMMAND != 'Sleep' and cp.ID != CONNECTION_ID();
 class ActiveSessionCount(BaseTable):
+    __slots__ = ("total_active_sessions", "lock_waiting_sessions", "metadata_lock_waiting_sessions")
+
     def __init__(self):
         self.total_active_sessions = 0
         self.lock_waiting_sessions = 0
@@ -1116,6 +1395,11 @@ def get_active_session_count(conn):
 #        0 as ddl_blocking_count
 # from mysql.tidb_mdl_view tmv;
 class MetadataLockWait(BaseTable):
+    __slots__ = (
+        "holding_session_id", "holding_sqls", "waiting_ddl_job", "cancel_ddl_job", "ddl_job_dbname",
+        "ddl_job_tablename", "waiting_ddl_sql", "ddl_is_locksource", "ddl_blocking_count"
+    )
+
     def __init__(self):
         self.holding_session_id = 0
         self.holding_sqls = ""
@@ -1150,11 +1434,12 @@ from mysql.tidb_mdl_view tmv;
     """
     metadata_lock_waits: List[MetadataLockWait] = []
     cursor = conn.cursor()
+    # 执行出错（比如超过max_execution_time）时抛出异常，而不是返回空列表，避免watch把它当成锁等待已经消失
     try:
         cursor.execute(sql_text)
-    except Exception as e:
-        logging.error(f"Execute sql failed: {e}, {traceback.format_exc()}")
-        return metadata_lock_waits
+    except Exception:
+        cursor.close()
+        raise
     for row in cursor:
         metadata_lock_wait = MetadataLockWait()
         metadata_lock_wait.holding_session_id = row[0]
@@ -1246,6 +1531,13 @@ from mysql.tidb_mdl_view tmv;
 #      ON
 #          ht.instance = pl_hold.instance AND ht.session_id = pl_hold.id;
 class LockChain(BaseTable):
+    __slots__ = (
+        "waiting_instance", "waiting_user", "waiting_client_ip", "waiting_transaction", "waiting_duration_sec",
+        "waiting_current_sql_digest", "waiting_sql", "lock_chain_node_type", "holding_session_id",
+        "kill_holding_session_cmd", "holding_instance", "holding_user", "holding_client_ip", "holding_transaction",
+        "holding_sql_digest", "holding_sql_source", "holding_sql"
+    )
+
     def __init__(self):
         self.waiting_instance = ""
         self.waiting_user = ""
@@ -1467,116 +1759,180 @@ def get_lock_chain(conn):
 #
 # select '------ 输出结束------';
 # drop temporary table if exists lock_source_check;
+# 上面的SQL每个周期都要在服务端重新执行一次递归关联，并且sleep期间一直占用连接，
+# 这里改为每次采样只执行一条扁平查询获取等待边，在客户端构建等待图找锁源头和环，采样间隔内不占用连接
+LOCK_SAMPLE_COUNT = 3  # 默认采样次数
+LOCK_SAMPLE_INTERVAL = 5  # 默认采样间隔，单位：秒
+
+
 class LockSourceChange(BaseTable):
+    __slots__ = (
+        "source_session_id", "source_trx_id", "hit_count", "sample_count", "persistence", "max_blocked_count",
+        "in_cycle", "status",
+    )
+
     def __init__(self):
         self.source_session_id = 0
-        self.cycle1 = 0
-        self.cycle2 = 0
-        self.cycle3 = 0
+        self.source_trx_id = 0  # 最后一次采样时的持锁事务
+        self.hit_count = 0  # 作为锁源头出现的采样次数
+        self.sample_count = 0  # 总采样次数
+        self.persistence = 0.0  # hit_count/sample_count，为1表示每次采样都是锁源头
+        self.max_blocked_count = 0  # 各次采样中直接或间接被阻塞的事务数的最大值
+        self.in_cycle = 0  # 是否处于循环等待中（没有源头，环上的事务都作为源头）
         self.status = ""
         super().__init__()
 
 
-def get_lock_source_change(conn):
+class LockWaitGraph:
     """
-    获取数据库中所有节点的锁源头变化信息,该函数会等待多次
-    :param conn: 数据库连接
-    :type conn: pymysql.connections.Connection
+    事务等待图，边为等待事务->持锁事务
+    """
+
+    def __init__(self):
+        self.edges = {}  # key:等待事务，value:持锁事务集合
+        self.waiters = {}  # key:持锁事务，value:等待它的事务集合
+        self.sessions = {}  # key:事务，value:session_id
+
+    def add_wait(self, waiting_trx_id, holding_trx_id, holding_session_id=None):
+        self.edges.setdefault(waiting_trx_id, set()).add(holding_trx_id)
+        self.waiters.setdefault(holding_trx_id, set()).add(waiting_trx_id)
+        if holding_session_id is not None:
+            self.sessions[holding_trx_id] = holding_session_id
+
+    def roots(self):
+        """
+        锁源头：被其它事务等待，自己没有等待任何事务
+        :rtype: List
+        """
+        return [trx_id for trx_id in self.waiters if trx_id not in self.edges]
+
+    def cycles(self):
+        """
+        使用迭代的Tarjan算法查找强连通分量，返回所有的环（节点数大于1的强连通分量）
+        :rtype: List[List]
+        """
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        cycles = []
+        counter = 0
+        for start in self.edges:
+            if start in index:
+                continue
+            work = [(start, iter(self.edges.get(start, ())))]
+            index[start] = low[start] = counter
+            counter += 1
+            stack.append(start)
+            on_stack.add(start)
+            while work:
+                node, children = work[-1]
+                child = next(children, None)
+                if child is not None:
+                    if child not in index:
+                        index[child] = low[child] = counter
+                        counter += 1
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(self.edges.get(child, ()))))
+                    elif child in on_stack:
+                        low[node] = min(low[node], index[child])
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) > 1:
+                        cycles.append(component)
+        return cycles
+
+    def blocked_count(self, trx_id):
+        """
+        直接或间接等待trx_id的事务数
+        :rtype: int
+        """
+        visited = {trx_id}
+        pending = [trx_id]
+        while pending:
+            for waiter in self.waiters.get(pending.pop(), ()):
+                if waiter not in visited:
+                    visited.add(waiter)
+                    pending.append(waiter)
+        return len(visited) - 1
+
+
+def _sample_lock_wait_graph(conn):
+    """
+    一次采样：扁平查询当前所有的锁等待边以及持锁事务对应的session
+    :rtype: LockWaitGraph
+    """
+    graph = LockWaitGraph()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""select dlw.trx_id, dlw.current_holding_trx_id, ctx.session_id
+from information_schema.data_lock_waits dlw
+         left join information_schema.cluster_tidb_trx ctx on dlw.current_holding_trx_id = ctx.id
+where dlw.current_holding_trx_id is not null""")
+        for waiting_trx_id, holding_trx_id, holding_session_id in cursor:
+            graph.add_wait(waiting_trx_id, holding_trx_id, holding_session_id)
+    finally:
+        cursor.close()
+    return graph
+
+
+def get_lock_source_change(pool, sample_count=LOCK_SAMPLE_COUNT, interval=LOCK_SAMPLE_INTERVAL):
+    """
+    多次采样锁等待图，统计每个锁源头session在各次采样中出现的次数，判断锁源头是否一直不变
+    每次采样从连接池获取连接，采样后立即归还，等待期间不占用连接
+    :param pool: 数据库连接池
+    :type pool: dbutils.pooled_db.PooledDB
+    :param sample_count: 采样次数
+    :type sample_count: int
+    :param interval: 采样间隔，单位：秒
+    :type interval: float
     :rtype: List[LockSourceChange]
     """
+    sources = {}  # key:session_id，value:LockSourceChange
+    for sample in range(sample_count):
+        if sample > 0:
+            time.sleep(interval)
+        conn = pool.connection()
+        try:
+            graph = _sample_lock_wait_graph(conn)
+        finally:
+            conn.close()
+        # 有环时环上没有源头，环上的事务都认为是源头
+        source_trx_ids = [(trx_id, 0) for trx_id in graph.roots()]
+        source_trx_ids += [(trx_id, 1) for cycle in graph.cycles() for trx_id in cycle]
+        hit_sessions = set()
+        for trx_id, in_cycle in source_trx_ids:
+            session_id = graph.sessions.get(trx_id)
+            source = sources.get(session_id)
+            if source is None:
+                source = sources[session_id] = LockSourceChange()
+                source.source_session_id = session_id
+            source.source_trx_id = trx_id
+            source.in_cycle = max(source.in_cycle, in_cycle)
+            source.max_blocked_count = max(source.max_blocked_count, graph.blocked_count(trx_id))
+            # 同一个session在一次采样中只计一次
+            if session_id not in hit_sessions:
+                hit_sessions.add(session_id)
+                source.hit_count += 1
     lock_source_changes: List[LockSourceChange] = []
-    cursor = conn.cursor()
-    cursor.execute("""create temporary table if not exists lock_source_check(source_session_id bigint,cycle int);""")
-    cursor.execute("""insert into lock_source_check(source_session_id,cycle) 
-WITH RECURSIVE lock_chain AS (
-    -- 基础查询：从当前锁等待中获取直接锁关系，并将锁源头的级别标记为 0
-    SELECT trx_id AS waiting_trx_id,
-        current_holding_trx_id AS holding_trx_id,
-        0 AS level
-    FROM information_schema.data_lock_waits
-    WHERE current_holding_trx_id is not null and current_holding_trx_id not in (select distinct trx_id from information_schema.data_lock_waits)
-    UNION ALL
-    -- 递归查询：将上一层持锁事务作为下一层等待事务，级别递增
-    SELECT lc.waiting_trx_id,
-        dlw.current_holding_trx_id AS holding_trx_id,
-        lc.level + 1 AS level
-    FROM lock_chain lc
-        JOIN information_schema.data_lock_waits dlw ON lc.holding_trx_id = dlw.trx_id
-)
-SELECT distinct ctx.session_id,1
-FROM lock_chain lc
-    left join information_schema.cluster_tidb_trx ctx on lc.holding_trx_id = ctx.id
-where lc.level = 0;""")
-    cursor.execute("""select sleep(5);""")
-    cursor.execute("""insert into lock_source_check(source_session_id,cycle) 
-WITH RECURSIVE lock_chain AS (
-    -- 基础查询：从当前锁等待中获取直接锁关系，并将锁源头的级别标记为 0
-    SELECT trx_id AS waiting_trx_id,
-        current_holding_trx_id AS holding_trx_id,
-        0 AS level
-    FROM information_schema.data_lock_waits
-    WHERE current_holding_trx_id is not null and current_holding_trx_id not in (select distinct trx_id from information_schema.data_lock_waits)
-    UNION ALL
-    -- 递归查询：将上一层持锁事务作为下一层等待事务，级别递增
-    SELECT lc.waiting_trx_id,
-        dlw.current_holding_trx_id AS holding_trx_id,
-        lc.level + 1 AS level
-    FROM lock_chain lc
-        JOIN information_schema.data_lock_waits dlw ON lc.holding_trx_id = dlw.trx_id
-)
-SELECT distinct ctx.session_id,2
-FROM lock_chain lc
-    left join information_schema.cluster_tidb_trx ctx on lc.holding_trx_id = ctx.id
-where lc.level = 0;""")
-    cursor.execute("""select sleep(5);""")
-    cursor.execute("""insert into lock_source_check(source_session_id,cycle) 
-WITH RECURSIVE lock_chain AS (
-    -- 基础查询：从当前锁等待中获取直接锁关系，并将锁源头的级别标记为 0
-    SELECT trx_id AS waiting_trx_id,
-        current_holding_trx_id AS holding_trx_id,
-        0 AS level
-    FROM information_schema.data_lock_waits
-    WHERE current_holding_trx_id is not null and current_holding_trx_id not in (select distinct trx_id from information_schema.data_lock_waits)
-    UNION ALL
-    -- 递归查询：将上一层持锁事务作为下一层等待事务，级别递增
-    SELECT lc.waiting_trx_id,
-        dlw.current_holding_trx_id AS holding_trx_id,
-        lc.level + 1 AS level
-    FROM lock_chain lc
-        JOIN information_schema.data_lock_waits dlw ON lc.holding_trx_id = dlw.trx_id
-)
-SELECT distinct ctx.session_id,3
-FROM lock_chain lc
-    left join information_schema.cluster_tidb_trx ctx on lc.holding_trx_id = ctx.id
-where lc.level = 0;""")
-    # 开始查询结果
-    sql_text = """SELECT 
-    source_session_id,
-    -- 出现的次数，比如cycle1表示在第一个周期内该session_source_id出现的次数（在不重复的情况下为1次）
-    SUM(CASE WHEN cycle = 1 THEN 1 ELSE 0 END) AS cycle1,
-    SUM(CASE WHEN cycle = 2 THEN 1 ELSE 0 END) AS cycle2,
-    SUM(CASE WHEN cycle = 3 THEN 1 ELSE 0 END) AS cycle3,
-    CASE
-    WHEN SUM(CASE WHEN cycle = 1 THEN 1 ELSE 0 END) > 0 AND
-         SUM(CASE WHEN cycle = 2 THEN 1 ELSE 0 END) > 0 AND
-         SUM(CASE WHEN cycle = 3 THEN 1 ELSE 0 END) > 0
-        THEN '锁源头不变'
-    ELSE '锁源头发生变化'
-    END                                    AS status
-FROM lock_source_check
-GROUP BY source_session_id
-ORDER BY source_session_id;"""
-    cursor.execute(sql_text)
-    for row in cursor:
-        lock_source_change = LockSourceChange()
-        lock_source_change.source_session_id = row[0]
-        lock_source_change.cycle1 = row[1]
-        lock_source_change.cycle2 = row[2]
-        lock_source_change.cycle3 = row[3]
-        lock_source_change.status = row[4]
-        lock_source_changes.append(lock_source_change)
-    cursor.execute("""drop temporary table if exists lock_source_check;""")
-    cursor.close()
+    for session_id in sorted(sources, key=lambda session: (session is None, session)):
+        source = sources[session_id]
+        source.sample_count = sample_count
+        source.persistence = round(source.hit_count / sample_count, 2) if sample_count else 0.0
+        source.status = "锁源头不变" if source.hit_count == sample_count else "锁源头发生变化"
+        lock_source_changes.append(source)
     return lock_source_changes
 
 # 当前活动连接数信息
@@ -1702,6 +2058,14 @@ ORDER BY source_session_id;"""
 #       from result) as t;
 
 class ActiveConnectionInfo(BaseTable):
+    __slots__ = (
+        "instance", "digest", "active_count", "active_avg_time_s", "active_total_time_s", "active_total_mem_mb",
+        "active_total_disk_mb", "exec_count", "qps", "plan_digest", "avg_latency_s", "avg_processed_keys",
+        "avg_total_keys", "avg_result_rows", "avg_scan_keys_per_row", "query_sample_text",
+        "query_sample_text_len200", "first_seen", "last_seen", "active_total_factor", "active_total_factor_percent",
+        "expensive_sql", "user_access", "ip_access", "session_id_list", "id_list_kill"
+    )
+
     def __init__(self):
         self.instance = ""
         self.digest = ""
@@ -1904,6 +2268,8 @@ from (select *,
 #         and time = now()) b
 # where a.ip = b.ip;
 class CpuUsage(BaseTable):
+    __slots__ = ("time", "hostname", "ip", "types", "cpu_used_percent")
+
     def __init__(self):
         self.time = datetime.now()
         self.hostname = ""
@@ -1912,32 +2278,36 @@ class CpuUsage(BaseTable):
         self.cpu_used_percent = 0.0
         super().__init__()
 
-def get_cpu_usage(conn):
-    sql_text = """select b.time, a.hostname, a.ip, a.types, b.cpu_used_percent
-from (select group_concat(type)                as types,
-             substring_index(instance, ':', 1) as ip,
-             value                             as hostname
-      from INFORMATION_SCHEMA.cluster_systeminfo
-      where name = 'kernel.hostname'
-      group by ip,
-               hostname) a,
-     (select time,
-             substring_index(instance, ':', 1) as ip,
-             round((100 - value), 2)           as cpu_used_percent
-      from METRICS_SCHEMA.node_cpu_usage
-      where mode = 'idle'
-        and time = now()) b
-where a.ip = b.ip;"""
+def get_cpu_usage(conn, topology):
+    """
+    获取各主机当前的CPU使用率，主机名和节点类型从主机拓扑中关联
+    :param conn: 数据库连接
+    :type conn: pymysql.connections.Connection
+    :param topology: 主机拓扑
+    :type topology: pkg.topology.Topology
+    :rtype: List[CpuUsage]
+    """
+    sql_text = """select time,
+       substring_index(instance, ':', 1) as ip,
+       round((100 - value), 2)           as cpu_used_percent
+from METRICS_SCHEMA.node_cpu_usage
+where mode = 'idle'
+  and time = now();"""
     cpu_usages: List[CpuUsage] = []
+    topology.load(conn)
     cursor = conn.cursor()
     cursor.execute(sql_text)
     for row in cursor:
+        host = topology.hosts.get(row[1])
+        # 和原来的内连接一致，没有主机名的ip不输出
+        if host is None or not host.hostname:
+            continue
         cpu_usage = CpuUsage()
         cpu_usage.time = row[0]
-        cpu_usage.hostname = row[1]
-        cpu_usage.ip = row[2]
-        cpu_usage.types = row[3]
-        cpu_usage.cpu_used_percent = row[4]
+        cpu_usage.hostname = host.hostname
+        cpu_usage.ip = row[1]
+        cpu_usage.types = host.types
+        cpu_usage.cpu_used_percent = row[2]
         cpu_usages.append(cpu_usage)
     cursor.close()
     return cpu_usages
@@ -2058,6 +2428,12 @@ where a.ip = b.ip;"""
 # order by a.instance, b.mount_point, a.time_group desc;
 
 class IoResponseTime(BaseTable):
+    __slots__ = (
+        "time", "instance", "hostname", "types_on_host", "device", "mapper_device", "mount_point", "iops",
+        "io_util", "io_size_kb", "read_latency_ms", "write_latency_ms", "disk_read_bytes_mb", "disk_write_bytes_mb",
+        "cpu_used"
+    )
+
     def __init__(self):
         self.time = datetime.now()
         self.instance = ""
@@ -2076,143 +2452,6 @@ class IoResponseTime(BaseTable):
         self.cpu_used = 0.0
         super().__init__()
 
-def get_io_response_time(conn):
-    sql_text = """with node_hostname_map as (select group_concat(type)                as types,
-                                  substring_index(instance, ':', 1) as ip,
-                                  value                             as hostname
-                           from INFORMATION_SCHEMA.cluster_systeminfo
-                           where name = 'kernel.hostname'
-                           group by ip, hostname),
-     device_disk_info as (select substring_index(instance, ':', 1) as ip,
-                                 device_name,
-                                 value
-                          from INFORMATION_SCHEMA.CLUSTER_HARDWARE
-                          where DEVICE_TYPE = 'disk'
-                            and name = 'path'
-                          group by ip, device_name, value),
-     device_mapping_info as (select a.ip,
-                                    a.device_name as dm_device,
-                                    a.value       as mount_point,
-                                    b.device_name as mapper_device
-                             from device_disk_info a
-                                      join device_disk_info b
-                                           on a.ip = b.ip and a.VALUE = b.VALUE and a.DEVICE_NAME like 'dm-%'
-                                               and b.DEVICE_NAME like '/dev/mapper/%'
-                             order by a.ip),
-     aggregated_iops as (select date_format(time, '%Y-%m-%d %H:%i') as time_group,
-                                instance,
-                                device,
-                                max(value)                          as value
-                         from METRICS_SCHEMA.node_disk_iops
-                         where time between now() - interval 60 minute and now()
-                         group by time_group, instance, device),
-     aggregated_data_with_host as (select a.time_group,
-                                          a.instance,
-                                          h.hostname,
-                                          h.types as types_on_host,
-                                          a.device,
-                                          a.value
-                                   from aggregated_iops a
-                                            left join node_hostname_map h on substring_index(a.instance, ':', 1) = h.ip),
-     aggregated_latency as (select date_format(time, '%Y-%m-%d %H:%i') as time_group,
-                                   instance,
-                                   device,
-                                   max(value)                          as value
-                            from METRICS_SCHEMA.node_disk_read_latency
-                            where time between now() - interval 60 minute and now()
-                            group by time_group, instance, device),
-     aggregated_write_latency as (select date_format(time, '%Y-%m-%d %H:%i') as time_group,
-                                         instance,
-                                         device,
-                                         max(value)                          as value
-                                  from METRICS_SCHEMA.node_disk_write_latency
-                                  where time between now() - interval 60 minute and now()
-                                  group by time_group, instance, device),
-     aggregated_io_util as (select date_format(time, '%Y-%m-%d %H:%i') as time_group,
-                                   instance,
-                                   device,
-                                   max(value)                          as value
-                            from METRICS_SCHEMA.node_disk_io_util
-                            where time between now() - interval 60 minute and now()
-                            group by time_group, instance, device),
-     aggregated_read_bytes as (select date_format(time, '%Y-%m-%d %H:%i') as time_group,
-                                      instance,
-                                      device,
-                                      max(value)                          as value
-                               from METRICS_SCHEMA.tikv_disk_read_bytes
-                               where time between now() - interval 60 minute and now()
-                               group by time_group, instance, device),
-     aggregated_write_bytes as (select date_format(time, '%Y-%m-%d %H:%i') as time_group,
-                                       instance,
-                                       device,
-                                       max(value)                          as value
-                                from METRICS_SCHEMA.tikv_disk_write_bytes
-                                where time between now() - interval 60 minute and now()
-                                group by time_group, instance, device),
-     aggregated_cpu_usage as (select date_format(time, '%Y-%m-%d %H:%i') as time_group,
-                                     instance,
-                                     max(value)                          as value,
-                                     mode
-                              from METRICS_SCHEMA.node_cpu_usage
-                              where time between now() - interval 60 minute and now()
-                              group by time_group, instance, mode)
-
-select /*+ MAX_EXECUTION_TIME(10000) MEMORY_QUOTA(1024 MB) */
-    a.time_group                                              as time,
-    a.instance,
-    a.hostname,
-    a.types_on_host,
-    a.device,
-    b.mapper_device,
-    b.mount_point,
-    round(a.value, 2)                                         as iops,
-    round(c.value, 2)                                         as io_util,
-    round((d.value + e.value) / 1024 / nullif(a.value, 0), 0) as io_size_kb,
-    round(f.value * 1000, 2)                                  as read_latency_ms,
-    round(g.value * 1000, 2)                                  as write_latency_ms,
-    round(d.value / 1024 / 1024, 2)                           as disk_read_bytes_mb,
-    round(e.value / 1024 / 1024, 2)                           as disk_write_bytes_mb,
-    round((100 - h.value) / 100, 2)                           as cpu_used
-from aggregated_data_with_host a
-         left join device_mapping_info b on substring_index(a.instance, ':', 1) = b.ip and a.device = b.dm_device
-         left join aggregated_io_util c
-                   on a.time_group = c.time_group and a.instance = c.instance and a.device = c.device
-         left join aggregated_read_bytes d
-                   on a.time_group = d.time_group and a.instance = d.instance and a.device = d.device
-         left join aggregated_write_bytes e
-                   on a.time_group = e.time_group and a.instance = e.instance and a.device = e.device
-         left join aggregated_latency f
-                   on a.time_group = f.time_group and a.instance = f.instance and a.device = f.device
-         left join aggregated_write_latency g
-                   on a.time_group = g.time_group and a.instance = g.instance and a.device = g.device
-         left join aggregated_cpu_usage h on a.instance = h.instance and a.time_group = h.time_group
-where h.mode = 'idle'
-  and a.device like 'dm-%'
-  and b.mount_point like '/%'
-order by a.instance, b.mount_point, a.time_group desc;"""
-    io_response_times: List[IoResponseTime] = []
-    cursor = conn.cursor()
-    cursor.execute(sql_text)
-    for row in cursor:
-        io_response_time = IoResponseTime()
-        io_response_time.time = row[0]
-        io_response_time.instance = row[1]
-        io_response_time.hostname = row[2]
-        io_response_time.types_on_host = row[3]
-        io_response_time.device = row[4]
-        io_response_time.mapper_device = row[5]
-        io_response_time.mount_point = row[6]
-        io_response_time.iops = row[7]
-        io_response_time.io_util = row[8]
-        io_response_time.io_size_kb = row[9]
-        io_response_time.read_latency_ms = row[10]
-        io_response_time.write_latency_ms = row[11]
-        io_response_time.disk_read_bytes_mb = row[12]
-        io_response_time.disk_write_bytes_mb = row[13]
-        io_response_time.cpu_used = row[14]
-        io_response_times.append(io_response_time)
-    cursor.close()
-    return io_response_times
 # 查看数据库最近1小时的QPS情况
 # select time,
 #        round(sum(value), 2) as qps
@@ -2222,30 +2461,13 @@ order by a.instance, b.mount_point, a.time_group desc;"""
 # group by time
 # order by time;
 class Qps(BaseTable):
+    __slots__ = ("time", "qps")
+
     def __init__(self):
         self.time = datetime.now()
         self.qps = 0.0
         super().__init__()
 
-def get_qps(conn):
-    sql_text = """select time,
-       round(sum(value), 2) as qps
-from METRICS_SCHEMA.tidb_qps
-where type in ('StmtSendLongData', 'Query', 'StmtExecute', 'StmtPrepare', 'StmtFetch')
-  and time between now() - interval 60 minute and now()
-group by time
-order by time;"""
-    qps: List[Qps] = []
-    cursor = conn.cursor()
-    cursor.execute(sql_text)
-    for row in cursor:
-        qps_info = Qps()
-        qps_info.time = row[0]
-        qps_info.qps = row[1]
-        qps.append(qps_info)
-    cursor.close()
-    return qps
-
 # 查看语句的平均响应时间
 # select instance, time, round(1000 * avg(value), 2) as avg_response_time_ms
 # from METRICS_SCHEMA.tidb_query_duration
@@ -2254,31 +2476,14 @@ order by time;"""
 # group by time, instance
 # order by instance, time;
 class AvgResponseTime(BaseTable):
+    __slots__ = ("instance", "time", "avg_response_time_ms")
+
     def __init__(self):
         self.instance = ""
         self.time = datetime.now()
         self.avg_response_time_ms = 0.0
         super().__init__()
 
-def get_avg_response_time(conn):
-    sql_text = """select instance, time, round(1000 * avg(value), 2) as avg_response_time_ms
-from METRICS_SCHEMA.tidb_query_duration
-where quantile = 0.5
-  and time between now() - interval 60 minute and now()
-group by time, instance
-order by instance, time;"""
-    avg_response_times: List[AvgResponseTime] = []
-    cursor = conn.cursor()
-    cursor.execute(sql_text)
-    for row in cursor:
-        avg_response_time = AvgResponseTime()
-        avg_response_time.instance = row[0]
-        avg_response_time.time = row[1]
-        avg_response_time.avg_response_time_ms = row[2]
-        avg_response_times.append(avg_response_time)
-    cursor.close()
-    return avg_response_times
-
 # 查看连接数使用率情况
 # select type,
 #        hostname,
@@ -2315,6 +2520,10 @@ order by instance, time;"""
 #                           where `key` in ('max-server-connections', 'instance.max_connections')) c
 #                          on b.INSTANCE = c.INSTANCE and c.nbr = 1) a;
 class ConnectionUsage(BaseTable):
+    __slots__ = (
+        "type", "hostname", "instance", "connection_count", "configured_max_counnection_count", "connection_ratio"
+    )
+
     def __init__(self):
         self.type = ""
         self.hostname = ""
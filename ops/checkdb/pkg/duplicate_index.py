@@ -3,6 +3,7 @@
 1. 顺序相同的情况下，称为一定重复索引，一个索引被另一个索引的最左前缀覆盖，例如：a,b,c和a,b,c,d
 2. 顺序不同的情况下，称为疑似重复索引，一个索引被另一个索引的最左前缀覆盖，例如：a,b,c和b,a,c,d
 """
+from bisect import bisect_right
 from typing import List
 import pymysql
 
@@ -17,6 +18,7 @@ class Index:
     定义索引类
     该类包含索引的状态、表结构、表名、索引名、索引列
     """
+    __slots__ = ("state", "table_schema", "table_name", "index_name", "columns", "covered_by")
 
     def __init__(self):
         self.state = CONST_UNMARKED
@@ -45,8 +47,7 @@ class Index:
             self.covered_by = index
             return True
         # 判断当前索引是否疑似被另一个索引的最左前缀覆盖
-        if len(self.columns) <= len(index.columns) and sorted(list(set(self.columns))) == sorted(
-                list(set(index.columns[:len(self.columns)]))):
+        if len(self.columns) <= len(index.columns) and set(self.columns) == set(index.columns[:len(self.columns)]):
             self.state = CONST_SUSPECTED_DUPLICATE_INDEX
             self.covered_by = index
             return True
@@ -100,52 +101,104 @@ class TableIndex:
     def analyze_indexes(self):
         """
         分析表上的索引，标记重复索引
+        索引按字段个数升序排列后，只有排在后面的索引才能覆盖前面的索引（字段完全相同时后面的覆盖前面的）；
+        一定重复索引通过字段前缀树查找，疑似重复索引通过排序后的前缀字段查找，不再两两比较
         """
-        for cursor in range(len(self.indexes)):
-            for next_cursor in range(cursor + 1, len(self.indexes)):
-                if self.indexes[cursor].is_covered_by(self.indexes[next_cursor]):
-                    break
+        self.indexes.sort(key=lambda index: len(index.columns))
+        trie = PrefixTrie()
+        sorted_prefixes = {}  # key:排序后的前缀字段，value:包含该前缀的索引位置，升序
+        for position, index in enumerate(self.indexes):
+            trie.insert(index.columns, position)
+            for length in range(1, len(index.columns) + 1):
+                sorted_prefixes.setdefault(tuple(sorted(index.columns[:length])), []).append(position)
+        for position, index in enumerate(self.indexes):
+            covered_by = trie.find_after(index.columns, position)
+            if covered_by is not None:
+                index.state = CONST_DUPLICATE_INDEX
+                index.covered_by = self.indexes[covered_by]
+                continue
+            covered_by = _first_after(sorted_prefixes.get(tuple(sorted(index.columns)), []), position)
+            if covered_by is not None:
+                index.state = CONST_SUSPECTED_DUPLICATE_INDEX
+                index.covered_by = self.indexes[covered_by]
+
+
+def _first_after(positions, position):
+    """
+    在升序的positions中查找第一个大于position的值
+    """
+    i = bisect_right(positions, position)
+    return positions[i] if i < len(positions) else None
+
+
+class PrefixTrie:
+    """
+    索引字段前缀树，每个节点记录字段前缀经过该节点的索引位置
+    """
+    __slots__ = ("children", "positions")
+
+    def __init__(self):
+        self.children = {}
+        self.positions = []  # 插入时位置递增，保持升序
+
+    def insert(self, columns, position):
+        node = self
+        for column in columns:
+            node = node.children.setdefault(column, PrefixTrie())
+            node.positions.append(position)
+
+    def find_after(self, columns, position):
+        """
+        查找以columns为最左前缀、且位置在position之后的第一个索引
+        :rtype: int
+        """
+        node = self
+        for column in columns:
+            node = node.children.get(column)
+            if node is None:
+                return None
+        return _first_after(node.positions, position)
 
 
 # 获取索引信息
 def get_tableindexes(connect):
     """
-    获取表上的索引信息
+    获取表上的索引信息，按表逐个返回，同一时间只有一张表的索引在内存中
     :param connect: 数据库连接
     :type connect: pymysql.connections.Connection
-    :rtype: List[TableIndex]
+    :rtype: Iterator[TableIndex]
     """
-    # 按照column_name分组聚合并按照seq_in_index升序组成字段列表，然后按照table_schema,table_name,len(column_names)升序，这样一来同一个表上的索引字段个数最少的排在前面，向下匹配来判断冗余索引即可
+    # 按照column_name分组聚合并按照seq_in_index升序组成字段列表，按照table_schema,table_name排序，同一张表的索引连续返回
     get_index_sql = """select table_schema,table_name,key_name,group_concat(column_name order by seq_in_index 
     separator ',') as column_names from information_schema.tidb_indexes  where table_schema not in ('mysql',
     'INFORMATION_SCHEMA','PERFORMANCE_SCHEMA') group by table_schema,table_name,key_name order by table_schema,
-    table_name,length(column_names) asc"""
-
-    # 设置游标返回的数据类型为字典
-    cursor = connect.cursor(cursor=pymysql.cursors.DictCursor)
-    cursor.execute(get_index_sql)
-    table_indexes: List[TableIndex] = []
-    last_table = []
-    for each_row in cursor:
-        table_name = each_row["table_name"]
-        table_schema = each_row["table_schema"]
-        key_name = each_row["key_name"]
-        column_names = each_row["column_names"].split(",")
-        # 初始化索引类
-        index = Index()
-        index.table_schema = table_schema
-        index.table_name = table_name
-        index.index_name = key_name
-        index.columns = column_names
-        if last_table != [table_schema, table_name]:
-            table_index = TableIndex()
-            table_indexes.append(table_index)
-            table_index.table_schema = table_schema
-            table_index.table_name = table_name
-        table_index.indexes.append(index)
-        last_table = [table_schema, table_name]
-    cursor.close()
-    return table_indexes
+    table_name"""
+
+    # 使用服务端游标，逐行读取
+    cursor = connect.cursor(cursor=pymysql.cursors.SSDictCursor)
+    try:
+        cursor.execute(get_index_sql)
+        table_index = None
+        for each_row in cursor:
+            table_name = each_row["table_name"]
+            table_schema = each_row["table_schema"]
+            # 初始化索引类
+            index = Index()
+            index.table_schema = table_schema
+            index.table_name = table_name
+            index.index_name = each_row["key_name"]
+            index.columns = each_row["column_names"].split(",")
+            if table_index is None or (table_index.table_schema, table_index.table_name) != (table_schema, table_name):
+                if table_index is not None:
+                    yield table_index
+                table_index = TableIndex()
+                table_index.table_schema = table_schema
+                table_index.table_name = table_name
+            table_index.indexes.append(index)
+        if table_index is not None:
+            yield table_index
+    finally:
+        cursor.close()
 
 
 if __name__ == "__main__":
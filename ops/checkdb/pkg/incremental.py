@@ -0,0 +1,116 @@
+"""
+增量采集
+每个集群的sqlite3文件中保存水位线，定时任务再次采集时只获取水位线之后的数据并追加到已有的表中，
+而不是删除文件后重新拉取整个时间窗口
+"""
+import logging
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+
+WATERMARK_TABLE = "tidb_watermark"
+# 时间类水位线的格式，保留微秒
+WATERMARK_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def create_watermark_table(conn):
+    """
+    :param conn: sqlite3连接
+    :type conn: sqlite3.Connection
+    """
+    conn.execute(f"create table if not exists {WATERMARK_TABLE} (name varchar(512) primary key, value varchar(512), update_time text)")
+
+
+def load_watermarks(db_path):
+    """
+    读取sqlite3文件中的所有水位线，文件或表不存在时返回空字典
+    :param db_path: sqlite3文件路径
+    :type db_path: str
+    :return: key:水位线名称，value:水位线
+    :rtype: dict
+    """
+    if not Path(db_path).exists():
+        return {}
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        return dict(conn.execute(f"select name, value from {WATERMARK_TABLE} where value is not null").fetchall())
+    except sqlite3.DatabaseError as e:
+        logging.warning(f"读取{db_path}水位线失败，将全量采集: {e}")
+        return {}
+    finally:
+        conn.close()
+
+
+def parse_watermark_time(value):
+    """
+    解析时间类水位线，从表中取出的时间在微秒为0时不带小数部分
+    :type value: str
+    :rtype: datetime
+    """
+    try:
+        return datetime.strptime(value, WATERMARK_TIME_FORMAT)
+    except ValueError:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+
+def save_watermark(conn, name, value):
+    conn.execute(f"insert or replace into {WATERMARK_TABLE} (name, value, update_time) values (?, ?, datetime('now', 'localtime'))",
+                 (name, value))
+
+
+def table_exists(conn, table_name):
+    return conn.execute("select 1 from sqlite_master where type='table' and name=?", (table_name,)).fetchone() is not None
+
+
+class IncrementalTarget:
+    """
+    增量采集任务对应的表和水位线
+    数据追加写入table_name，任务完成后在同一个事务中更新水位线；
+    上次采集如果中途失败，水位线不会前移，开始写入前先删除column大于水位线的残留数据，避免重复
+    """
+
+    def __init__(self, name, table_name, column, last_value=None, next_value=None, value_column=None):
+        """
+        :param name: 水位线名称
+        :type name: str
+        :param table_name: 追加写入的sqlite3表名
+        :type table_name: str
+        :param column: 判断数据是否在水位线之后的时间字段
+        :type column: str
+        :param last_value: 上次采集的水位线，None表示第一次采集
+        :type last_value: str
+        :param next_value: 本次采集完成后的水位线，None表示取表中value_column的最大值
+        :type next_value: str
+        :param value_column: 计算水位线的时间字段，None表示使用column
+        :type value_column: str
+        """
+        self.name = name
+        self.table_name = table_name
+        self.column = column
+        self.last_value = last_value
+        self.next_value = next_value
+        self.value_column = value_column or column
+
+    def on_start(self, conn):
+        """
+        写入第一批数据前执行，清理上次失败残留的数据
+        """
+        if self.last_value and table_exists(conn, self.table_name):
+            # 时间字段可能带微秒也可能不带，用julianday比较而不是字符串比较
+            conn.execute(f"delete from {self.table_name} where julianday({self.column}) > julianday(?)", (self.last_value,))
+
+    def on_done(self, conn):
+        """
+        任务数据全部写入后执行，更新水位线，和数据在同一个事务中提交
+        """
+        value = self.next_value
+        if value is None and table_exists(conn, self.table_name):
+            value = conn.execute(f"select max({self.value_column}) from {self.table_name}").fetchone()[0]
+            # 本次没有新数据时表中的最大值可能早于上次的水位线，水位线不后退
+            if value is not None and self.last_value and \
+                    conn.execute("select julianday(?) < julianday(?)", (value, self.last_value)).fetchone()[0]:
+                value = self.last_value
+        if value is None:
+            return
+        save_watermark(conn, self.name, value)
+        logging.debug(f"Update watermark[{self.name}]: {self.last_value} -> {value}")
@@ -0,0 +1,392 @@
+"""
+按时间窗口采集METRICS_SCHEMA中的监控指标
+METRICS_SCHEMA的每个查询都会在TiDB上转换为一次Prometheus的range query，这里：
+1. 时间窗口取自--since，按窗口大小选择step，窗口越长step越大，每条序列的点数基本固定；
+2. 窗口按step对齐后切分为固定大小的时间块，所有指标的所有时间块从连接池并发查询；
+3. 已经完整的时间块按(指标, step, 块开始时间)缓存在sqlite3文件中，下次采集只查询缓存中没有的时间块；
+4. 时间窗口取自TiDB服务端的当前时间，查询时使用UTC的epoch秒，不受采集机时钟和时区的影响
+"""
+import calendar
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List
+
+from .dbinfo import AvgResponseTime, BaseTable, IoResponseTime, MemoryUsageDetail, Qps
+from .sqlite3_writer import BulkWriter
+
+CACHE_TABLE = "tidb_metric_cache"
+# 可选的step（秒），按窗口大小选择不小于window/METRIC_TARGET_POINTS的最小值
+METRIC_STEPS = [15, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 21600, 86400]
+METRIC_TARGET_POINTS = 720
+# 每个时间块包含的step数，也是单次查询返回的每条序列的最大点数
+METRIC_BLOCK_POINTS = 240
+# tidb_metric_query_step和tidb_metric_query_range_duration的默认值，查询结束后恢复，连接归还后会被其它任务复用
+DEFAULT_METRIC_QUERY_STEP = 60
+DEFAULT_METRIC_QUERY_RANGE_DURATION = 60
+
+
+class MetricCacheBlock(BaseTable):
+    __slots__ = ("metric", "step", "block_start", "block_end", "payload")
+    _table_name = CACHE_TABLE
+
+    def __init__(self):
+        self.metric = ""
+        self.step = 0
+        self.block_start = 0
+        self.block_end = 0
+        self.payload = ""  # json，[[epoch秒, [标签值], 值]]
+        super().__init__()
+
+
+class MetricQuery:
+    """
+    METRICS_SCHEMA中一张表的查询，按时间和标签分组聚合
+    """
+
+    def __init__(self, name, table, labels=(), condition="", agg="max", scale=1.0):
+        """
+        :param name: 指标名，也是缓存的key
+        :type name: str
+        :param table: METRICS_SCHEMA中的表名
+        :type table: str
+        :param labels: 分组的标签
+        :type labels: Sequence[str]
+        :param condition: 额外的过滤条件
+        :type condition: str
+        :param agg: 同一个时间点和标签有多个值时的聚合函数
+        :type agg: str
+        :param scale: 结果乘以scale，比如秒转换为毫秒
+        :type scale: float
+        """
+        self.name = name
+        self.table = table
+        self.labels = list(labels)
+        self.condition = condition
+        self.agg = agg
+        self.scale = scale
+
+    @property
+    def sql(self):
+        columns = "".join(f", {label}" for label in self.labels)
+        condition = f" and {self.condition}" if self.condition else ""
+        return (f"select time{columns}, {self.agg}(value) from METRICS_SCHEMA.{self.table} "
+                f"where time between from_unixtime(%s) and from_unixtime(%s){condition} group by time{columns}")
+
+
+QPS = MetricQuery("qps", "tidb_qps", condition="type in ('StmtSendLongData', 'Query', 'StmtExecute', 'StmtPrepare', 'StmtFetch')",
+                  agg="sum")
+QUERY_DURATION = MetricQuery("query_duration_p50", "tidb_query_duration", ["instance"], "quantile = 0.5", "avg", 1000)
+DISK_IOPS = MetricQuery("node_disk_iops", "node_disk_iops", ["instance", "device"])
+DISK_IO_UTIL = MetricQuery("node_disk_io_util", "node_disk_io_util", ["instance", "device"])
+DISK_READ_LATENCY = MetricQuery("node_disk_read_latency", "node_disk_read_latency", ["instance", "device"], scale=1000)
+DISK_WRITE_LATENCY = MetricQuery("node_disk_write_latency", "node_disk_write_latency", ["instance", "device"], scale=1000)
+DISK_READ_BYTES = MetricQuery("tikv_disk_read_bytes", "tikv_disk_read_bytes", ["instance", "device"], scale=1 / 1024 / 1024)
+DISK_WRITE_BYTES = MetricQuery("tikv_disk_write_bytes", "tikv_disk_write_bytes", ["instance", "device"], scale=1 / 1024 / 1024)
+CPU_IDLE = MetricQuery("node_cpu_idle", "node_cpu_usage", ["instance"], "mode = 'idle'")
+MEMORY_USAGE = MetricQuery("node_memory_usage", "node_memory_usage", ["instance"])
+
+
+def choose_step(window_seconds):
+    """
+    :param window_seconds: 时间窗口，单位：秒
+    :type window_seconds: float
+    :return: step，单位：秒
+    :rtype: int
+    """
+    for step in METRIC_STEPS:
+        if step * METRIC_TARGET_POINTS >= window_seconds:
+            return step
+    return METRIC_STEPS[-1]
+
+
+def server_time(pool):
+    """
+    读取TiDB服务端的当前时间
+    :param pool: 数据库连接池
+    :type pool: dbutils.pooled_db.PooledDB
+    :return: epoch秒
+    :rtype: int
+    """
+    conn = pool.connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("select unix_timestamp()")
+        row = cursor.fetchone()
+        cursor.close()
+        if not row:
+            # 回放的录制文件中没有这条SQL时使用本地时间
+            logging.warning("读取TiDB服务端时间失败，使用本地时间")
+            return int(time.time())
+        return int(row[0])
+    finally:
+        conn.close()
+
+
+def load_metric_cache(db_path):
+    """
+    读取sqlite3文件中缓存的时间块，文件或表不存在时返回空字典
+    :param db_path: sqlite3文件路径
+    :type db_path: str
+    :return: key:(指标名, step, 块开始时间)，value:MetricCacheBlock
+    :rtype: dict
+    """
+    if not Path(db_path).exists():
+        return {}
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        cache = {}
+        for metric, step, block_start, block_end, payload in conn.execute(
+                f"select metric, step, block_start, block_end, payload from {CACHE_TABLE}"):
+            block = MetricCacheBlock()
+            block.metric = metric
+            block.step = step
+            block.block_start = block_start
+            block.block_end = block_end
+            block.payload = payload
+            cache[(metric, step, block_start)] = block
+        return cache
+    except sqlite3.DatabaseError as e:
+        logging.warning(f"读取{db_path}监控指标缓存失败，将重新查询: {e}")
+        return {}
+    finally:
+        conn.close()
+
+
+class MetricFetcher:
+    """
+    一次采集中所有指标共用的时间窗口、step和缓存
+    """
+
+    def __init__(self, start, end, cache=None, max_workers=4):
+        """
+        :param start: 窗口开始时间，epoch秒
+        :type start: int
+        :param end: 窗口结束时间，epoch秒，为服务端的当前时间
+        :type end: int
+        :param cache: load_metric_cache的结果
+        :type cache: dict
+        :param max_workers: 并发查询的连接数
+        :type max_workers: int
+        """
+        self.step = choose_step(end - start)
+        # 窗口按step对齐，同一个step下每次采集的时间点相同，时间块才能复用
+        self.start = start // self.step * self.step
+        self.end = end // self.step * self.step
+        self.max_workers = max_workers
+        self.cache = cache or {}
+        self.used = {}  # 本次采集使用和新增的完整时间块，采集结束后写回sqlite3
+        self.lock = threading.Lock()
+        # 最近两个step的数据Prometheus可能还没有抓取完整，包含这段时间的块不缓存
+        self.complete_before = end - 2 * self.step
+
+    def blocks(self):
+        """
+        :return: [(块开始时间, 块结束时间, 是否完整)]，结束时间不包含
+        :rtype: List[tuple]
+        """
+        block_seconds = self.step * METRIC_BLOCK_POINTS
+        result = []
+        block_start = self.start // block_seconds * block_seconds
+        while block_start <= self.end:
+            block_end = block_start + block_seconds
+            full = block_start >= self.start and block_end <= self.end + self.step and block_end <= self.complete_before
+            result.append((max(block_start, self.start), min(block_end, self.end + self.step), full))
+            block_start = block_end
+        return result
+
+    def _query(self, pool, query, block_start, block_end):
+        conn = pool.connection()
+        cursor = None
+        time_zone = None
+        try:
+            cursor = conn.cursor()
+            # 会话时区设置为UTC，查询条件和返回的时间都是UTC，和epoch秒直接换算
+            cursor.execute("select @@session.time_zone")
+            row = cursor.fetchone()
+            time_zone = row[0] if row else None
+            cursor.execute("set @@session.time_zone = '+00:00'")
+            cursor.execute(f"set @@tidb_metric_query_step = {self.step}")
+            cursor.execute(f"set @@tidb_metric_query_range_duration = {max(60, self.step)}")
+            cursor.execute(query.sql, (block_start, block_end - self.step))
+            rows = []
+            for row in cursor:
+                value = row[-1]
+                rows.append([calendar.timegm(row[0].timetuple()), [str(label) for label in row[1:-1]],
+                             None if value is None else float(value) * query.scale])
+            return rows
+        finally:
+            try:
+                if cursor is not None:
+                    cursor.execute(f"set @@tidb_metric_query_step = {DEFAULT_METRIC_QUERY_STEP}")
+                    cursor.execute(f"set @@tidb_metric_query_range_duration = {DEFAULT_METRIC_QUERY_RANGE_DURATION}")
+                    if time_zone is not None:
+                        cursor.execute("set @@session.time_zone = %s", (time_zone,))
+                    cursor.close()
+            except Exception as e:
+                logging.warning(f"恢复tidb_metric_query_step和time_zone失败: {e}")
+            conn.close()
+
+    def _fetch_block(self, pool, query, block_start, block_end, full):
+        key = (query.name, self.step, block_start)
+        block = self.cache.get(key) if full else None
+        if block is None:
+            rows = self._query(pool, query, block_start, block_end)
+            if not full:
+                return rows
+            block = MetricCacheBlock()
+            block.metric = query.name
+            block.step = self.step
+            block.block_start = block_start
+            block.block_end = block_end
+            block.payload = json.dumps(rows)
+        with self.lock:
+            self.used[key] = block
+        return json.loads(block.payload)
+
+    def fetch(self, pool, queries):
+        """
+        并发查询多个指标的所有时间块
+        :param pool: 数据库连接池
+        :type pool: dbutils.pooled_db.PooledDB
+        :type queries: List[MetricQuery]
+        :return: key:指标名，value:[(epoch秒, 标签值元组, 值)]，按时间排序
+        :rtype: Dict[str, List[tuple]]
+        """
+        blocks = self.blocks()
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers), thread_name_prefix="metric") as executor:
+            futures = {query.name: [executor.submit(self._fetch_block, pool, query, *block) for block in blocks]
+                       for query in queries}
+            results = {}
+            for name, block_futures in futures.items():
+                rows = [(ts, tuple(labels), value) for future in block_futures for ts, labels, value in future.result()]
+                rows.sort(key=lambda row: row[0])
+                results[name] = rows
+        cached = sum(1 for block in blocks if block[2] and (queries[0].name, self.step, block[0]) in self.cache)
+        logging.debug(f"Fetch metrics {[query.name for query in queries]}: step={self.step}s, blocks={len(blocks)}, cached={cached}")
+        return results
+
+    def save(self, db_path):
+        """
+        将本次使用的完整时间块写回sqlite3，不在时间窗口内的旧块随之清除，在写线程关闭后调用
+        :param db_path: sqlite3文件路径
+        :type db_path: str
+        """
+        conn = sqlite3.connect(db_path)
+        try:
+            conn.execute(f"drop table if exists {CACHE_TABLE}")
+            BulkWriter(conn).save(self.used.values())
+            conn.commit()
+        except Exception as e:
+            logging.error(f"Save metric cache failed: {e}")
+        finally:
+            conn.close()
+
+
+def _ip(instance):
+    return instance.split(":")[0]
+
+
+def get_qps(pool, fetcher):
+    """
+    集群QPS
+    :type fetcher: MetricFetcher
+    :rtype: List[Qps]
+    """
+    qps_list: List[Qps] = []
+    for ts, _, value in fetcher.fetch(pool, [QPS])[QPS.name]:
+        qps = Qps()
+        qps.time = datetime.fromtimestamp(ts)
+        qps.qps = None if value is None else round(value, 2)
+        qps_list.append(qps)
+    return qps_list
+
+
+def get_avg_response_time(pool, fetcher):
+    """
+    各tidb实例语句响应时间的中位数
+    :type fetcher: MetricFetcher
+    :rtype: List[AvgResponseTime]
+    """
+    avg_response_times: List[AvgResponseTime] = []
+    for ts, labels, value in fetcher.fetch(pool, [QUERY_DURATION])[QUERY_DURATION.name]:
+        avg_response_time = AvgResponseTime()
+        avg_response_time.instance = labels[0]
+        avg_response_time.time = datetime.fromtimestamp(ts)
+        avg_response_time.avg_response_time_ms = None if value is None else round(value, 2)
+        avg_response_times.append(avg_response_time)
+    return avg_response_times
+
+
+def get_io_response_time(pool, fetcher, topology):
+    """
+    dm设备的磁盘IO和主机CPU，各指标并发查询后按(时间, ip, 设备)在本地关联，设备的挂载点和主机名取自主机拓扑
+    :type fetcher: MetricFetcher
+    :type topology: pkg.topology.Topology
+    :rtype: List[IoResponseTime]
+    """
+    topology.load_from_pool(pool)
+    devices = topology.devices
+    queries = [DISK_IOPS, DISK_IO_UTIL, DISK_READ_LATENCY, DISK_WRITE_LATENCY, DISK_READ_BYTES, DISK_WRITE_BYTES, CPU_IDLE]
+    results = fetcher.fetch(pool, queries)
+    # key:指标名，value:{(时间, ip, 设备): 值}，tikv指标的instance端口和node_exporter不同，按ip关联
+    values = {name: {(ts, _ip(labels[0]), labels[1] if len(labels) > 1 else ""): value for ts, labels, value in rows}
+              for name, rows in results.items()}
+    io_response_times: List[IoResponseTime] = []
+    for ts, labels, iops in results[DISK_IOPS.name]:
+        instance, device = labels
+        ip = _ip(instance)
+        if (ip, device) not in devices:
+            continue
+        key = (ts, ip, device)
+        cpu_idle = values[CPU_IDLE.name].get((ts, ip, ""))
+        read_bytes = values[DISK_READ_BYTES.name].get(key)
+        write_bytes = values[DISK_WRITE_BYTES.name].get(key)
+        io_response_time = IoResponseTime()
+        io_response_time.time = datetime.fromtimestamp(ts)
+        io_response_time.instance = instance
+        host = topology.hosts.get(ip)
+        io_response_time.hostname = host.hostname if host else ""
+        io_response_time.types_on_host = host.types if host else ""
+        io_response_time.device = device
+        io_response_time.mount_point, io_response_time.mapper_device = devices[(ip, device)]
+        io_response_time.iops = round(iops, 2) if iops is not None else None
+        io_response_time.io_util = values[DISK_IO_UTIL.name].get(key)
+        io_response_time.read_latency_ms = values[DISK_READ_LATENCY.name].get(key)
+        io_response_time.write_latency_ms = values[DISK_WRITE_LATENCY.name].get(key)
+        io_response_time.disk_read_bytes_mb = read_bytes
+        io_response_time.disk_write_bytes_mb = write_bytes
+        if iops and read_bytes is not None and write_bytes is not None:
+            io_response_time.io_size_kb = round((read_bytes + write_bytes) * 1024 / iops, 0)
+        else:
+            io_response_time.io_size_kb = None
+        io_response_time.cpu_used = None if cpu_idle is None else round((100 - cpu_idle) / 100, 2)
+        io_response_times.append(io_response_time)
+    return io_response_times
+
+
+def get_memory_detail(pool, fetcher, topology):
+    """
+    各主机的内存使用率，主机名和节点类型取自主机拓扑
+    :type fetcher: MetricFetcher
+    :type topology: pkg.topology.Topology
+    :rtype: List[MemoryUsageDetail]
+    """
+    topology.load_from_pool(pool)
+    memory_infos: List[MemoryUsageDetail] = []
+    for ts, labels, value in fetcher.fetch(pool, [MEMORY_USAGE])[MEMORY_USAGE.name]:
+        host = topology.hosts.get(_ip(labels[0]))
+        if host is None or not host.hostname or not host.types_count:
+            continue
+        memory_info = MemoryUsageDetail()
+        memory_info.time = datetime.fromtimestamp(ts)
+        memory_info.ip_address = host.ip_address
+        memory_info.hostname = host.hostname
+        memory_info.types_count = host.types_count
+        memory_info.used_percent = None if value is None else round(value / 100, 2)
+        memory_infos.append(memory_info)
+    return memory_infos
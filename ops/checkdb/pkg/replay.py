@@ -0,0 +1,333 @@
+"""
+采集的录制和回放
+不能在生产集群上反复调优采集性能，这里提供离线的基准测试：
+1. 录制：collect --record时连接由RecordingConnection创建，按协议包记录每条SQL的原始响应，写入fixture文件（sqlite3）；
+2. 回放：StandInServer是一个本地的MySQL协议服务端，握手后对每条COM_QUERY按SQL查找录制的响应原样返回，
+   结果集的数据行可以重复N倍模拟更大的集群；
+3. checkdb bench在1x/10x/100x等数据规模下对回放服务端执行完整的采集和报表，记录耗时和内存
+协议包的解析使用pymysql.protocol，不依赖真实的集群
+"""
+import logging
+import os
+import re
+import socketserver
+import sqlite3
+import struct
+import threading
+from datetime import datetime
+
+import pymysql
+from pymysql.connections import Connection, MAX_PACKET_LEN, _lenenc_int, _pack_int24
+from pymysql.constants import CLIENT, COMMAND, SERVER_STATUS
+from pymysql.protocol import MysqlPacket
+
+META_TABLE = "replay_meta"
+RESPONSE_TABLE = "replay_response"
+DEFAULT_SERVER_VERSION = "5.7.25-TiDB-replay"
+CHARSET_UTF8MB4_GENERAL_CI = 45
+SERVER_CAPABILITIES = (CLIENT.LONG_PASSWORD | CLIENT.LONG_FLAG | CLIENT.CONNECT_WITH_DB | CLIENT.PROTOCOL_41 |
+                       CLIENT.TRANSACTIONS | CLIENT.SECURE_CONNECTION | CLIENT.MULTI_RESULTS | CLIENT.PLUGIN_AUTH)
+
+# 每次采集都会变化的部分：时间字面量（慢查询、监控指标的时间窗口）和按预算设置的执行时间
+_DATETIME_LITERAL = re.compile(r"'\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(?:\.\d+)?'")
+_MAX_EXECUTION_TIME = re.compile(r"(max_execution_time\s*(?:=|\())\s*\d+", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_sql(sql):
+    """
+    录制和回放时查找响应的key，去掉每次采集都会变化的部分
+    :type sql: bytes|str
+    :rtype: str
+    """
+    if isinstance(sql, bytes):
+        sql = sql.decode("utf8", "surrogateescape")
+    sql = _DATETIME_LITERAL.sub("'?'", sql)
+    sql = _MAX_EXECUTION_TIME.sub(r"\1?", sql)
+    return _WHITESPACE.sub(" ", sql).strip()
+
+
+def pack_packets(packets):
+    """
+    多个协议包打包为一个blob，每个包前面为4字节的长度
+    :type packets: List[bytes]
+    :rtype: bytes
+    """
+    return b"".join(struct.pack("<I", len(packet)) + packet for packet in packets)
+
+
+def unpack_packets(data):
+    packets = []
+    i = 0
+    while i < len(data):
+        length = struct.unpack_from("<I", data, i)[0]
+        packets.append(bytes(data[i + 4:i + 4 + length]))
+        i += 4 + length
+    return packets
+
+
+def error_packet(errno, message):
+    return b"\xff" + struct.pack("<H", errno) + b"#HY000" + str(message).encode("utf8")
+
+
+def ok_packet(status=SERVER_STATUS.SERVER_STATUS_AUTOCOMMIT):
+    return b"\x00" + _lenenc_int(0) + _lenenc_int(0) + struct.pack("<HH", status, 0)
+
+
+def _is_eof(packet):
+    return packet[:1] == b"\xfe" and len(packet) < 9
+
+
+def split_rows(packets):
+    """
+    将一个响应拆分为(结果集头部, 数据行, 结尾)，不是结果集（OK/ERR）时数据行为空
+    头部为列数、列定义和EOF，结尾为数据行之后的EOF/ERR以及后续结果集
+    :type packets: List[bytes]
+    :rtype: tuple
+    """
+    if not packets or packets[0][:1] in (b"\x00", b"\xff", b"\xfb"):
+        return packets, [], []
+    column_count = MysqlPacket(packets[0], "utf8").read_length_encoded_integer()
+    start = 1 + column_count + 1  # 列数、列定义、EOF
+    end = start
+    while end < len(packets) and not _is_eof(packets[end]) and packets[end][:1] != b"\xff":
+        end += 1
+    return packets[:start], packets[start:end], packets[end:]
+
+
+class Recorder:
+    """
+    录制一次采集的所有响应，作为PooledDB的creator使用
+    """
+    threadsafety = 1
+
+    def __init__(self, path, meta=None):
+        """
+        :param path: fixture文件路径
+        :type path: str
+        :param meta: 回放时需要保持一致的采集参数，比如监控指标的时间窗口since
+        :type meta: dict
+        """
+        self.path = path
+        self.meta = dict(meta or {})
+        self.server_version = DEFAULT_SERVER_VERSION
+        self.responses = []  # [(key, sql, packets)]
+        self._lock = threading.Lock()
+
+    def connect(self, *args, **kwargs):
+        return RecordingConnection(*args, recorder=self, **kwargs)
+
+    def add(self, sql, packets):
+        with self._lock:
+            self.responses.append((normalize_sql(sql), sql.decode("utf8", "surrogateescape"), packets))
+
+    def save(self):
+        """
+        写入fixture文件，同一个key的多个响应按录制顺序保存，回放时依次返回
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        conn = sqlite3.connect(self.path)
+        try:
+            conn.execute(f"create table {META_TABLE} (name text primary key, value text)")
+            conn.execute(f"create table {RESPONSE_TABLE} (id integer primary key autoincrement, query_key text, "
+                         f"position int, sql text, packets blob)")
+            positions = {}
+            rows = []
+            for key, sql, packets in self.responses:
+                positions[key] = positions.get(key, -1) + 1
+                rows.append((key, positions[key], sql, pack_packets(packets)))
+            conn.executemany(f"insert into {RESPONSE_TABLE} (query_key, position, sql, packets) values (?, ?, ?, ?)", rows)
+            conn.executemany(f"insert into {META_TABLE} values (?, ?)",
+                             [("server_version", self.server_version),
+                              ("recorded_at", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))] +
+                             [(name, str(value)) for name, value in self.meta.items()])
+            conn.commit()
+        finally:
+            conn.close()
+        logging.info(f"录制了{len(self.responses)}个响应，fixture文件:{self.path}")
+
+
+class RecordingConnection(Connection):
+    """
+    记录每条SQL从服务端读到的所有协议包，下一个命令发出或连接关闭时该SQL的响应结束
+    """
+
+    def __init__(self, *args, recorder=None, **kwargs):
+        self._recorder = recorder
+        self._recording = None  # (sql, [packet])
+        super().__init__(*args, **kwargs)
+        recorder.server_version = self.server_version
+
+    def _flush_recording(self):
+        if self._recording is not None:
+            self._recorder.add(*self._recording)
+            self._recording = None
+
+    def _execute_command(self, command, sql):
+        # 上一个未读完的结果集在这里读完，仍然属于上一条SQL
+        super()._execute_command(command, sql)
+        self._flush_recording()
+        if command == COMMAND.COM_QUERY:
+            self._recording = (sql if isinstance(sql, bytes) else sql.encode(self.encoding), [])
+
+    def _read_packet(self, packet_type=MysqlPacket):
+        try:
+            packet = super()._read_packet(packet_type)
+        except pymysql.err.MySQLError as e:
+            # 错误包在pymysql中直接抛出异常，按错误码和信息还原
+            if self._recording is not None and len(e.args) == 2 and isinstance(e.args[0], int):
+                self._recording[1].append(error_packet(e.args[0], e.args[1]))
+            raise
+        if self._recording is not None:
+            self._recording[1].append(packet.get_all_data())
+        return packet
+
+    def close(self):
+        self._flush_recording()
+        super().close()
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    """
+    回放fixture的本地MySQL协议服务端，只实现采集用到的COM_QUERY、COM_PING、COM_INIT_DB和COM_QUIT
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, fixture, scale=1, host="127.0.0.1", port=0):
+        """
+        :param fixture: 录制的fixture文件
+        :type fixture: str
+        :param scale: 结果集数据行重复的倍数
+        :type scale: int
+        """
+        self.scale = scale
+        self.server_version = DEFAULT_SERVER_VERSION
+        self.meta = {}  # 录制时保存的采集参数
+        self.responses = {}  # key:normalize_sql，value:[(头部, 数据行, 结尾)]
+        self.query_count = 0
+        self.misses = {}  # 没有录制的SQL及次数，返回OK包
+        self._positions = {}
+        self._lock = threading.Lock()
+        self._load(fixture)
+        super().__init__((host, port), _StandInHandler)
+
+    def _load(self, fixture):
+        conn = sqlite3.connect(f"file:{fixture}?mode=ro", uri=True)
+        try:
+            self.meta = dict(conn.execute(f"select name, value from {META_TABLE}"))
+            self.server_version = self.meta.get("server_version", DEFAULT_SERVER_VERSION)
+            for key, packets in conn.execute(f"select query_key, packets from {RESPONSE_TABLE} order by query_key, position"):
+                self.responses.setdefault(key, []).append(split_rows(unpack_packets(packets)))
+        finally:
+            conn.close()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name="stand-in-server", daemon=True)
+        thread.start()
+        logging.info(f"回放服务端已启动，端口:{self.port}，响应数:{sum(len(v) for v in self.responses.values())}，"
+                     f"数据倍数:{self.scale}")
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def response(self, sql):
+        """
+        同一个key的响应按录制顺序轮流返回，比如按时间切片执行的多条慢查询SQL
+        :return: (头部, 数据行, 结尾)
+        :rtype: tuple
+        """
+        key = normalize_sql(sql)
+        with self._lock:
+            self.query_count += 1
+            responses = self.responses.get(key)
+            if not responses:
+                self.misses[key] = self.misses.get(key, 0) + 1
+                return [ok_packet()], [], []
+            position = self._positions.get(key, 0)
+            self._positions[key] = position + 1
+        return responses[position % len(responses)]
+
+
+class _StandInHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.rfile = self.request.makefile("rb")
+        self.seq = 0
+        self.buffer = []
+        self.buffer_size = 0
+
+    def finish(self):
+        self.rfile.close()
+
+    def read_packet(self):
+        payload = b""
+        while True:
+            header = self.rfile.read(4)
+            if len(header) < 4:
+                return None
+            length = header[0] | header[1] << 8 | header[2] << 16
+            self.seq = (header[3] + 1) % 256
+            payload += self.rfile.read(length)
+            if length < MAX_PACKET_LEN:
+                return payload
+
+    def write_packet(self, payload):
+        # 超过16MB的包拆分发送
+        while True:
+            chunk = payload[:MAX_PACKET_LEN]
+            payload = payload[MAX_PACKET_LEN:]
+            self.buffer.append(_pack_int24(len(chunk)) + bytes([self.seq]) + chunk)
+            self.buffer_size += len(chunk) + 4
+            self.seq = (self.seq + 1) % 256
+            if self.buffer_size >= 65536:
+                self.flush()
+            if len(chunk) < MAX_PACKET_LEN:
+                return
+
+    def flush(self):
+        if self.buffer:
+            self.request.sendall(b"".join(self.buffer))
+            self.buffer = []
+            self.buffer_size = 0
+
+    def greeting(self):
+        salt = os.urandom(20).replace(b"\0", b"\1")
+        return (bytes([10]) + self.server.server_version.encode() + b"\0" +
+                struct.pack("<I", threading.get_ident() & 0xffffffff) + salt[:8] + b"\0" +
+                struct.pack("<HBHHB", SERVER_CAPABILITIES & 0xffff, CHARSET_UTF8MB4_GENERAL_CI,
+                            SERVER_STATUS.SERVER_STATUS_AUTOCOMMIT, SERVER_CAPABILITIES >> 16, 21) +
+                b"\0" * 10 + salt[8:] + b"\0" + b"mysql_native_password\0")
+
+    def handle(self):
+        self.write_packet(self.greeting())
+        self.flush()
+        # 不校验用户名和密码
+        if self.read_packet() is None:
+            return
+        self.write_packet(ok_packet())
+        self.flush()
+        while True:
+            packet = self.read_packet()
+            if packet is None or packet[0] == COMMAND.COM_QUIT:
+                return
+            if packet[0] == COMMAND.COM_QUERY:
+                head, rows, tail = self.server.response(packet[1:])
+                for payload in head:
+                    self.write_packet(payload)
+                for _ in range(self.server.scale if rows else 0):
+                    for payload in rows:
+                        self.write_packet(payload)
+                for payload in tail:
+                    self.write_packet(payload)
+            elif packet[0] in (COMMAND.COM_PING, COMMAND.COM_INIT_DB):
+                self.write_packet(ok_packet())
+            else:
+                self.write_packet(error_packet(1047, f"Unsupported command {packet[0]}"))
+            self.flush()
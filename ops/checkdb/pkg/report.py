@@ -1,6 +1,22 @@
 
 import sqlite3
-from .report_base import header, footer, generate_html_table, generate_html_chart,generate_html_chart_with_instance_and_mount
+from .report_base import header, footer, write_html_table, write_html_series_chart
+from .timeseries import downsample, read_series, rows_to_series
+from .warehouse import SNAPSHOT_TABLE, compare_queries, resolve_snapshots
+from .sqlite3_writer import READ_PRAGMAS, apply_pragmas
+
+# 报表查询使用的索引，采集完成后统一建立，key:(表名, [列名])
+REPORT_INDEXES = [
+    ("tidb_cpuusage", ["hostname"]),
+    ("tidb_osinfo", ["hostname"]),
+    ("tidb_slowquery", ["digest", "plan_digest"]),
+    ("tidb_statementhistory", ["exec_count"]),
+    ("tidb_collector_stats", ["collect_time"]),
+    ("tidb_metric_series", ["metric", "labels"]),
+    ("tidb_locksourcechange", ["persistence", "max_blocked_count"]),
+    ("tidb_avgresponsetime", ["instance", "time"]),
+    ("tidb_ioresponsetime", ["instance", "mount_point", "time"]),
+]
 
 def fetch_data(conn, query):
     cursor = conn.cursor()
@@ -13,6 +29,48 @@ def fetch_data(conn, query):
     cursor.close()
     return column_names, rows
 
+
+def iter_data(conn, query):
+    """
+    和fetch_data相同，但是返回游标，数据在写入报表时逐行读取
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute(query)
+    except sqlite3.OperationalError as e:
+        return [], []
+    column_names = [description[0] for description in cursor.description]
+    return column_names, cursor
+
+def load_chart_groups(conn, legacy_query, spec):
+    """
+    读取指标序列并降采样，按spec["group_by"]中的标签分组
+    优先读取tidb_metric_series，没有数据时（旧版本采集的文件）从逐点存储的旧表中读取
+    :param legacy_query: 旧表的查询，第一列为时间，之后为spec["labels"]中的标签列，其余为值
+    :type legacy_query: str
+    :param spec: metric:指标名，labels:标签，group_by:分组的标签，fields:显示的字段
+    :type spec: dict
+    :return: key:分组名，value:该分组的序列
+    :rtype: Dict[str, List[dict]]
+    """
+    series_list = read_series(conn, spec["metric"])
+    if not series_list:
+        column_names, rows = fetch_data(conn, legacy_query)
+        series_list = rows_to_series(column_names, rows, len(spec["labels"])) if rows else []
+    groups = {}
+    for series in series_list:
+        if series.field not in spec["fields"]:
+            continue
+        group_name = " | ".join(series.labels.get(label, "") for label in spec["group_by"])
+        name_parts = [series.labels.get(label, "") for label in spec["labels"] if label not in spec["group_by"]]
+        if len(spec["fields"]) > 1 or not name_parts:
+            name_parts.append(series.field)
+        data = downsample(series.ts, series.values)
+        if data:
+            groups.setdefault(group_name, []).append({"name": " - ".join(name_parts), "data": data})
+    return dict(sorted(groups.items()))
+
+
 def report_queries():
     """
     打印的查询列表
@@ -108,12 +166,16 @@ from tidb_activeconnectioninfo;
         """
 select source_session_id,
        status,
-       concat('kill tidb ', source_session_id, ';') as kill_source_cmd,
-       cycle1,
-       cycle2,
-       cycle3
-from tidb_locksourcechange""",
-        "查询锁等待的源头是否反复变化"
+       'kill tidb ' || source_session_id || ';' as kill_source_cmd,
+       hit_count,
+       sample_count,
+       persistence,
+       max_blocked_count,
+       in_cycle,
+       source_trx_id
+from tidb_locksourcechange
+order by persistence desc, max_blocked_count desc""",
+        "查询锁等待的源头是否反复变化，hit_count为作为锁源头出现的采样次数，persistence为出现次数占总采样次数的比例，max_blocked_count为直接或间接被阻塞的最大事务数，in_cycle为1表示事务处于循环等待中"
     ]
     queries["元数据锁"] = [
         "table",
@@ -121,19 +183,29 @@ from tidb_locksourcechange""",
         "查询元数据锁等待详情，当存在元数据锁等待时，并不影响业务，只是DDL会等待DML提交"
     ]
     queries["集群QPS"] = [
-        "chart",
-        "select * from tidb_qps;",
-        "查询集群QPS"
+        "series",
+        "select time, qps from tidb_qps;",
+        "查询集群QPS",
+        {"metric": "qps", "labels": [], "group_by": [], "fields": ["qps"]}
     ]
     queries["数据库平均响应时间"] = [
-        "chart",
+        "series",
         "select time,instance,avg_response_time_ms from tidb_avgresponsetime;",
-        "数据库语句平均响应时间"
+        "数据库语句平均响应时间",
+        {"metric": "avg_response_time", "labels": ["instance"], "group_by": [], "fields": ["avg_response_time_ms"]}
     ]
     queries["磁盘IO响应时间"] = [
-        "chart",
-        "select time,instance,mount_point,iops,read_latency_ms,write_latency_ms,cpu_used * 100 as cpu_used_percent from tidb_ioresponsetime;",
-        "磁盘IO响应时间"
+        "series",
+        "select time,instance,mount_point,iops,read_latency_ms,write_latency_ms,cpu_used from tidb_ioresponsetime;",
+        "磁盘IO响应时间，cpu_used为主机CPU使用率（0-1）",
+        {"metric": "io_response_time", "labels": ["instance", "mount_point"], "group_by": ["instance", "mount_point"],
+         "fields": ["iops", "read_latency_ms", "write_latency_ms", "cpu_used"]}
+    ]
+    queries["节点内存使用率"] = [
+        "series",
+        "select time,hostname,used_percent from tidb_memoryusagedetail;",
+        "各主机内存使用率",
+        {"metric": "memory_usage", "labels": ["hostname"], "group_by": [], "fields": ["used_percent"]}
     ]
     queries["StatementHistory"] = [
         "table",
@@ -171,30 +243,49 @@ from tidb_statementhistory order by exec_count desc;""",
     ]
     queries["最近慢查询语句"] = [
         "table",
+        # 增量采集时同一个digest在每次采集中各有一行，这里按digest和plan_digest重新汇总
         """select substr(digest, 1, 16)                     as short_digest,
-               exec_count,
-               avg_query_time,
-               sum_query_time,
-               sum_process_keys,
-               avg_process_keys,
-               strftime('%Y-%m-%d %H:%M:%S', first_seen) as first_seen,
-               strftime('%Y-%m-%d %H:%M:%S', last_seen)  as last_seen,
-               sum_total_keys,
-               avg_total_keys,
-               avg_result_rows,
-               max_result_rows,
-               mem_max,
-               disk_max,
+               sum(exec_count)                              as exec_count,
+               round(sum(sum_query_time) / sum(exec_count), 4) as avg_query_time,
+               round(sum(sum_query_time), 4)                as sum_query_time,
+               sum(sum_process_keys)                        as sum_process_keys,
+               1.0 * sum(sum_process_keys) / sum(exec_count) as avg_process_keys,
+               strftime('%Y-%m-%d %H:%M:%S', min(first_seen)) as first_seen,
+               strftime('%Y-%m-%d %H:%M:%S', max(last_seen))  as last_seen,
+               sum(sum_total_keys)                          as sum_total_keys,
+               1.0 * sum(sum_total_keys) / sum(exec_count)  as avg_total_keys,
+               sum(avg_result_rows * exec_count) / sum(exec_count) as avg_result_rows,
+               max(max_result_rows)                         as max_result_rows,
+               max(mem_max)                                 as mem_max,
+               max(disk_max)                                as disk_max,
                digest,
                plan_digest,
-               succ_count,
-               plan_from_binding,
-               query,
-               plan
+               sum(succ_count)                              as succ_count,
+               sum(plan_from_binding)                       as plan_from_binding,
+               max(query)                                   as query,
+               max(plan)                                    as plan
         from tidb_slowquery
+        group by digest, plan_digest
         order by exec_count desc;""",
         "查询慢查询信息，包括慢查询的sql语句和执行时间，按照Digest和Plan_digest进行分组聚合"
     ]
+    queries["采集任务耗时"] = [
+        "table",
+        """select task_name,
+               status,
+               elapsed_s,
+               query_s,
+               write_s,
+               wait_s,
+               row_count,
+               round(bytes / 1024.0 / 1024, 2) as data_mb,
+               peak_rss_delta_mb,
+               error
+        from tidb_collector_stats
+        where collect_time = (select max(collect_time) from tidb_collector_stats)
+        order by elapsed_s desc;""",
+        "最近一次采集中各采集任务的耗时和资源使用，query_s为在TiDB上执行SQL和读取数据的耗时，write_s为写入sqlite3的耗时，wait_s为等待写线程的耗时，peak_rss_delta_mb为任务前后进程内存峰值的增量（任务并发执行时仅供参考），status为partial表示超出执行时间预算，只保存了部分结果"
+    ]
     return queries
 
 def report(in_file, out_file):
@@ -207,6 +298,7 @@ def report(in_file, out_file):
     """
     conn = sqlite3.connect(in_file)
     conn.text_factory = str  # Set character set to UTF-8
+    apply_pragmas(conn, READ_PRAGMAS)
     """
     queries = {
         "节点信息": ["table","SELECT type as 类型 FROM tidb_nodeinfo", "查询每个节点的信息，包括节点的IP地址、端口、状态、版本、启动时间、上线时间、下线时间、节点类型、节点角色、节点状态、节点状态描述"],
@@ -224,39 +316,81 @@ def report(in_file, out_file):
     }
     """
     queries = report_queries()
-    html_content = header()
-    html_content += "<body>\n"
-    html_content += "<div class='sidebar'>\n"
-    html_content += "<h2>导航</h2>\n"
-    for title in queries.keys():
-        html_content += f"<a href='#{title.replace(' ', '_')}'>{title}</a>\n"
-    html_content += "</div>\n"
+    # 边生成边写入文件，不在内存中拼接整个html
+    with open(out_file, 'w', encoding='utf-8') as file:
+        file.write(header())
+        file.write("<body>\n")
+        file.write("<div class='sidebar'>\n")
+        file.write("<h2>导航</h2>\n")
+        for title in queries.keys():
+            file.write(f"<a href='#{title.replace(' ', '_')}'>{title}</a>\n")
+        file.write("</div>\n")
 
-    html_content += "<div class='table-container'>\n"
-    for idx, (title, query_list) in enumerate(queries.items()):
-        query = query_list[1]
-        describe = query_list[2]
-        column_names, rows = fetch_data(conn, query)
-        table_id = f"table_{idx}"
-        html_content += f"<h2 id='{title.replace(' ', '_')}'>{title}</h2>\n"
-        html_content += f"<small style='color: black; font-size: small;'>{describe}</small><br></br>\n"
-        if query_list[0] == "chart":
-            # column_names第一列为时间，后面的列为数据
-            if title == "磁盘IO响应时间":
-                html_content += generate_html_chart_with_instance_and_mount(table_id, column_names, rows, title)
-            elif title == "数据库平均响应时间":
-                html_content += generate_html_chart(table_id, column_names, rows, title, 1)
+        file.write("<div class='table-container'>\n")
+        for idx, (title, query_list) in enumerate(queries.items()):
+            query = query_list[1]
+            describe = query_list[2]
+            table_id = f"table_{idx}"
+            file.write(f"<h2 id='{title.replace(' ', '_')}'>{title}</h2>\n")
+            file.write(f"<small style='color: black; font-size: small;'>{describe}</small><br></br>\n")
+            if query_list[0] == "series":
+                # 每条序列降采样到固定点数，报表大小不随时间窗口和实例数增长
+                write_html_series_chart(file, table_id, load_chart_groups(conn, query, query_list[3]), title)
             else:
-                html_content += generate_html_chart(table_id,column_names, rows, title, 0)
-        else:
-            html_content += generate_html_table(table_id, column_names, rows)
-    html_content += "</div>\n"
-    html_content += "</body>\n"
-    html_content += footer()
+                column_names, rows = iter_data(conn, query)
+                write_html_table(file, table_id, column_names, rows)
+        file.write("</div>\n")
+        file.write("</body>\n")
+        file.write(footer())
 
-    with open(out_file, 'w', encoding='utf-8') as file:
-        file.write(html_content)
+    conn.close()
 
+
+def compare_report(warehouse_file, out_file, snapshot_id=None, baseline_id=None, min_ratio=1.5):
+    """
+    对比仓库中的两个快照生成html报表
+    :param warehouse_file: 仓库文件路径
+    :type warehouse_file: str
+    :param out_file: 输出html文件路径
+    :type out_file: str
+    :param snapshot_id: 当前快照，默认为最新的快照
+    :type snapshot_id: int
+    :param baseline_id: 基线快照，默认为当前快照的前一个快照
+    :type baseline_id: int
+    :param min_ratio: 平均耗时达到基线的min_ratio倍才认为退化
+    :type min_ratio: float
+    """
+    conn = sqlite3.connect(f"file:{warehouse_file}?mode=ro", uri=True)
+    conn.text_factory = str
+    cluster_name, snapshot_id, baseline_id = resolve_snapshots(conn, snapshot_id, baseline_id)
+    sections = {}
+    sections["快照列表"] = [f"select * from {SNAPSHOT_TABLE} where cluster = ? order by snapshot_id desc", (cluster_name,),
+                        f"集群{cluster_name}的所有快照，当前快照:{snapshot_id}，基线快照:{baseline_id}"]
+    for title, (query, describe) in compare_queries().items():
+        sections[title] = [query, (cluster_name, snapshot_id, cluster_name, baseline_id, min_ratio),
+                           f"{describe}，只列出平均耗时达到基线{min_ratio}倍的digest"]
+    with open(out_file, 'w', encoding='utf-8') as file:
+        file.write(header())
+        file.write("<body>\n")
+        file.write("<div class='sidebar'>\n")
+        file.write("<h2>导航</h2>\n")
+        for title in sections.keys():
+            file.write(f"<a href='#{title}'>{title}</a>\n")
+        file.write("</div>\n")
+        file.write("<div class='table-container'>\n")
+        for idx, (title, (query, params, describe)) in enumerate(sections.items()):
+            file.write(f"<h2 id='{title}'>{title}</h2>\n")
+            file.write(f"<small style='color: black; font-size: small;'>{describe}</small><br></br>\n")
+            try:
+                cursor = conn.execute(query, params)
+                column_names = [description[0] for description in cursor.description]
+            except sqlite3.OperationalError:
+                # 仓库中还没有这张表
+                column_names, cursor = [], []
+            write_html_table(file, f"table_{idx}", column_names, cursor)
+        file.write("</div>\n")
+        file.write("</body>\n")
+        file.write(footer())
     conn.close()
 
 
@@ -1,25 +1,100 @@
+import html
+import json
 from pathlib import Path
-def generate_html_table(table_id, column_names, rows):
-    if not column_names or not rows:
-        return "<p>No data available</p>\n"
-    html_table = f"<table id='{table_id}' class='display'>\n"
-    html_table += "  <thead><tr>\n"
-    for column_name in column_names:
-        html_table += f"    <th>{column_name}</th>\n"
-    html_table += "  </tr></thead>\n"
+def to_json_script(value):
+    """
+    序列化为可以直接放在<script type="application/json">中的json，
+    转义所有的<，避免数据中的</script>或<!--提前结束脚本块
+    """
+    return json.dumps(value, ensure_ascii=False, default=str).replace("<", "\\u003c")
 
-    html_table += "  <tbody>\n"
+
+def write_html_table(file, table_id, column_names, rows):
+    """
+    流式写入表格，html中只包含表头，数据逐行序列化为json数组放在表格后面的脚本块中，
+    由DataTables按页延迟渲染(deferRender)，报表大小和生成耗时与行数线性相关
+    :param file: 输出文件
+    :type file: TextIO
+    :param table_id: 表格的HTML元素ID
+    :type table_id: str
+    :param column_names: 列名列表
+    :type column_names: list
+    :param rows: 数据行，可以是sqlite3游标
+    :type rows: Iterable[tuple]
+    """
+    rows = iter(rows)
+    first_row = next(rows, None)
+    if not column_names or first_row is None:
+        file.write("<p>No data available</p>\n")
+        return
+    file.write(f"<table id='{table_id}' class='display' data-source='{table_id}-data' style='width:100%'>\n")
+    file.write("  <thead><tr>\n")
+    for column_name in column_names:
+        file.write(f"    <th>{html.escape(str(column_name))}</th>\n")
+    file.write("  </tr></thead>\n")
+    file.write("</table>\n")
+    file.write(f"<script type='application/json' id='{table_id}-data'>[\n")
+    file.write(to_json_script(list(first_row)))
     for row in rows:
-        html_table += "  <tr>\n"
-        for cell in row:
-            if isinstance(cell, str):
-                cell = cell.replace("└─", "&boxur;").replace("\n", "<br>").replace("│", "&boxv;").replace("├─",
-                                                                                                          "&boxvr;")
-            html_table += f"    <td><pre><span class=\"custom-font\">{cell}</span></pre></td>\n"
-        html_table += "  </tr>\n"
-    html_table += "  </tbody>\n"
-    html_table += "</table>\n"
-    return html_table
+        file.write(",\n")
+        file.write(to_json_script(list(row)))
+    file.write("\n]</script>\n")
+
+
+def write_html_series_chart(file, chart_id, groups, title=""):
+    """
+    写入时间轴折线图，序列数据已经降采样，放在图表后面的json脚本块中；
+    groups有多个分组时（比如实例+挂载点）显示下拉框切换分组
+    :param file: 输出文件
+    :type file: TextIO
+    :param chart_id: 图表的HTML元素ID
+    :type chart_id: str
+    :param groups: key:分组名，value:[{"name": 序列名, "data": [[毫秒时间戳, 值]]}]
+    :type groups: Dict[str, List[dict]]
+    :param title: 图表标题
+    :type title: str
+    """
+    if not groups:
+        file.write("<p>No data available</p>\n")
+        return
+    file.write("<div style='position: relative;'>\n")
+    if len(groups) > 1:
+        file.write(f"  <select id='{chart_id}-selector' style='position: absolute; top: 10px; left: 10px; z-index: 1000;'>\n")
+        for name in groups:
+            file.write(f"    <option>{html.escape(name)}</option>\n")
+        file.write("  </select>\n")
+    file.write(f"  <div id='{chart_id}' style='width: 100%; height: 400px; margin: 0 auto; border: 1px solid #ccc; "
+               f"border-radius: 8px; box-shadow: 0px 0px 10px rgba(0, 0, 0, 0.1);'></div>\n")
+    file.write("</div>\n")
+    file.write(f"<script type='application/json' id='{chart_id}-data'>{to_json_script(groups)}</script>\n")
+    file.write(f"""<script>
+(function() {{
+    var groups = JSON.parse(document.getElementById('{chart_id}-data').textContent);
+    var chart = echarts.init(document.getElementById('{chart_id}'));
+    var selector = document.getElementById('{chart_id}-selector');
+    function render(name) {{
+        chart.setOption({{
+            "title": {{"text": {json.dumps(title)}, "left": "center"}},
+            "tooltip": {{"trigger": "axis"}},
+            "legend": {{"top": "8%"}},
+            "grid": {{"left": "5%", "right": "5%", "bottom": "10%", "containLabel": true}},
+            "toolbox": {{"feature": {{"saveAsImage": {{}}, "restore": {{}}, "dataZoom": {{"yAxisIndex": "none"}}}}}},
+            "xAxis": {{"type": "time"}},
+            "yAxis": {{"type": "value"}},
+            "dataZoom": [{{"type": "slider", "start": 0, "end": 100}}],
+            "series": groups[name].map(function(series) {{
+                return {{"name": series.name, "type": "line", "showSymbol": false, "data": series.data}};
+            }})
+        }}, true);
+    }}
+    render(Object.keys(groups)[0]);
+    if (selector) {{
+        selector.addEventListener('change', function(event) {{ render(event.target.value); }});
+    }}
+    window.addEventListener('resize', function() {{ chart.resize(); }});
+}})();
+</script>
+""")
 
 
 # column_names第一列为时间，后面的列为数据
@@ -526,33 +601,42 @@ def footer(local=True):
         """
     footer = jscripts + """
     <script>
+        // 单元格内容做html转义后放在<pre>中显示，保留执行计划的换行和树形符号
+        function renderCell(data, type) {
+            if (type !== 'display' || data === null || data === undefined) {
+                return data;
+            }
+            var text = String(data).replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;');
+            return '<pre><span class="custom-font">' + text + '</span></pre>';
+        }
         $(document).ready(function() {
-            // Initialize DataTables for each table
-            $('table.display').DataTable({
-                "fixedHeader": true,
-                "paging": true,
-                "ordering": true,
-                "searching": true,
-                "responsive": true
-            });
-            // Set default column width based on the longest cell content
+            // Initialize DataTables for each table，数据来自表格对应的json脚本块，只渲染当前页
             $('table.display').each(function() {
                 var table = $(this);
+                var data = JSON.parse(document.getElementById(table.data('source')).textContent);
+                // Set default column width based on the longest cell content，只采样前200行
                 table.find('th').each(function(index) {
                     var maxWidth = 300; // 设置最大宽度
                     var maxLength = 0;
-                    table.find('tr').each(function() {
-                        var cell = $(this).find('td').eq(index);
-                        if (cell.length) {
-                            var cellText = cell.text();
-                            if (cellText.length > maxLength) {
-                                maxLength = cellText.length;
-                            }
+                    for (var i = 0; i < Math.min(data.length, 200); i++) {
+                        var cellText = data[i][index] === null ? '' : String(data[i][index]);
+                        if (cellText.length > maxLength) {
+                            maxLength = cellText.length;
                         }
-                    });
+                    }
                     var width = Math.min(maxLength * 10, maxWidth); // 计算宽度并限制最大宽度
                     $(this).css('width', width + 'px');
                 });
+                table.DataTable({
+                    "data": data,
+                    "deferRender": true,
+                    "columnDefs": [{"targets": "_all", "render": renderCell}],
+                    "fixedHeader": true,
+                    "paging": true,
+                    "ordering": true,
+                    "searching": true,
+                    "responsive": true
+                });
             });
             // Enable column resizing using jQuery UI
             $('th').resizable({
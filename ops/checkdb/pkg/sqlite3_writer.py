@@ -1,6 +1,52 @@
+import logging
 import sqlite3
 import threading
 import time
+import traceback
+from itertools import chain, islice
+from queue import Queue
+
+# executemany每次提交给sqlite3的行数，只影响内存占用，所有数据仍在同一个事务中
+DEFAULT_BATCH_SIZE = 2000
+# 写入阶段的PRAGMA：采集失败时文件会重新生成，不需要每次提交都落盘
+LOAD_PRAGMAS = ["journal_mode=WAL", "synchronous=OFF", "cache_size=-65536", "temp_store=MEMORY"]
+# 追加写入（增量采集）时文件中保存了历史数据和水位线，无法重新生成，WAL模式下synchronous=NORMAL保证崩溃后不损坏
+APPEND_PRAGMAS = ["journal_mode=WAL", "synchronous=NORMAL", "cache_size=-65536", "temp_store=MEMORY"]
+# 生成报表时的PRAGMA：分组和排序使用内存中的临时表
+READ_PRAGMAS = ["cache_size=-65536", "temp_store=MEMORY"]
+
+
+def apply_pragmas(conn, pragmas):
+    """
+    :type conn: sqlite3.Connection
+    :type pragmas: List[str]
+    """
+    for pragma in pragmas:
+        conn.execute(f"pragma {pragma}")
+
+
+def finalize_db(db_path, indexes=()):
+    """
+    数据全部写入后执行：建立报表查询需要的索引，收集统计信息，再切换回DELETE日志模式，
+    输出仍然是单个sqlite3文件，没有-wal和-shm文件
+    :param db_path: sqlite3文件路径
+    :type db_path: str
+    :param indexes: [(表名, [列名])]，表不存在时跳过
+    :type indexes: Iterable[tuple]
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        apply_pragmas(conn, ["temp_store=MEMORY", "cache_size=-65536"])
+        tables = {row[0] for row in conn.execute("select name from sqlite_master where type='table'")}
+        for table, columns in indexes:
+            if table in tables:
+                conn.execute(f"create index if not exists idx_{table}_{'_'.join(columns)} on {table} ({','.join(columns)})")
+        conn.execute("analyze")
+        conn.commit()
+        conn.execute("pragma journal_mode=DELETE")
+    finally:
+        conn.close()
+
 
 class SQLiteConnectionManager:
     def __init__(self, db_path):
@@ -26,4 +72,283 @@ class SQLiteConnectionManager:
         if self.conn:
             self.lock.release()
             self.conn.close()
-            self.conn = None
\ No newline at end of file
+            self.conn = None
+
+
+def chunked(iterable, size):
+    """
+    将可迭代对象按size切分为列表
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def value_size(value):
+    """
+    估算一个sqlite3绑定值的大小，用于统计采集的数据量
+    """
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return 8
+
+
+class BulkWriter:
+    """
+    批量写入sqlite3
+    每个表类只生成一次建表语句和带?占位符的插入语句，数据按batch_size分块交给executemany，
+    一次save的所有数据在同一个事务中提交
+    """
+    # key:表类，value:(drop_table_sql, create_table_sql, bulk_insert_sql)
+    _statements = {}
+
+    def __init__(self, conn, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        :param conn: 写入的数据库连接
+        :type conn: sqlite3.Connection
+        :param batch_size: executemany每批次的行数
+        :type batch_size: int
+        """
+        self.conn = conn
+        self.batch_size = batch_size
+        self.byte_count = 0  # 累计写入的数据量，字符串按字符数、数值按8字节估算
+
+    @classmethod
+    def statements(cls, row):
+        """
+        获取表类对应的建表和插入语句，同一个表类只生成一次
+        :param row: BaseTable实例
+        :rtype: tuple
+        """
+        table_class = type(row)
+        if table_class not in cls._statements:
+            cls._statements[table_class] = (row.drop_table_sql(), row.create_table_sql(), row.bulk_insert_sql())
+        return cls._statements[table_class]
+
+    def prepare(self, row, append=False):
+        """
+        按照row的表类重建表
+        :param row: BaseTable实例
+        :param append: 为True时保留已有的表和数据，只在表不存在时建表，旧版本建的表缺少的列通过alter table追加
+        :type append: bool
+        :return: 该表类的插入语句
+        :rtype: str
+        """
+        drop_sql, create_sql, insert_sql = self.statements(row)
+        self.begin()
+        if not append:
+            self.conn.execute(drop_sql)
+        self.conn.execute(create_sql)
+        if append:
+            table = row.class_to_table_name
+            existing = {column[1] for column in self.conn.execute(f"pragma table_info({table})")}
+            for name, column_type in row.fields.items():
+                if name not in existing:
+                    self.conn.execute(f"alter table {table} add column {name} {column_type}")
+        return insert_sql
+
+    def begin(self):
+        if not self.conn.in_transaction:
+            self.conn.execute("begin")
+
+    def write(self, insert_sql, rows):
+        """
+        按batch_size分块写入数据，不提交事务
+        :rtype: int
+        """
+        row_count = 0
+        self.begin()
+        for chunk in chunked(rows, self.batch_size):
+            values = [row.insert_values() for row in chunk]
+            self.conn.executemany(insert_sql, values)
+            self.byte_count += sum(value_size(value) for row_values in values for value in row_values)
+            row_count += len(chunk)
+        return row_count
+
+    def save(self, rows, append=False):
+        """
+        重建表并写入数据，rows为空时不创建表
+        :param rows: BaseTable实例的列表或生成器
+        :param append: 为True时追加写入已有的表
+        :type append: bool
+        :return: 写入的行数
+        :rtype: int
+        """
+        rows = iter(rows)
+        first_row = next(rows, None)
+        if first_row is None:
+            return 0
+        try:
+            insert_sql = self.prepare(first_row, append=append)
+            row_count = self.write(insert_sql, chain([first_row], rows))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return row_count
+
+
+class SQLiteWriter(threading.Thread):
+    """
+    唯一的sqlite3写线程，连接在写线程内创建，采集线程通过有界队列提交数据，避免多线程共用同一个sqlite3连接
+    队列中的消息为(类型, 任务名, 数据)：
+    rows: 数据为BaseTable实例列表，任务的第一批数据会重建表，增量任务则追加到已有的表
+    done: 任务数据全部提交，提交事务
+    failed: 任务执行失败，数据为异常信息，删除该任务已写入的数据
+    所有任务共用写连接上的事务，多个任务的数据交替写入（指标序列还会写入同一张表），
+    SAVEPOINT只能按栈的顺序回滚，无法单独回滚其中一个任务，因此记录每个任务写入的rowid范围，失败时按范围删除
+    """
+
+    def __init__(self, db_path, batch_size=DEFAULT_BATCH_SIZE, queue_size=16, init_db=None, incremental=None,
+                 pragmas=None):
+        """
+        :param db_path: sqlite3文件路径
+        :type db_path: str
+        :param batch_size: executemany每批次的行数
+        :type batch_size: int
+        :param queue_size: 队列长度，队列满时采集线程会阻塞等待
+        :type queue_size: int
+        :param init_db: 打开连接后的初始化函数，参数为sqlite3.Connection
+        :type init_db: Callable[[sqlite3.Connection], None]
+        :param incremental: 追加写入的任务，key:任务名，value:追加写入的目标（增量采集的表和水位线、指标序列）
+        :type incremental: Dict[str, pkg.incremental.IncrementalTarget]
+        :param pragmas: 写入阶段的PRAGMA，默认为LOAD_PRAGMAS
+        :type pragmas: List[str]
+        """
+        super().__init__(name="sqlite3-writer", daemon=True)
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.init_db = init_db
+        self.incremental = incremental or {}
+        self.pragmas = pragmas or LOAD_PRAGMAS
+        self.queue = Queue(maxsize=queue_size)
+        self.row_counts = {}  # key:任务名，value:写入行数
+        self.byte_counts = {}  # key:任务名，value:写入的数据量
+        self.write_seconds = {}  # key:任务名，value:建表、写入和提交的耗时（秒）
+        self.errors = {}  # key:任务名，value:错误信息
+        self._insert_sqls = {}  # key:任务名，value:插入语句
+        self._tables = {}  # key:任务名，value:写入的表名
+        self._written = {}  # key:任务名，value:未提交完成的任务已写入的rowid范围[(first, last)]
+        self._incremental_started = set()  # 已经执行过on_start的增量任务
+
+    def put_rows(self, task_name, rows):
+        self.queue.put(("rows", task_name, rows))
+
+    def finish(self, task_name):
+        self.queue.put(("done", task_name, None))
+
+    def fail(self, task_name, error):
+        self.queue.put(("failed", task_name, error))
+
+    def close(self):
+        """
+        等待队列中的数据全部写完后关闭写线程
+        """
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        conn = None
+        writer = None
+        init_error = None
+        try:
+            # 连接、PRAGMA（如其它进程打开文件时切换WAL报database is locked）或初始化失败时，
+            # 仍然要消费队列并将所有任务标记为失败，避免采集线程阻塞在队列上
+            try:
+                conn = sqlite3.connect(self.db_path)
+                conn.text_factory = str
+                apply_pragmas(conn, self.pragmas)
+                writer = BulkWriter(conn, self.batch_size)
+                if self.init_db:
+                    self.init_db(conn)
+            except Exception as e:
+                logging.error(f"Init sqlite3 db failed: {e}, {traceback.format_exc()}")
+                init_error = str(e)
+            while True:
+                message = self.queue.get()
+                if message is None:
+                    break
+                if init_error:
+                    self.errors.setdefault(message[1], init_error)
+                    continue
+                self._handle(writer, *message)
+            if not init_error and conn.in_transaction:
+                conn.commit()
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _handle(self, writer, kind, task_name, payload):
+        # 写入失败的任务后续数据直接丢弃，不影响其它任务
+        if task_name in self.errors:
+            return
+        start = time.time()
+        byte_count = writer.byte_count
+        try:
+            if kind == "rows":
+                if not payload:
+                    return
+                if task_name not in self._insert_sqls:
+                    self._start(writer, task_name)
+                    self._insert_sqls[task_name] = writer.prepare(payload[0], append=task_name in self.incremental)
+                    self._tables[task_name] = payload[0].class_to_table_name
+                    self.row_counts[task_name] = 0
+                # 写线程是唯一的写入者，一批数据的rowid是连续的
+                first = self._max_rowid(writer, task_name) + 1
+                try:
+                    self.row_counts[task_name] += writer.write(self._insert_sqls[task_name], payload)
+                finally:
+                    last = self._max_rowid(writer, task_name)
+                    if last >= first:
+                        self._written.setdefault(task_name, []).append((first, last))
+            elif kind == "done":
+                target = self.incremental.get(task_name)
+                if target is not None:
+                    self._start(writer, task_name)
+                    target.on_done(writer.conn)
+                writer.conn.commit()
+                self._written.pop(task_name, None)
+                logging.debug(f"Save data from task[{task_name}]: {self.row_counts.get(task_name, 0)}")
+            elif kind == "failed":
+                self.errors[task_name] = str(payload)
+                self._rollback(writer, task_name)
+                writer.conn.commit()
+        except Exception as e:
+            logging.error(f"Save data failed: {e}, {traceback.format_exc()}")
+            self.errors[task_name] = str(e)
+            try:
+                self._rollback(writer, task_name)
+            except Exception as rollback_error:
+                logging.error(f"Rollback data of task[{task_name}] failed: {rollback_error}")
+        finally:
+            self.write_seconds[task_name] = self.write_seconds.get(task_name, 0.0) + time.time() - start
+            self.byte_counts[task_name] = self.byte_counts.get(task_name, 0) + writer.byte_count - byte_count
+
+    def _max_rowid(self, writer, task_name):
+        return writer.conn.execute(f"select coalesce(max(rowid), 0) from {self._tables[task_name]}").fetchone()[0]
+
+    def _rollback(self, writer, task_name):
+        """
+        删除失败的任务已经写入的数据，和其它任务的数据一起在下次提交时生效
+        """
+        ranges = self._written.pop(task_name, [])
+        if not ranges:
+            return
+        writer.begin()
+        for first, last in ranges:
+            writer.conn.execute(f"delete from {self._tables[task_name]} where rowid between ? and ?", (first, last))
+        self.row_counts[task_name] = 0
+        logging.warning(f"Task[{task_name}] failed, rollback {sum(last - first + 1 for first, last in ranges)} rows")
+
+    def _start(self, writer, task_name):
+        # 增量任务在写入第一批数据前（或没有数据时在提交前）清理上次失败残留的数据，只执行一次
+        target = self.incremental.get(task_name)
+        if target is not None and task_name not in self._incremental_started:
+            self._incremental_started.add(task_name)
+            writer.begin()
+            target.on_start(writer.conn)
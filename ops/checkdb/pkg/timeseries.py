@@ -0,0 +1,275 @@
+"""
+监控指标的列式存储和降采样
+QPS、响应时间、IO、内存等指标不再每个点一行，而是每条序列（指标+标签+字段）一行，
+时间戳为epoch秒的int64数组，值为float64数组，打包为小端字节序的blob；
+生成报表时每条序列用LTTB降采样到固定点数，报表大小和时间窗口、实例数无关，同时保留峰值的形状
+"""
+import json
+import math
+import sqlite3
+import sys
+from array import array
+from datetime import datetime
+
+from .dbinfo import BaseTable
+
+SERIES_TABLE = "tidb_metric_series"
+# 报表中每条序列最多的点数
+CHART_MAX_POINTS = 600
+
+
+class MetricSeries(BaseTable):
+    __slots__ = ("metric", "labels", "field", "point_count", "start_ts", "end_ts", "ts", "vals")
+    _table_name = SERIES_TABLE
+
+    def __init__(self):
+        self.metric = ""
+        self.labels = ""  # 标签的json，比如{"instance": "127.0.0.1:10080"}
+        self.field = ""
+        self.point_count = 0
+        self.start_ts = 0
+        self.end_ts = 0
+        self.ts = b""  # pack_ints打包的时间戳
+        self.vals = b""  # pack_floats打包的值，空值为NaN
+        super().__init__()
+
+
+def _pack(typecode, values):
+    packed = array(typecode, values)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _unpack(typecode, data):
+    unpacked = array(typecode)
+    unpacked.frombytes(data)
+    if sys.byteorder == "big":
+        unpacked.byteswap()
+    return unpacked
+
+
+def pack_ints(values):
+    return _pack("q", values)
+
+
+def pack_floats(values):
+    return _pack("d", values)
+
+
+def unpack_ints(data):
+    return _unpack("q", data)
+
+
+def unpack_floats(data):
+    return _unpack("d", data)
+
+
+def to_epoch(value):
+    """
+    将datetime或时间字符串转换为epoch秒
+    :rtype: int
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+    if not isinstance(value, datetime):
+        # datetime.fromisoformat需要python3.7，打包的依赖面向python3.6
+        value = str(value)
+        value = datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f" if "." in value else "%Y-%m-%d %H:%M:%S")
+    return int(value.timestamp())
+
+
+def to_float(value):
+    if value is None:
+        return math.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def to_series(rows, metric, label_fields, value_fields, time_field="time"):
+    """
+    将逐点的数据行按标签分组，每个字段生成一条序列
+    :param rows: BaseTable实例
+    :type rows: Iterable[BaseTable]
+    :param metric: 指标名
+    :type metric: str
+    :param label_fields: 标签字段
+    :type label_fields: List[str]
+    :param value_fields: 值字段，每个字段一条序列
+    :type value_fields: List[str]
+    :param time_field: 时间字段
+    :type time_field: str
+    :rtype: Iterator[MetricSeries]
+    """
+    # key:标签值，value:[(时间戳, 各字段的值)]
+    points = {}
+    for row in rows:
+        labels = tuple(getattr(row, field) for field in label_fields)
+        points.setdefault(labels, []).append((to_epoch(getattr(row, time_field)),
+                                              [to_float(getattr(row, field)) for field in value_fields]))
+    for labels, label_points in points.items():
+        label_points.sort(key=lambda point: point[0])
+        ts = pack_ints([point[0] for point in label_points])
+        for i, field in enumerate(value_fields):
+            series = MetricSeries()
+            series.metric = metric
+            series.labels = json.dumps(dict(zip(label_fields, map(str, labels))), ensure_ascii=False, sort_keys=True)
+            series.field = field
+            series.point_count = len(label_points)
+            series.start_ts = label_points[0][0]
+            series.end_ts = label_points[-1][0]
+            series.ts = ts
+            series.vals = pack_floats([point[1][i] for point in label_points])
+            yield series
+
+
+def series_collector(func, metric, label_fields, value_fields, time_field="time"):
+    """
+    把逐点返回数据的采集函数包装为返回MetricSeries的采集函数，任务名保持不变，其余参数原样传给func
+    :type func: Callable[..., List[BaseTable]]
+    """
+    def collector(conn, *args, **kwargs):
+        return to_series(func(conn, *args, **kwargs), metric, label_fields, value_fields, time_field)
+    collector.__name__ = func.__name__
+    return collector
+
+
+class SeriesTarget:
+    """
+    多个采集任务的序列写入同一张表，每个任务只替换自己指标的数据
+    和pkg.incremental.IncrementalTarget一样作为写线程的追加写入目标
+    """
+
+    def __init__(self, metric):
+        self.metric = metric
+
+    def on_start(self, conn):
+        if conn.execute("select 1 from sqlite_master where type='table' and name=?", (SERIES_TABLE,)).fetchone():
+            conn.execute(f"delete from {SERIES_TABLE} where metric = ?", (self.metric,))
+
+    def on_done(self, conn):
+        pass
+
+
+def lttb(ts, values, threshold):
+    """
+    Largest-Triangle-Three-Buckets降采样，保留首尾两个点，中间每个桶选取和相邻桶构成三角形面积最大的点
+    :param ts: 时间戳，升序
+    :type ts: Sequence[int]
+    :param values: 值，不能包含NaN
+    :type values: Sequence[float]
+    :param threshold: 降采样后的点数
+    :type threshold: int
+    :return: 选中的点的下标
+    :rtype: List[int]
+    """
+    length = len(ts)
+    if threshold >= length or threshold < 3:
+        return list(range(length))
+    selected = [0]
+    bucket_size = (length - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # 下一个桶的平均点作为三角形的第三个顶点
+        next_start = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, length)
+        avg_count = next_end - next_start
+        avg_x = sum(ts[next_start:next_end]) / avg_count
+        avg_y = sum(values[next_start:next_end]) / avg_count
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        ax, ay = ts[a], values[a]
+        max_area = -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (values[j] - ay) - (ax - ts[j]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                a_next = j
+        selected.append(a_next)
+        a = a_next
+    selected.append(length - 1)
+    return selected
+
+
+def minmax(ts, values, threshold):
+    """
+    按时间均分为threshold/2个桶，每个桶保留最小值和最大值，适合毛刺多的指标
+    :return: 选中的点的下标
+    :rtype: List[int]
+    """
+    length = len(ts)
+    buckets = threshold // 2
+    if threshold >= length or buckets < 1:
+        return list(range(length))
+    selected = []
+    bucket_size = length / buckets
+    for i in range(buckets):
+        start = int(i * bucket_size)
+        end = min(int((i + 1) * bucket_size), length)
+        if start >= end:
+            continue
+        bucket = range(start, end)
+        low = min(bucket, key=lambda j: values[j])
+        high = max(bucket, key=lambda j: values[j])
+        selected.extend(sorted({low, high}))
+    return selected
+
+
+def downsample(ts, values, threshold=CHART_MAX_POINTS, method=lttb):
+    """
+    去掉空值后降采样
+    :return: [[毫秒时间戳, 值]]，可以直接作为echarts时间轴的数据
+    :rtype: List[list]
+    """
+    points = [(t, v) for t, v in zip(ts, values) if not math.isnan(v)]
+    ts = [point[0] for point in points]
+    values = [point[1] for point in points]
+    return [[ts[i] * 1000, values[i]] for i in method(ts, values, threshold)]
+
+
+class Series:
+    """
+    报表中使用的一条序列
+    """
+    __slots__ = ("labels", "field", "ts", "values")
+
+    def __init__(self, labels, field, ts, values):
+        self.labels = labels
+        self.field = field
+        self.ts = ts
+        self.values = values
+
+
+def read_series(conn, metric):
+    """
+    读取指标的所有序列，表不存在（旧版本采集的文件）时返回空列表
+    :type conn: sqlite3.Connection
+    :rtype: List[Series]
+    """
+    try:
+        cursor = conn.execute(f"select labels, field, ts, vals from {SERIES_TABLE} where metric = ? order by labels", (metric,))
+    except sqlite3.OperationalError:
+        return []
+    return [Series(json.loads(labels), field, unpack_ints(ts), unpack_floats(vals)) for labels, field, ts, vals in cursor]
+
+
+def rows_to_series(column_names, rows, label_count):
+    """
+    旧版本逐点存储的数据转换为序列，第一列为时间，之后label_count列为标签，其余列为值
+    :rtype: List[Series]
+    """
+    label_names = column_names[1:1 + label_count]
+    value_names = column_names[1 + label_count:]
+    points = {}
+    for row in rows:
+        labels = tuple(str(value) for value in row[1:1 + label_count])
+        points.setdefault(labels, []).append((to_epoch(row[0]), [to_float(value) for value in row[1 + label_count:]]))
+    series = []
+    for labels, label_points in sorted(points.items()):
+        label_points.sort(key=lambda point: point[0])
+        ts = [point[0] for point in label_points]
+        for i, field in enumerate(value_names):
+            series.append(Series(dict(zip(label_names, labels)), field, ts, [point[1][i] for point in label_points]))
+    return series
@@ -0,0 +1,142 @@
+"""
+集群主机拓扑
+ip到主机名、节点类型、CPU/内存、磁盘挂载点的映射在一次采集中只从CLUSTER_INFO、CLUSTER_SYSTEMINFO、CLUSTER_HARDWARE
+各查询一次，保存在进程内的Topology对象中并写入tidb_topology表；
+各采集函数只查询自己的监控指标，在本地和拓扑关联，不再在各自的SQL中重复关联这几张集群表
+"""
+import logging
+import threading
+import time
+from typing import List
+
+from .dbinfo import BaseTable
+
+
+class HostTopology(BaseTable):
+    __slots__ = ("ip_address", "hostname", "types", "types_count", "instances", "cpu_arch", "cpu_cores",
+                 "memory_capacity_gb")
+    _table_name = "tidb_topology"
+
+    def __init__(self):
+        self.ip_address = ""
+        self.hostname = ""
+        self.types = ""  # 主机上每个节点的类型，比如tidb,tikv,tikv
+        self.types_count = ""  # 主机上每种类型的节点数，比如tidb(1),tikv(2)
+        self.instances = ""
+        self.cpu_arch = ""
+        self.cpu_cores = 0
+        self.memory_capacity_gb = 0.0
+        super().__init__()
+
+
+class Topology:
+    """
+    一次采集中所有采集函数共用的主机拓扑，第一次使用时加载
+    """
+
+    def __init__(self):
+        self.hosts = {}  # key:ip，value:HostTopology
+        self.hardware_ips = set()  # CLUSTER_HARDWARE中有CPU或内存信息的ip
+        self.devices = {}  # key:(ip, dm设备名)，value:(挂载点, /dev/mapper设备名)
+        self.loaded = False
+        self._lock = threading.Lock()
+
+    def load(self, conn):
+        """
+        加载拓扑，多个采集函数并发调用时只有第一个会查询数据库
+        :param conn: 数据库连接
+        :type conn: pymysql.connections.Connection
+        :rtype: Topology
+        """
+        with self._lock:
+            if not self.loaded:
+                start = time.time()
+                self._load(conn)
+                self.loaded = True
+                logging.debug(f"Load topology: {len(self.hosts)} hosts, {time.time() - start:.2f}s")
+        return self
+
+    def load_from_pool(self, pool):
+        """
+        未加载时从连接池获取连接加载拓扑
+        :type pool: dbutils.pooled_db.PooledDB
+        :rtype: Topology
+        """
+        if not self.loaded:
+            conn = pool.connection()
+            try:
+                self.load(conn)
+            finally:
+                conn.close()
+        return self
+
+    def _host(self, ip):
+        host = self.hosts.get(ip)
+        if host is None:
+            host = HostTopology()
+            host.ip_address = ip
+            self.hosts[ip] = host
+        return host
+
+    def _load(self, conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute("select type, instance from INFORMATION_SCHEMA.CLUSTER_INFO order by type, instance")
+            instances = {}
+            for node_type, instance in cursor.fetchall():
+                instances.setdefault(instance.split(":")[0], []).append((node_type, instance))
+            for ip, nodes in instances.items():
+                host = self._host(ip)
+                types = [node_type for node_type, _ in nodes]
+                host.types = ",".join(types)
+                host.types_count = ",".join(f"{node_type}({types.count(node_type)})" for node_type in dict.fromkeys(types))
+                host.instances = ",".join(instance for _, instance in nodes)
+            cursor.execute("select distinct substring_index(instance, ':', 1), value from INFORMATION_SCHEMA.CLUSTER_SYSTEMINFO "
+                           "where name = 'kernel.hostname'")
+            for ip, hostname in cursor.fetchall():
+                self._host(ip).hostname = hostname
+            cursor.execute("""select distinct substring_index(instance, ':', 1), device_type, device_name, name, value
+from INFORMATION_SCHEMA.CLUSTER_HARDWARE
+where (device_type = 'cpu' and device_name = 'cpu' and name in ('cpu-arch', 'cpu-physical-cores'))
+   or (device_type = 'memory' and device_name = 'memory' and name = 'capacity')
+   or (device_type = 'disk' and name = 'path')""")
+            disk_paths = {}
+            for ip, device_type, device_name, name, value in cursor.fetchall():
+                if device_type == "disk":
+                    disk_paths.setdefault((ip, value), []).append(device_name)
+                    continue
+                host = self._host(ip)
+                self.hardware_ips.add(ip)
+                if name == "cpu-arch":
+                    host.cpu_arch = value
+                elif name == "cpu-physical-cores":
+                    host.cpu_cores = int(value)
+                elif name == "capacity":
+                    host.memory_capacity_gb = round(int(value) / 1024 / 1024 / 1024, 1)
+            # dm设备和/dev/mapper设备挂载在同一个路径上
+            for (ip, mount_point), device_names in disk_paths.items():
+                if not mount_point.startswith("/"):
+                    continue
+                mappers = [name for name in device_names if name.startswith("/dev/mapper/")]
+                for device_name in device_names:
+                    if device_name.startswith("dm-"):
+                        for mapper in mappers:
+                            self.devices[(ip, device_name)] = (mount_point, mapper)
+        finally:
+            cursor.close()
+
+    def hostname(self, ip):
+        host = self.hosts.get(ip)
+        return host.hostname if host else None
+
+
+def get_topology(conn, topology):
+    """
+    将主机拓扑写入tidb_topology
+    :param conn: 数据库连接
+    :type conn: pymysql.connections.Connection
+    :type topology: Topology
+    :rtype: List[HostTopology]
+    """
+    hosts: List[HostTopology] = list(topology.load(conn).hosts.values())
+    return sorted(hosts, key=lambda host: host.ip_address)
@@ -19,6 +19,22 @@ def set_max_memory(max_memory=4 * 1024 * 1024 * 1024):
         return
 
 
+def get_peak_rss_mb():
+    """
+    获取当前进程的内存使用峰值(ru_maxrss)，单位：MB，不支持的平台返回0
+    :rtype: float
+    """
+    try:
+        import resource, sys
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS上ru_maxrss的单位是字节，Linux上是KB
+    if sys.platform == 'darwin':
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
 # 装饰器来给函数设置异常处理
 def catch_exception(func):
     """使用说明：
@@ -0,0 +1,223 @@
+"""
+历史快照仓库
+每次采集生成的sqlite3文件会被覆盖，无法跨天查看趋势；仓库模式下每次采集结束后把快照中的所有表追加到
+每个集群一个的仓库文件中，每行带上集群名和snapshot_id，按(cluster, snapshot_id, digest/instance/time)建索引，
+对比任意两个快照（比如慢查询digest的退化）时只走索引，不需要逐个打开历史文件。
+增量采集的文件是累积的，追加写入的表只复制比仓库中上一个快照更新的行，每个快照只包含本次采集的数据
+"""
+import logging
+import sqlite3
+from datetime import datetime, timedelta
+from pathlib import Path
+
+SNAPSHOT_TABLE = "tidb_snapshot"
+# 不追加到仓库的表：缓存和水位线只对下一次采集有意义；sqlite_开头的内部表（sqlite_sequence、analyze生成的sqlite_stat1等）另外排除
+SKIP_TABLES = {"tidb_metric_cache", "tidb_watermark"}
+# 存在这些列的表会额外建立(cluster, snapshot_id, 列)索引
+INDEX_COLUMNS = ["digest", "instance", "time"]
+
+
+def warehouse_path(warehouse_dir, cluster_name):
+    return str(Path(warehouse_dir).joinpath(f"{cluster_name}_warehouse.sqlite3"))
+
+
+def connect(path):
+    """
+    打开仓库，采集追加时报表仍然可以并发读取
+    :rtype: sqlite3.Connection
+    """
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("pragma journal_mode=WAL")
+    conn.execute("pragma synchronous=NORMAL")
+    conn.execute(f"""create table if not exists {SNAPSHOT_TABLE} (snapshot_id integer primary key autoincrement,
+                 cluster varchar(512), collect_time text, source_file text, table_count int, row_count int)""")
+    conn.execute(f"create index if not exists idx_{SNAPSHOT_TABLE}_cluster on {SNAPSHOT_TABLE} (cluster, collect_time)")
+    return conn
+
+
+def _columns(conn, schema, table):
+    """
+    :return: [(列名, 类型)]
+    :rtype: List[tuple]
+    """
+    return [(row[1], row[2]) for row in conn.execute(f"pragma {schema}.table_info({table})")]
+
+
+def _prepare_table(conn, table, columns):
+    """
+    在仓库中建表，快照中新增的列通过alter table追加，旧快照的这些列为空
+    """
+    existing = {name for name, _ in _columns(conn, "main", table)}
+    if not existing:
+        definitions = ",".join(f"{name} {column_type}" for name, column_type in columns)
+        conn.execute(f"create table {table} (cluster varchar(512), snapshot_id int, {definitions})")
+        index_columns = [name for name, _ in columns if name in INDEX_COLUMNS]
+        conn.execute(f"create index idx_{table}_snapshot on {table} (cluster, snapshot_id)")
+        for name in index_columns:
+            conn.execute(f"create index idx_{table}_{name} on {table} (cluster, snapshot_id, {name})")
+        return
+    for name, column_type in columns:
+        if name not in existing:
+            conn.execute(f"alter table {table} add column {name} {column_type}")
+
+
+def _previous_value(conn, table, column, cluster_name):
+    """
+    仓库中该表最近一个快照的column最大值（julianday），没有快照时返回None
+    """
+    if not _columns(conn, "main", table):
+        return None
+    return conn.execute(f"select max(julianday({column})) from {table} where cluster = ? and snapshot_id = "
+                        f"(select max(snapshot_id) from {table} where cluster = ?)", (cluster_name, cluster_name)).fetchone()[0]
+
+
+def append_snapshot(path, snapshot_file, cluster_name, collect_time=None, retention_days=30, incremental_columns=None):
+    """
+    把一次采集的sqlite3文件追加到仓库，并清理超过保留天数的快照
+    :param path: 仓库文件路径
+    :type path: str
+    :param snapshot_file: 本次采集的sqlite3文件
+    :type snapshot_file: str
+    :param cluster_name: 集群名
+    :type cluster_name: str
+    :param collect_time: 采集时间，默认为当前时间
+    :type collect_time: datetime
+    :param retention_days: 快照保留天数，0表示不清理
+    :type retention_days: int
+    :param incremental_columns: 增量采集时追加写入的表，key:表名，value:时间字段，只复制该字段比上一个快照新的行
+    :type incremental_columns: Dict[str, str]
+    :return: snapshot_id
+    :rtype: int
+    """
+    collect_time = collect_time or datetime.now()
+    conn = connect(path)
+    try:
+        conn.execute("attach database ? as snap", (str(snapshot_file),))
+        tables = [row[0] for row in conn.execute("select name from snap.sqlite_master where type='table' "
+                                                 "and name not like 'sqlite\\_%' escape '\\' order by name")
+                  if row[0] not in SKIP_TABLES]
+        with conn:
+            cursor = conn.execute(f"insert into {SNAPSHOT_TABLE} (cluster, collect_time, source_file, table_count, row_count) "
+                                  f"values (?, ?, ?, ?, 0)",
+                                  (cluster_name, collect_time.strftime("%Y-%m-%d %H:%M:%S"), str(snapshot_file), len(tables)))
+            snapshot_id = cursor.lastrowid
+            row_count = 0
+            for table in tables:
+                columns = _columns(conn, "snap", table)
+                names = ",".join(name for name, _ in columns)
+                column = (incremental_columns or {}).get(table)
+                previous = _previous_value(conn, table, column, cluster_name) if column else None
+                _prepare_table(conn, table, columns)
+                if previous is None:
+                    row_count += conn.execute(f"insert into main.{table} (cluster, snapshot_id, {names}) "
+                                              f"select ?, ?, {names} from snap.{table}", (cluster_name, snapshot_id)).rowcount
+                else:
+                    row_count += conn.execute(f"insert into main.{table} (cluster, snapshot_id, {names}) "
+                                              f"select ?, ?, {names} from snap.{table} where julianday({column}) > ?",
+                                              (cluster_name, snapshot_id, previous)).rowcount
+            conn.execute(f"update {SNAPSHOT_TABLE} set row_count = ? where snapshot_id = ?", (row_count, snapshot_id))
+        conn.execute("detach database snap")
+        logging.info(f"快照{snapshot_id}已追加到{path}，表数:{len(tables)}，行数:{row_count}")
+        if retention_days:
+            purge_snapshots(conn, cluster_name, collect_time - timedelta(days=retention_days))
+        return snapshot_id
+    finally:
+        conn.close()
+
+
+def purge_snapshots(conn, cluster_name, before):
+    """
+    删除before之前的快照，按(cluster, snapshot_id)索引删除
+    :type conn: sqlite3.Connection
+    :type before: datetime
+    """
+    expired = [row[0] for row in conn.execute(f"select snapshot_id from {SNAPSHOT_TABLE} where cluster = ? and collect_time < ?",
+                                              (cluster_name, before.strftime("%Y-%m-%d %H:%M:%S")))]
+    if not expired:
+        return
+    placeholders = ",".join("?" * len(expired))
+    tables = [row[0] for row in conn.execute("select name from sqlite_master where type='table' "
+                                             "and name not like 'sqlite\\_%' escape '\\'")
+              if row[0] not in SKIP_TABLES and row[0] != SNAPSHOT_TABLE]
+    with conn:
+        for table in tables:
+            conn.execute(f"delete from {table} where cluster = ? and snapshot_id in ({placeholders})", [cluster_name] + expired)
+        conn.execute(f"delete from {SNAPSHOT_TABLE} where cluster = ? and snapshot_id in ({placeholders})", [cluster_name] + expired)
+    logging.info(f"清理{cluster_name}过期快照:{expired}")
+
+
+def resolve_snapshots(conn, snapshot_id=None, baseline_id=None):
+    """
+    未指定时当前快照为最新的快照，基线为当前快照的前一个快照
+    :return: (集群名, 当前快照, 基线快照)
+    :rtype: tuple
+    """
+    if snapshot_id is None:
+        row = conn.execute(f"select cluster, snapshot_id from {SNAPSHOT_TABLE} order by snapshot_id desc limit 1").fetchone()
+    else:
+        row = conn.execute(f"select cluster, snapshot_id from {SNAPSHOT_TABLE} where snapshot_id = ?", (snapshot_id,)).fetchone()
+    if row is None:
+        raise ValueError(f"快照{snapshot_id or ''}不存在")
+    cluster_name, snapshot_id = row
+    if baseline_id is None:
+        row = conn.execute(f"select snapshot_id from {SNAPSHOT_TABLE} where cluster = ? and snapshot_id < ? "
+                           f"order by snapshot_id desc limit 1", (cluster_name, snapshot_id)).fetchone()
+        if row is None:
+            raise ValueError(f"快照{snapshot_id}之前没有可以对比的快照")
+        baseline_id = row[0]
+    return cluster_name, snapshot_id, baseline_id
+
+
+def digest_regression_sql(table, exec_column, sum_latency_column, text_column):
+    """
+    生成按digest对比两个快照平均耗时的SQL，参数依次为(cluster, 当前快照, cluster, 基线快照, 退化倍数)
+    两个快照的数据都通过(cluster, snapshot_id, digest)索引读取
+    """
+    aggregate = f"""select digest,
+                  sum({exec_column})                                 as exec_count,
+                  sum({sum_latency_column}) / nullif(sum({exec_column}), 0) as avg_latency,
+                  group_concat(distinct plan_digest)                 as plan_digests,
+                  count(distinct plan_digest)                        as plan_count,
+                  min(plan_digest)                                   as min_plan_digest,
+                  max(plan_digest)                                   as max_plan_digest,
+                  max({text_column})                                 as sql_text
+           from {table}
+           where cluster = ? and snapshot_id = ?
+           group by digest"""
+    return f"""with cur as ({aggregate}),
+     base as ({aggregate})
+select substr(cur.digest, 1, 16)                           as short_digest,
+       case when base.digest is null then 'new' else 'regressed' end as status,
+       round(base.avg_latency, 4)                          as base_avg_latency_s,
+       round(cur.avg_latency, 4)                           as cur_avg_latency_s,
+       round(cur.avg_latency / nullif(base.avg_latency, 0), 2) as ratio,
+       base.exec_count                                     as base_exec_count,
+       cur.exec_count                                      as cur_exec_count,
+       case when base.plan_count is not cur.plan_count or base.min_plan_digest is not cur.min_plan_digest
+                 or base.max_plan_digest is not cur.max_plan_digest then 1 else 0 end as plan_changed,
+       base.plan_digests                                   as base_plan_digests,
+       cur.plan_digests                                    as cur_plan_digests,
+       cur.digest,
+       cur.sql_text
+from cur
+         left join base on cur.digest = base.digest
+where base.digest is null
+   or cur.avg_latency >= base.avg_latency * ?
+order by base.digest is null, ratio desc, cur_avg_latency_s desc"""
+
+
+def compare_queries():
+    """
+    快照对比报表的查询，参数见digest_regression_sql
+    :rtype: dict
+    """
+    queries = {}
+    queries["慢查询退化"] = [
+        digest_regression_sql("tidb_slowquery", "exec_count", "sum_query_time", "query"),
+        "对比两个快照中慢查询按digest汇总的平均执行时间，ratio为当前/基线，status为new表示基线中没有该digest，plan_changed为1表示执行计划发生了变化"
+    ]
+    queries["历史SQL退化"] = [
+        digest_regression_sql("tidb_statementhistory", "exec_count", "sum_latency", "digest_text"),
+        "对比两个快照中statements_summary_history按digest汇总的平均执行时间"
+    ]
+    return queries
@@ -0,0 +1,171 @@
+"""
+持续观察锁等待和活动连接
+collect每次只拍一个快照，两次采集之间的短时锁风暴会被漏掉；watch常驻运行，每隔N秒轮询一次，
+状态没有变化时不写入，有变化时把新的状态追加到sqlite3的环形缓冲表中，超过大小上限后删除最早的记录
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+import traceback
+from datetime import datetime
+
+from .dbinfo import get_active_connection_info, get_lock_chain, get_metadata_lock_wait, to_sqlite_value
+
+WATCH_TABLE = "tidb_watch_events"
+
+
+class WatchSource:
+    """
+    观察的数据源
+    """
+
+    def __init__(self, func, every=1, ignore_fields=()):
+        """
+        :param func: 采集函数，参数为数据库连接
+        :type func: Callable[[pymysql.connections.Connection], List[BaseTable]]
+        :param every: 每every次轮询执行一次，开销大的数据源可以降低频率
+        :type every: int
+        :param ignore_fields: 随时间自然变化的字段（比如已等待时间），判断状态是否变化时忽略
+        :type ignore_fields: Iterable[str]
+        """
+        self.func = func
+        self.every = max(1, every)
+        self.ignore_fields = set(ignore_fields)
+        self.name = func.__name__
+        self.last_hash = None
+
+    def state_hash(self, rows):
+        """
+        计算状态的指纹，行的顺序不影响结果
+        :rtype: str
+        """
+        keys = sorted(repr([(key, to_sqlite_value(getattr(row, key))) for key in row.fields if key not in self.ignore_fields])
+                      for row in rows)
+        return hashlib.md5("\n".join(keys).encode("utf-8")).hexdigest()
+
+
+def default_sources(active_every=6):
+    """
+    :param active_every: 活动连接信息的SQL开销较大，每active_every次轮询执行一次
+    :rtype: List[WatchSource]
+    """
+    return [
+        WatchSource(get_lock_chain, ignore_fields=["waiting_duration_sec"]),
+        WatchSource(get_metadata_lock_wait),
+        WatchSource(get_active_connection_info, every=active_every,
+                    ignore_fields=["active_avg_time_s", "active_total_time_s", "active_total_mem_mb",
+                                   "active_total_disk_mb", "exec_count", "qps", "last_seen", "active_total_factor",
+                                   "active_total_factor_percent", "expensive_sql", "session_id_list",
+                                   "id_list_kill"]),
+    ]
+
+
+class RingBuffer:
+    """
+    sqlite3中的环形缓冲表，按payload总大小保留最新的记录
+    """
+
+    def __init__(self, conn, max_bytes):
+        """
+        :param conn: sqlite3连接
+        :type conn: sqlite3.Connection
+        :param max_bytes: payload总大小上限
+        :type max_bytes: int
+        """
+        self.conn = conn
+        self.max_bytes = max_bytes
+        conn.execute(f"""create table if not exists {WATCH_TABLE} (id integer primary key autoincrement,
+                     sample_time text, source varchar(512), state_hash varchar(64), row_count int, bytes int, payload text)""")
+        conn.execute(f"create index if not exists idx_{WATCH_TABLE}_source on {WATCH_TABLE} (source, sample_time)")
+        conn.commit()
+        # 只在启动时统计一次，之后在内存中累加
+        self.total_bytes = conn.execute(f"select coalesce(sum(bytes), 0) from {WATCH_TABLE}").fetchone()[0]
+
+    def append(self, sample_time, source, state_hash, rows):
+        payload = json.dumps([{key: to_sqlite_value(getattr(row, key)) for key in row.fields} for row in rows],
+                             ensure_ascii=False, default=str)
+        size = len(payload)
+        self.conn.execute(f"insert into {WATCH_TABLE} (sample_time, source, state_hash, row_count, bytes, payload) values (?,?,?,?,?,?)",
+                          (sample_time, source, state_hash, len(rows), size, payload))
+        self.total_bytes += size
+        self.evict()
+        self.conn.commit()
+
+    def evict(self):
+        """
+        删除最早的记录直到总大小不超过上限
+        """
+        while self.total_bytes > self.max_bytes:
+            freed = 0
+            last_id = None
+            for row_id, size in self.conn.execute(f"select id, bytes from {WATCH_TABLE} order by id limit 1000"):
+                freed += size
+                last_id = row_id
+                if self.total_bytes - freed <= self.max_bytes:
+                    break
+            if last_id is None:
+                self.total_bytes = 0
+                return
+            self.conn.execute(f"delete from {WATCH_TABLE} where id <= ?", (last_id,))
+            self.total_bytes -= freed
+
+
+def watch(pool, db_path, interval=5, sources=None, max_bytes=64 * 1024 * 1024, duration=0):
+    """
+    按固定间隔轮询数据源，状态变化时追加写入环形缓冲表
+    整个过程只使用一个连接，连接出错时归还并在下次轮询时重新获取
+    :param pool: 数据库连接池
+    :type pool: dbutils.pooled_db.PooledDB
+    :param db_path: sqlite3文件路径
+    :type db_path: str
+    :param interval: 轮询间隔，单位：秒
+    :type interval: float
+    :param sources: 数据源，默认为default_sources()
+    :type sources: List[WatchSource]
+    :param max_bytes: 环形缓冲表的大小上限，单位：字节
+    :type max_bytes: int
+    :param duration: 运行时长，单位：秒，0表示一直运行直到被中断
+    :type duration: float
+    """
+    sources = sources or default_sources()
+    sqlite_conn = sqlite3.connect(db_path)
+    buffer = RingBuffer(sqlite_conn, max_bytes)
+    conn = None
+    tick = 0
+    start = time.time()
+    try:
+        while not duration or time.time() - start < duration:
+            tick_start = time.time()
+            sample_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            for source in sources:
+                if tick % source.every:
+                    continue
+                try:
+                    if conn is None:
+                        conn = pool.connection()
+                    rows = list(source.func(conn) or [])
+                except Exception as e:
+                    # 采集失败时跳过本次采样，不记录状态变化
+                    logging.error(f"Watch {source.name} failed: {e}, {traceback.format_exc()}")
+                    if conn is not None:
+                        conn.close()
+                        conn = None
+                    continue
+                state_hash = source.state_hash(rows)
+                # 状态没有变化不写入；从有到无也是一次变化，写入一条空记录
+                if state_hash == source.last_hash or (source.last_hash is None and not rows):
+                    source.last_hash = state_hash
+                    continue
+                source.last_hash = state_hash
+                buffer.append(sample_time, source.name, state_hash, rows)
+                logging.info(f"{source.name}状态变化，行数:{len(rows)}")
+            tick += 1
+            time.sleep(max(0.0, interval - (time.time() - tick_start)))
+    except KeyboardInterrupt:
+        logging.info("watch被中断，退出")
+    finally:
+        if conn is not None:
+            conn.close()
+        sqlite_conn.close()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import pymysql
+
+# 添加checkdb目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pkg.budget import DEFAULT_BUDGET_SECONDS, BudgetStore
+from pkg.collector import CollectTask, run_collect_tasks
+from pkg.dbinfo import ER_QUERY_TIMEOUT
+
+
+class FakeCursor:
+    def execute(self, sql):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def cursor(self):
+        return FakeCursor()
+
+    def close(self):
+        pass
+
+
+class FakePool:
+    def connection(self):
+        return FakeConnection()
+
+
+def get_slow_collector(conn):
+    raise pymysql.err.OperationalError(ER_QUERY_TIMEOUT, "Query execution was interrupted, maximum statement execution time exceeded")
+
+
+class TestBudgetStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.budget_path = os.path.join(self.tmp_dir, "c1_budgets.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def collect(self):
+        budgets = BudgetStore(self.budget_path)
+        task = CollectTask(get_slow_collector)
+        task.budget = budgets.budget(task.name)
+        results = run_collect_tasks(os.path.join(self.tmp_dir, "c1.sqlite3"), FakePool(), [task])
+        for result in results:
+            budgets.record_result(result)
+        budgets.save()
+        return task.budget.seconds, results[0]
+
+    def test_timeout_without_rows_grows_budget(self):
+        first_seconds, result = self.collect()
+        self.assertEqual(first_seconds, DEFAULT_BUDGET_SECONDS)
+        self.assertEqual(result.status, "failed")
+        self.assertTrue(result.timed_out)
+        second_seconds, result = self.collect()
+        self.assertEqual(result.status, "failed")
+        self.assertGreater(second_seconds, first_seconds)
+
+
+if __name__ == '__main__':
+    unittest.main()
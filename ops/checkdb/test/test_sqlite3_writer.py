@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+# 添加checkdb目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pkg.dbinfo import NodeInfo
+from pkg.sqlite3_writer import SQLiteWriter
+
+
+class AppendTarget:
+    """
+    追加写入同一张表，和指标序列的SeriesTarget一样
+    """
+
+    def on_start(self, conn):
+        pass
+
+    def on_done(self, conn):
+        pass
+
+
+def node_infos(instance, count):
+    rows = []
+    for i in range(count):
+        node_info = NodeInfo()
+        node_info.instance = f"{instance}-{i}"
+        rows.append(node_info)
+    return rows
+
+
+class TestSQLiteWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, "c1.sqlite3")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def instances(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return sorted(row[0] for row in conn.execute("select instance from tidb_nodeinfo"))
+        finally:
+            conn.close()
+
+    def test_failed_task_rows_removed(self):
+        # 两个任务交替写入同一张表，a失败前b已经提交，a的数据不能被b的提交保留下来
+        writer = SQLiteWriter(self.db_path, incremental={"a": AppendTarget(), "b": AppendTarget()})
+        writer.start()
+        writer.put_rows("b", node_infos("b", 2))
+        writer.put_rows("a", node_infos("a", 3))
+        writer.put_rows("b", node_infos("b2", 1))
+        writer.finish("b")
+        writer.put_rows("a", node_infos("a2", 2))
+        writer.fail("a", Exception("timeout"))
+        writer.close()
+        self.assertIn("a", writer.errors)
+        self.assertNotIn("b", writer.errors)
+        self.assertEqual(self.instances(), ["b-0", "b-1", "b2-0"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import math
+import os
+import sys
+import unittest
+from datetime import datetime
+
+# 添加checkdb目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pkg.timeseries import lttb, pack_floats, pack_ints, to_epoch, unpack_floats, unpack_ints
+
+
+class TestPack(unittest.TestCase):
+    def test_ints_round_trip(self):
+        values = [0, 1, -1, 1700000000, 2 ** 63 - 1, -2 ** 63]
+        data = pack_ints(values)
+        self.assertEqual(len(data), 8 * len(values))
+        self.assertEqual(list(unpack_ints(data)), values)
+
+    def test_floats_round_trip(self):
+        values = [0.0, -1.5, 3.141592653589793, 1e300, math.inf]
+        self.assertEqual(list(unpack_floats(pack_floats(values))), values)
+        self.assertTrue(math.isnan(unpack_floats(pack_floats([math.nan]))[0]))
+
+    def test_little_endian(self):
+        self.assertEqual(pack_ints([1]), b"\x01" + b"\x00" * 7)
+
+
+class TestToEpoch(unittest.TestCase):
+    def test_formats(self):
+        expected = int(datetime(2024, 1, 2, 3, 4, 5).timestamp())
+        self.assertEqual(to_epoch("2024-01-02 03:04:05"), expected)
+        self.assertEqual(to_epoch("2024-01-02 03:04:05.250000"), expected)
+        self.assertEqual(to_epoch(datetime(2024, 1, 2, 3, 4, 5)), expected)
+        self.assertEqual(to_epoch(expected), expected)
+
+
+class TestLttb(unittest.TestCase):
+    def test_endpoints_and_size(self):
+        ts = list(range(1000))
+        values = [math.sin(i / 10.0) for i in ts]
+        selected = lttb(ts, values, 100)
+        self.assertEqual(len(selected), 100)
+        self.assertEqual(selected[0], 0)
+        self.assertEqual(selected[-1], 999)
+        self.assertEqual(selected, sorted(set(selected)))
+
+    def test_keeps_peak(self):
+        ts = list(range(500))
+        values = [0.0] * 500
+        values[250] = 100.0
+        self.assertIn(250, lttb(ts, values, 20))
+
+    def test_small_input(self):
+        self.assertEqual(lttb([1, 2, 3], [1.0, 2.0, 3.0], 10), [0, 1, 2])
+        self.assertEqual(lttb(list(range(10)), [0.0] * 10, 2), list(range(10)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+# 添加checkdb目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pkg.sqlite3_writer import finalize_db
+from pkg.warehouse import SNAPSHOT_TABLE, append_snapshot, purge_snapshots, connect
+
+
+class TestAppendSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.warehouse = os.path.join(self.tmp_dir, "test_warehouse.sqlite3")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_snapshot(self, name, digests):
+        """
+        生成一个和采集结果一样经过finalize_db（会建立sqlite_stat1）的快照
+        """
+        path = os.path.join(self.tmp_dir, name)
+        conn = sqlite3.connect(path)
+        conn.execute("create table tidb_slowquery (digest text, exec_count int)")
+        conn.execute("create table tidb_watermark (name text primary key, value text)")
+        conn.execute("create table tidb_events (id integer primary key autoincrement, msg text)")
+        conn.executemany("insert into tidb_slowquery values (?, ?)", [(digest, 1) for digest in digests])
+        conn.execute("insert into tidb_events (msg) values ('x')")
+        conn.commit()
+        conn.close()
+        finalize_db(path, [("tidb_slowquery", ["digest"])])
+        return path
+
+    def test_append_finalized_snapshot(self):
+        snapshot = self.make_snapshot("s1.sqlite3", ["a", "b"])
+        conn = sqlite3.connect(snapshot)
+        internal = {row[0] for row in conn.execute("select name from sqlite_master where name like 'sqlite_%'")}
+        conn.close()
+        self.assertIn("sqlite_stat1", internal)
+        first = append_snapshot(self.warehouse, snapshot, "c1", retention_days=0)
+        second = append_snapshot(self.warehouse, self.make_snapshot("s2.sqlite3", ["a"]), "c1", retention_days=0)
+        conn = connect(self.warehouse)
+        try:
+            counts = dict(conn.execute("select snapshot_id, count(*) from tidb_slowquery group by snapshot_id"))
+            self.assertEqual(counts, {first: 2, second: 1})
+            self.assertEqual(conn.execute("select table_count from tidb_snapshot where snapshot_id = ?", (first,)).fetchone()[0], 2)
+            tables = {row[0] for row in conn.execute("select name from sqlite_master where type='table'")}
+            self.assertNotIn("tidb_watermark", tables)
+        finally:
+            conn.close()
+
+    def test_purge_snapshots(self):
+        snapshot = self.make_snapshot("s1.sqlite3", ["a"])
+        old = append_snapshot(self.warehouse, snapshot, "c1", collect_time=datetime.now() - timedelta(days=40), retention_days=0)
+        new = append_snapshot(self.warehouse, snapshot, "c1", retention_days=30)
+        conn = connect(self.warehouse)
+        try:
+            self.assertEqual([row[0] for row in conn.execute(f"select snapshot_id from {SNAPSHOT_TABLE}")], [new])
+            self.assertEqual([row[0] for row in conn.execute("select distinct snapshot_id from tidb_slowquery")], [new])
+            purge_snapshots(conn, "c1", datetime.now() + timedelta(days=1))
+            self.assertEqual(conn.execute("select count(*) from tidb_events").fetchone()[0], 0)
+        finally:
+            conn.close()
+        self.assertNotEqual(old, new)
+
+
+    def test_append_incremental_snapshot(self):
+        # 增量采集（--incremental）的文件是累积的，仓库（--warehouse）中每个快照只保留本次采集的行
+        path = os.path.join(self.tmp_dir, "c1.sqlite3")
+        conn = sqlite3.connect(path)
+        conn.execute("create table tidb_slowquery (digest text, first_seen text, exec_count int)")
+        conn.execute("create table tidb_nodeinfo (instance text)")
+        conn.executemany("insert into tidb_slowquery values (?, ?, ?)",
+                         [("a", "2026-10-01 10:00:00", 1), ("b", "2026-10-01 11:00:00.123456", 1)])
+        conn.execute("insert into tidb_nodeinfo values ('tidb-0')")
+        conn.commit()
+        columns = {"tidb_slowquery": "first_seen"}
+        first = append_snapshot(self.warehouse, path, "c1", retention_days=0, incremental_columns=columns)
+        conn.execute("insert into tidb_slowquery values ('a', '2026-10-01 12:00:00', 5)")
+        conn.commit()
+        conn.close()
+        second = append_snapshot(self.warehouse, path, "c1", retention_days=0, incremental_columns=columns)
+        conn = connect(self.warehouse)
+        try:
+            counts = dict(conn.execute("select snapshot_id, count(*) from tidb_slowquery group by snapshot_id"))
+            self.assertEqual(counts, {first: 2, second: 1})
+            self.assertEqual(conn.execute("select exec_count from tidb_slowquery where snapshot_id = ?", (second,)).fetchone()[0], 5)
+            # 不在incremental_columns中的表仍然完整复制
+            counts = dict(conn.execute("select snapshot_id, count(*) from tidb_nodeinfo group by snapshot_id"))
+            self.assertEqual(counts, {first: 1, second: 1})
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,6 +8,7 @@
 # ******************复用get_table_size代码***********************
 # 这里避免调用直接放到当前文件中
 import argparse
+import binascii
 import json
 import logging as log
 import os.path
@@ -23,12 +24,14 @@ isV3 = float(sys.version[:3]) > 2.7
 
 if not isV3:
     import urllib as request
-    from Queue import Queue
+    from Queue import Queue, Empty
 else:
     import urllib.request as request
-    from queue import Queue
+    from queue import Queue, Empty
 
-region_queue = Queue(100)  # 内容为（dbname,tabname,region_id）的元组
+region_queue = Queue(100)  # 内容为（dbname,tabname,leader_node_id,[region_id]）的元组，同一个leader store的region一批
+REGION_PROPERTIES_BATCH = 64  # 一次tikv-ctl调用查询的region数
+REGION_PROPERTIES_MARKER = "__region_properties__"  # 批量查询时每个region输出前的分隔行
 
 
 def command_run(command, use_temp=False, timeout=30):
@@ -276,6 +279,8 @@ class TableInfo:
 class Region:
     def __init__(self):
         self.region_id = 0
+        self.version = 0  # region_epoch.version，region分裂或合并后会增加
+        self.conf_ver = 0  # region_epoch.conf_ver，peer增加、删除（迁移）后会增加
         self.leader_id = 0
         self.leader_store_id = 0
         self.leader_store_node_id = ""
@@ -309,6 +314,7 @@ class TiDBCluster:
         self._get_clusterinfo()
         self.ctl_version = self.get_ctl_version()
         self._check_env()
+        self.tikv_ctl = self.get_tikv_ctl()
         self._sstfiles_list = []
         self._get_store_sstfiles_bystoreall_once = False  # 是否调用过get_store_sstfiles_bystoreall方法，如果调用过则说明_sstfiles_list包含所有的sstfile文件信息，不需要重复执行
         self._table_region_map = {}  # 所有表的region信息
@@ -462,6 +468,8 @@ class TiDBCluster:
                         region.region_id = each_region["region_id"]
                         region.leader_id = each_region["leader"]["id"]
                         region.leader_store_id = each_region["leader"]["store_id"]
+                        region.version = each_region.get("region_epoch", {}).get("version", 0)
+                        region.conf_ver = each_region.get("region_epoch", {}).get("conf_ver", 0)
                         for each_peer in each_region["peers"]:
                             # 避免引入tiflash
                             if "role" in each_peer and each_peer["role"] == 1:
@@ -485,6 +493,8 @@ class TiDBCluster:
                             region.region_id = each_region["region_id"]
                             region.leader_id = each_region["leader"]["id"]
                             region.leader_store_id = each_region["leader"]["store_id"]
+                            region.version = each_region.get("region_epoch", {}).get("version", 0)
+                            region.conf_ver = each_region.get("region_epoch", {}).get("conf_ver", 0)
                             for each_peer in each_region["peers"]:
                                 if "role" in each_peer and each_peer["role"] == 1:
                                     continue
@@ -525,10 +535,16 @@ class TiDBCluster:
                 if full_tabname not in table_region_map:
                     log.error("table:%s not maybe not exists!" % (full_tabname))
                     continue
-                for region_id in table_region_map[full_tabname].all_region_map.keys():
-                    region_queue.put((dbname, tabname, region_id))
-                    log.debug("put region into region_queue:%s" % (region_id))
+                # 按leader store分批，每批一次tikv-ctl调用
+                leader_region_map = {}  # key:leader_node_id,value:[region_id]
+                for region_id, region in table_region_map[full_tabname].all_region_map.items():
+                    leader_region_map.setdefault(region.leader_store_node_id, []).append(region_id)
                     tabname_list_region_count += 1
+                for leader_node_id, region_id_list in leader_region_map.items():
+                    for i in range(0, len(region_id_list), REGION_PROPERTIES_BATCH):
+                        region_queue.put(
+                            (dbname, tabname, leader_node_id, region_id_list[i:i + REGION_PROPERTIES_BATCH]))
+                        log.debug("put regions into region_queue:%s,%s" % (leader_node_id, region_id_list[i]))
             for i in range(parallel):
                 # signal close region_queue
                 log.debug("put region into region_queue:None")
@@ -647,6 +663,49 @@ class TiDBCluster:
         self._stores = stores
         return self._stores
 
+    # 从PD获取region的起止key（PD中为编码后的key，接口返回16进制字符串），region不存在时返回None
+    # 返回：(start_key, end_key)，均为bytes，end_key为空表示到最后
+    def get_region_keys(self, region_id):
+        req = ""
+        for node in self.tidb_nodes:
+            if node.role == "pd":
+                req = "http://%s:%s/pd/api/v1/region/id/%d" % (node.host, node.service_port, region_id)
+                break
+        if req == "":
+            log.error("cannot find pd,region_id:%d" % (region_id))
+            return None
+        json_data, err = get_jsondata_from_url(req)
+        if err is not None or not json_data or "start_key" not in json_data:
+            log.warning("cannot get region keys from pd,url:%s,message:%s" % (req, err))
+            return None
+        return bytearray.fromhex(json_data["start_key"]), bytearray.fromhex(json_data.get("end_key", ""))
+
+    # 并发从PD获取多个region的起止key，返回：key:region_id,value:(start_key, end_key)，获取不到的region不包含在内
+    def get_regions_keys(self, region_ids, parallel=16):
+        region_keys_map = {}
+        region_id_queue = Queue()
+        for region_id in region_ids:
+            region_id_queue.put(region_id)
+
+        def target():
+            while True:
+                try:
+                    region_id = region_id_queue.get_nowait()
+                except Empty:
+                    return
+                region_keys = self.get_region_keys(region_id)
+                if region_keys is not None:
+                    region_keys_map[region_id] = region_keys
+
+        threads = []
+        for i in range(min(parallel, len(region_ids))):
+            t = threading.Thread(target=target)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        return region_keys_map
+
     # 根据sstfile文件名去tikv上获取文件大小
     # 入参：[SSTFile]
     def get_store_sstfiles_bysstfilelist(self, sstfiles):
@@ -728,7 +787,8 @@ class TiDBCluster:
     # 获取提供的region信息，多线程获取property信息
     # 入参：
     # table_region_map为以dbname+"."+tabname为key，TableInfo为value的字典
-    # region_queue中获取region信息（dbname,tablename,region_id)，修改table_region_map，补充sstfile相关信息
+    # region_queue中获取同一个leader store上的一批region信息（dbname,tablename,leader_node_id,[region_id])，修改table_region_map，补充sstfile相关信息
+    # 一批region在一次shell调用中循环执行tikv-ctl region-properties，输出按REGION_PROPERTIES_MARKER分隔
     def get_leader_region_sstfiles_muti(self, table_region_map, region_queue, thread_id=0):
         log.debug("thread_id:%d,get_leader_region_sstfiles_muti start" % (thread_id))
         while True:
@@ -736,52 +796,108 @@ class TiDBCluster:
             if data is None:
                 log.debug("thread_id:%d,get_leader_region_sstfiles_muti done" % (thread_id))
                 return
-            # (tabname, leader_node_id, region_id) = data
-            (dbname, tabname, region_id) = data
+            (dbname, tabname, leader_node_id, region_id_list) = data
             full_tabname = dbname + "." + tabname
             table_info = table_region_map[full_tabname]
-            region = table_info.all_region_map[region_id]
-            leader_node_id = region.leader_store_node_id
-            sstfiles = []
-            cmd = "tiup ctl:%s tikv --host %s region-properties -r %d" % (
-                self.ctl_version, leader_node_id, region_id)
-            result, recode = command_run(cmd)
-            # cannot find region when region split or region merge
-            if recode != 0:
+            sstfilename_map = {}  # key:region_id,value:[sstfile名]
+            cmd = "for region_id in %s; do echo %s $region_id; %s --host %s region-properties -r $region_id 2>&1; done" % (
+                " ".join([str(region_id) for region_id in region_id_list]), REGION_PROPERTIES_MARKER,
+                self.tikv_ctl, leader_node_id)
+            result, recode = command_run(cmd, timeout=30 + 5 * len(region_id_list))
+            output_map = self._split_region_properties(result)
+            if len(output_map) == 0:
                 log.warning("cmd:%s,message:%s" % (cmd, result))
-            else:
-                for each_line in result.splitlines():
-                    if each_line.find("sst_files:") > -1:
-                        # 如果tikv-ctl region properties的结果中包含sst_files开头的说明打印的结果只包含了writecf的sst文件
-                        if each_line.find("sst_files:") == 0 and not self.property_only_writecf_mode:
-                            self.property_only_writecf_mode = True
-                            log.info("property_only_writecf_mode:%s" % (self.property_only_writecf_mode))
-                        each_line_fields = each_line.split(":")
-                        each_line_fields_len = len(each_line_fields)
-                        if each_line_fields_len == 2 and each_line_fields[1] != "":
-                            for sstfilename in [x.strip() for x in each_line_fields[1].split(",")]:
-                                if sstfilename == "":
-                                    continue
-                                sstfile = SSTFile()
-                                sstfile.sst_name = sstfilename
-                                sstfile.region_id_list.append(region_id)
-                                sstfile.sst_node_id = leader_node_id
-                                sstfiles.append(sstfile)
-            if len(sstfiles) == 0:
-                log.debug(
-                    "region-properties:tabname:%s,region:%d's sstfile cannot found,cmd:%s" % (tabname, region_id, cmd))
-            table_region_map[full_tabname].all_region_map[region_id].sstfile_list = sstfiles
+            for region_id in region_id_list:
+                # cannot find region when region split or region merge
+                sstfilenames = self._parse_region_properties(output_map.get(region_id, ""))
+                if sstfilenames is None:
+                    log.debug("region-properties:tabname:%s,region:%d's property cannot found,message:%s" % (
+                        tabname, region_id, output_map.get(region_id, "")))
+                    sstfilenames = []
+                sstfilename_map[region_id] = sstfilenames
+            for region_id in region_id_list:
+                sstfiles = []
+                for sstfilename in sstfilename_map[region_id]:
+                    sstfile = SSTFile()
+                    sstfile.sst_name = sstfilename
+                    sstfile.region_id_list.append(region_id)
+                    sstfile.sst_node_id = leader_node_id
+                    sstfiles.append(sstfile)
+                if len(sstfiles) == 0:
+                    log.debug("region-properties:tabname:%s,region:%d's sstfile cannot found" % (tabname, region_id))
+                table_info.all_region_map[region_id].sstfile_list = sstfiles
             region_queue.task_done()
 
+    # 按REGION_PROPERTIES_MARKER拆分批量查询的输出
+    # 返回：key:region_id,value:该region的region-properties输出
+    def _split_region_properties(self, result):
+        output_map = {}
+        region_id = None
+        for each_line in result.splitlines():
+            if each_line.startswith(REGION_PROPERTIES_MARKER):
+                each_line_fields = each_line.split()
+                region_id = int(each_line_fields[1]) if len(each_line_fields) == 2 else None
+                if region_id is not None:
+                    output_map[region_id] = []
+                continue
+            if region_id is not None:
+                output_map[region_id].append(each_line)
+        return dict([(region_id, "\n".join(lines)) for region_id, lines in output_map.items()])
+
+    # 解析一个region的region-properties输出，返回sstfile名列表，输出中没有sst_files时返回None
+    def _parse_region_properties(self, output):
+        sstfilenames = None
+        for each_line in output.splitlines():
+            if each_line.find("sst_files:") > -1:
+                # 如果tikv-ctl region properties的结果中包含sst_files开头的说明打印的结果只包含了writecf的sst文件
+                if each_line.find("sst_files:") == 0 and not self.property_only_writecf_mode:
+                    self.property_only_writecf_mode = True
+                    log.info("property_only_writecf_mode:%s" % (self.property_only_writecf_mode))
+                if sstfilenames is None:
+                    sstfilenames = []
+                each_line_fields = each_line.split(":")
+                each_line_fields_len = len(each_line_fields)
+                if each_line_fields_len == 2 and each_line_fields[1] != "":
+                    for sstfilename in [x.strip() for x in each_line_fields[1].split(",")]:
+                        if sstfilename == "":
+                            continue
+                        sstfilenames.append(sstfilename)
+        return sstfilenames
+
     def get_cf_info(self):
         if self.property_only_writecf_mode is not True:
             return None
-        node_id = ""
+        return CFInfo(self.get_prometheus_node_id())
+
+    # 返回prometheus的host:port，没有prometheus时返回空字符串
+    def get_prometheus_node_id(self):
         for nd in self.tidb_nodes:
             if nd.role == "prometheus":
-                node_id = nd.id
-                break
-        return CFInfo(node_id)
+                return nd.id
+        return ""
+
+    # prometheus中tikv指标的instance标签为host:status_port，store地址为host:service_port
+    # 返回：key:store地址,value:instance
+    def get_tikv_instance_map(self):
+        instance_map = {}
+        for nd in self.tidb_nodes:
+            if nd.role == "tikv":
+                instance_map["%s:%s" % (nd.host, nd.service_port)] = "%s:%s" % (nd.host, nd.status_port)
+        return instance_map
+
+    # 直接执行ctl组件目录下的tikv-ctl，避免每次调用都经过tiup启动（每次几百毫秒），找不到时仍然使用tiup ctl
+    def get_tikv_ctl(self):
+        cmd = "tiup --binary ctl:%s" % (self.ctl_version)
+        result, recode = command_run(cmd)
+        if recode == 0:
+            lines = [line.strip() for line in result.splitlines() if line.strip() != ""]
+            if len(lines) != 0:
+                tikv_ctl = os.path.join(os.path.dirname(lines[-1]), "tikv-ctl")
+                if os.path.isfile(tikv_ctl):
+                    log.debug("tikv-ctl:%s" % (tikv_ctl))
+                    return tikv_ctl
+        log.warning("cannot find tikv-ctl binary,use tiup ctl,cmd:%s,message:%s" % (cmd, result))
+        return "tiup ctl:%s tikv" % (self.ctl_version)
 
     # 当前的cluster的version并不一定和ctl的版本一致，因此查找最接近当前cluster version版本的已安装的ctl版本
     def get_ctl_version(self):
@@ -923,17 +1039,52 @@ class OutPutShow():
 # ************compact单独代码*******************
 
 
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return "%ds" % (seconds)
+    elif seconds < 3600:
+        return "%dm%ds" % (seconds // 60, seconds % 60)
+    else:
+        return "%dh%dm" % (seconds // 3600, seconds % 3600 // 60)
+
+
+# tikv-ctl compact --from/--to使用RocksDB中的key：'z'前缀加上编码后的key，按tikv-ctl的转义格式（八进制）传入
+def escape_data_key(key):
+    escaped = ["z"]
+    for b in bytearray(key):
+        c = chr(b)
+        if b < 128 and (c.isalnum() or c == "_"):
+            escaped.append(c)
+        else:
+            escaped.append("\\%03o" % b)
+    return "".join(escaped)
+
+
+COMPACT_COLUMN_FAMILIES = ['default', 'write']
+
+
 # 返回总compact次数和失败次数
-def tiup_ctl_tikv_run(cluster, address, region_id, threads=4):
+# ctl_version使用TiDBCluster初始化时获取的版本，避免每次compact都执行tiup list
+# key_range不为空时按(start_key, end_key)范围compact，region_count为范围内的region数，用于计算超时时间
+# column_family_list为空时compact default和write
+def tiup_ctl_tikv_run(cluster, address, region_id, threads=4, key_range=None, region_count=1, column_family_list=None):
     total_compact_count = 0
     err_compact_count = 0
-    ctl_version = cluster.get_ctl_version()
-    column_family_list = ['default', 'write']
+    ctl_version = cluster.ctl_version
+    if column_family_list is None:
+        column_family_list = COMPACT_COLUMN_FAMILIES
     rocksdb_list = ['kv']  # 'kv' or 'raft'
+    if key_range is None:
+        target = "-r %d" % (region_id)
+    else:
+        target = "--from '%s'" % (escape_data_key(key_range[0]))
+        if len(key_range[1]) != 0:
+            target += " --to '%s'" % (escape_data_key(key_range[1]))
     for (family, rocksdb) in [(family, rocksdb) for rocksdb in rocksdb_list for family in column_family_list]:
-        cmd = "tiup ctl:%s tikv --host %s compact -r %d -c %s -d %s --bottommost force --threads %d" % (
-            ctl_version, address, region_id, family, rocksdb, threads)
-        result, recode = command_run(cmd)
+        cmd = "tiup ctl:%s tikv --host %s compact %s -c %s -d %s --bottommost force --threads %d" % (
+            ctl_version, address, target, family, rocksdb, threads)
+        result, recode = command_run(cmd, timeout=30 * region_count)
         total_compact_count += 1
         if recode != 0:
             log.warning("compact error! cmd:%s,message:%s" % (cmd, result))
@@ -943,39 +1094,640 @@ def tiup_ctl_tikv_run(cluster, address, region_id, threads=4):
     return total_compact_count, err_compact_count
 
 
-def compact_tables(cluster_name, table_list, threads):
-    table_compact_err_count_map = {}  # 记录每张表一共执行多少次compact和失败了多少次
+# 一个store上的compact任务，按region或者按合并后的key范围执行
+class CompactTask:
+    def __init__(self):
+        self.tabname = ""  # dbname.tabname
+        self.region_id = 0
+        self.peer_id = 0
+        self.store_id = 0
+        self.address = ""
+        self.key_range = None  # (start_key, end_key)，为None时按region_id执行
+        self.key_span = None  # 任务覆盖的(start_key, end_key)，按region_id执行时为region的起止key，未知时为None
+        self.region_ids = []  # key范围内的region
+        self.version_map = {}  # key:region_id,value:规划时的(region_epoch.version, region_epoch.conf_ver)
+        self.column_families = list(COMPACT_COLUMN_FAMILIES)  # 未完成的cf
+        self.item_ids = {}  # key:cf,value:journal中的item_id
+
+    def describe(self):
+        if self.key_range is None:
+            return "region_id:%d" % (self.region_id)
+        return "range of %d regions from region_id:%d" % (len(self.region_ids), self.region_ids[0])
+
+
+# 将一张表的region按start_key排序，首尾相接的region合并为一个范围，每个范围最多max_regions个region
+# 入参：[(start_key, end_key, region_id)]
+# 返回：[(start_key, end_key, [region_id])]
+def merge_key_ranges(region_keys, max_regions=256):
+    ranges = []
+    for start_key, end_key, region_id in sorted(region_keys, key=lambda x: x[0]):
+        if len(ranges) != 0:
+            last_start, last_end, last_region_ids = ranges[-1]
+            if len(last_end) != 0 and last_end == start_key and len(last_region_ids) < max_regions:
+                ranges[-1] = (last_start, end_key, last_region_ids + [region_id])
+                continue
+        ranges.append((start_key, end_key, [region_id]))
+    return ranges
+
+
+# journal中region_versions的格式为region_id:version:conf_ver，多个region以逗号分隔
+# 返回：[(region_id, (version, conf_ver))]
+def parse_region_versions(region_versions):
+    result = []
+    for each in region_versions.split(","):
+        fields = [int(field) for field in each.split(":")]
+        result.append((fields[0], (fields[1], fields[2] if len(fields) > 2 else 0)))
+    return result
+
+
+# 两个(start_key, end_key)范围是否重叠，end_key为空表示到最后
+def key_ranges_overlap(a, b):
+    return (len(b[1]) == 0 or a[0] < b[1]) and (len(a[1]) == 0 or b[0] < a[1])
+
+
+# compact断点记录，每个(表, store, region或key范围, cf)一行，status为pending/done/failed/stale
+# 一轮compact全部成功后清理该表的记录；中断或者有失败时保留，下次执行只处理未完成（pending/failed）的条目
+class CompactJournal:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # 多个store的工作线程共用一个连接，写入时加锁
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        create_table_ddl = '''
+        create table if not exists compact_journal (
+        item_id integer primary key autoincrement,
+        task_id int,
+        tabname varchar(255),
+        store_id int,
+        address varchar(255),
+        peer_id int,
+        region_id int,
+        region_versions text,
+        start_key text,
+        end_key text,
+        by_range int,
+        cf varchar(30),
+        status varchar(10),
+        attempts int,
+        message text,
+        update_time timestamp
+        );
+        '''
+        self.conn.execute(create_table_ddl)
+        # 旧版本的journal只记录按范围执行的任务的起止key
+        columns = [row[1] for row in self.conn.execute("pragma table_info(compact_journal)")]
+        if "by_range" not in columns:
+            self.conn.execute("alter table compact_journal add column by_range int")
+            self.conn.execute("update compact_journal set by_range=(start_key is not null)")
+        self.conn.execute("create index if not exists idx_compact_journal on compact_journal (tabname,status)")
+        self.conn.commit()
+
+    def has_table(self, tabname):
+        with self._lock:
+            row = self.conn.execute("select count(*) from compact_journal where tabname=?", (tabname,)).fetchone()
+        return row[0] != 0
+
+    # 写入新规划的任务，每个cf一行，同时记录item_id
+    def add(self, tasks):
+        with self._lock:
+            task_id = self.conn.execute("select coalesce(max(task_id),0) from compact_journal").fetchone()[0]
+            for task in tasks:
+                task_id += 1
+                region_versions = ",".join(["%d:%d:%d" % ((region_id,) + task.version_map.get(region_id, (0, 0)))
+                                            for region_id in task.region_ids])
+                start_key, end_key = None, None
+                if task.key_span is not None:
+                    start_key = binascii.hexlify(bytes(task.key_span[0])).decode()
+                    end_key = binascii.hexlify(bytes(task.key_span[1])).decode()
+                by_range = 1 if task.key_range is not None else 0
+                for cf in task.column_families:
+                    cur = self.conn.execute('''insert into compact_journal 
+                    (task_id,tabname,store_id,address,peer_id,region_id,region_versions,start_key,end_key,by_range,cf,status,
+                    attempts,update_time)
+                    values (?,?,?,?,?,?,?,?,?,?,?,'pending',0,datetime('now','localtime'))''', (
+                        task_id, task.tabname, task.store_id, task.address, task.peer_id, task.region_id,
+                        region_versions, start_key, end_key, by_range, cf))
+                    task.item_ids[cf] = cur.lastrowid
+            self.conn.commit()
+
+    # 读取表未完成的条目，同一个task_id的条目还原为一个CompactTask
+    def unfinished_tasks(self, tabname):
+        with self._lock:
+            rows = self.conn.execute('''select item_id,task_id,store_id,address,peer_id,region_id,region_versions,
+            start_key,end_key,by_range,cf from compact_journal where tabname=? and status in ('pending','failed') 
+            order by task_id,item_id''', (tabname,)).fetchall()
+        task_map = {}
+        tasks = []
+        for item_id, task_id, store_id, address, peer_id, region_id, region_versions, start_key, end_key, by_range, cf in rows:
+            if task_id not in task_map:
+                task = CompactTask()
+                task.tabname = tabname
+                task.store_id = store_id
+                task.address = address
+                task.peer_id = peer_id
+                task.region_id = region_id
+                task.column_families = []
+                for each_region_id, epoch in parse_region_versions(region_versions):
+                    task.region_ids.append(each_region_id)
+                    task.version_map[each_region_id] = epoch
+                if start_key is not None:
+                    task.key_span = (bytearray.fromhex(start_key), bytearray.fromhex(end_key))
+                    if by_range:
+                        task.key_range = task.key_span
+                task_map[task_id] = task
+                tasks.append(task)
+            task_map[task_id].column_families.append(cf)
+            task_map[task_id].item_ids[cf] = item_id
+        return tasks
+
+    # 表中未过期条目规划时的region版本，key:region_id,value:(version, conf_ver)
+    def region_epochs(self, tabname):
+        epoch_map = {}
+        with self._lock:
+            rows = self.conn.execute("select distinct region_versions from compact_journal where tabname=? and status!='stale'",
+                                     (tabname,)).fetchall()
+        for (region_versions,) in rows:
+            for region_id, epoch in parse_region_versions(region_versions):
+                epoch_map[region_id] = epoch
+        return epoch_map
+
+    # 表中所有条目（包括已完成和过期的）的store和覆盖范围
+    # 返回：(key:region_id,value:set(store_id), [(store_id, (start_key, end_key))])
+    def store_coverage(self, tabname):
+        region_store_map = {}
+        store_spans = []
+        with self._lock:
+            rows = self.conn.execute("select distinct store_id,region_versions,start_key,end_key from compact_journal "
+                                     "where tabname=?", (tabname,)).fetchall()
+        for store_id, region_versions, start_key, end_key in rows:
+            for region_id, epoch in parse_region_versions(region_versions):
+                region_store_map.setdefault(region_id, set()).add(store_id)
+            if start_key is not None:
+                store_spans.append((store_id, (bytearray.fromhex(start_key), bytearray.fromhex(end_key))))
+        return region_store_map, store_spans
+
+    def update(self, task, cf, status, message=""):
+        with self._lock:
+            self.conn.execute('''update compact_journal set status=?,attempts=attempts+1,message=?,
+            update_time=datetime('now','localtime') where item_id=?''', (status, message, task.item_ids[cf]))
+            self.conn.commit()
+
+    def mark_stale(self, tasks):
+        with self._lock:
+            for task in tasks:
+                for item_id in task.item_ids.values():
+                    self.conn.execute('''update compact_journal set status='stale',
+                    update_time=datetime('now','localtime') where item_id=?''', (item_id,))
+            self.conn.commit()
+
+    # 返回：{status: 条目数}
+    def status_count(self, tabname):
+        with self._lock:
+            rows = self.conn.execute("select status,count(*) from compact_journal where tabname=? group by status",
+                                     (tabname,)).fetchall()
+        return dict(rows)
+
+    def clear(self, tabname):
+        with self._lock:
+            self.conn.execute("delete from compact_journal where tabname=?", (tabname,))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+# compact进度，所有store的工作线程共用
+class CompactProgress:
+    def __init__(self, total, interval=30):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.interval = interval  # 两次打印进度之间的最小间隔（秒）
+        self.start_time = time.time()
+        self._last_log_time = 0
+        self._lock = threading.Lock()
+
+    def update(self, task, ok):
+        with self._lock:
+            self.done += 1
+            if not ok:
+                self.failed += 1
+            now = time.time()
+            if now - self._last_log_time < self.interval and self.done != self.total:
+                return
+            self._last_log_time = now
+            elapsed = now - self.start_time
+            eta = elapsed / self.done * (self.total - self.done)
+            log.info("compact progress:%d/%d(%.1f%%),failed:%d,elapsed:%s,eta:%s,last:table:%s,%s,store:%s" % (
+                self.done, self.total, 100.0 * self.done / self.total, self.failed, format_duration(elapsed),
+                format_duration(eta), task.tabname, task.describe(), task.address))
+
+
+# 按store负载限流时的指标上限，任一指标超过上限时该store的并发减半，全部低于上限的THROTTLE_HEADROOM倍时并发加1
+THROTTLE_CEILINGS = {
+    "disk_util": 0.8,  # 所在主机磁盘io时间占比的最大值
+    "pending_compaction_bytes": 64 * 1024 * 1024 * 1024,  # kv rocksdb待compact的数据量
+    "scheduler_p99": 0.1,  # scheduler命令的99分位耗时（秒）
+}
+THROTTLE_HEADROOM = 0.8
+THROTTLE_QUERIES = {
+    "disk_util": 'max(rate(node_disk_io_time_seconds_total[1m]))by(instance)',
+    "pending_compaction_bytes": 'sum(tikv_engine_pending_compaction_bytes{db="kv"})by(instance)',
+    "scheduler_p99": 'histogram_quantile(0.99,sum(rate(tikv_scheduler_command_duration_seconds_bucket[1m]))by(le,instance))',
+}
+
+
+# 从prometheus获取每个store的负载指标
+# node_exporter的instance为host:9100，按主机匹配；tikv指标的instance为host:status_port，按instance匹配
+class StoreLoadSampler:
+    def __init__(self, prometheus_node_id, instance_map):
+        self.prometheus_node_id = prometheus_node_id
+        self.instance_map = instance_map  # key:store地址,value:tikv的instance
+
+    def _query(self, query):
+        url = 'http://%s/api/v1/query?query=%s' % (self.prometheus_node_id, request.quote(query))
+        json_data, err = get_jsondata_from_url(url)
+        if err is not None:
+            log.warning("query prometheus error,url:%s,message:%s" % (url, err))
+            return None
+        value_map = {}  # key:instance,value:指标值
+        try:
+            for each_item in json_data["data"]["result"]:
+                value = float(each_item["value"][1])
+                if value == value:  # 过滤NaN
+                    value_map[each_item["metric"].get("instance", "")] = value
+        except Exception as e:
+            log.warning("parse prometheus data error,url:%s,message:%s" % (url, e))
+            return None
+        return value_map
+
+    # 返回：key:store地址,value:{指标名:指标值}，查询失败或者没有数据的指标不包含在内
+    def sample(self, addresses):
+        samples = dict([(address, {}) for address in addresses])
+        for name, query in THROTTLE_QUERIES.items():
+            value_map = self._query(query)
+            if value_map is None:
+                continue
+            for address in addresses:
+                instance = self.instance_map.get(address, address)
+                if instance in value_map:
+                    samples[address][name] = value_map[instance]
+                    continue
+                # 按主机匹配，同一主机上有多个实例时取最大值
+                host = instance.split(":")[0]
+                values = [value for each_instance, value in value_map.items() if each_instance.split(":")[0] == host]
+                if len(values) != 0:
+                    samples[address][name] = max(values)
+        return samples
+
+
+# 按store负载调整每个store的compact并发（AIMD）
+# 每interval秒采样一次：任一指标超过上限时并发减半（可以降到0，暂停该store），全部指标有余量时并发加1，最大为max_concurrency
+# 查询失败或者没有数据的指标（空闲集群的scheduler p99为NaN、prometheus不可用）视为没有超过上限，
+# 一个指标都没有时不增加并发，只让暂停的store恢复到1
+# 暂停超过max_pause秒后（例如一直采样失败）强制恢复到1，避免任务永远阻塞
+class CompactThrottle:
+    def __init__(self, sampler, max_concurrency, ceilings=None, interval=30, max_pause=600):
+        self.sampler = sampler
+        self.max_concurrency = max_concurrency
+        self.ceilings = ceilings or THROTTLE_CEILINGS
+        self.interval = interval
+        self.max_pause = max_pause
+        self.limit_map = {}  # key:store地址,value:当前允许的并发
+        self.running_map = {}  # key:store地址,value:正在执行的compact数
+        self.pause_time_map = {}  # key:暂停的store地址,value:暂停开始的时间
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def acquire(self, address):
+        with self._cond:
+            while self.running_map[address] >= self.limit_map[address]:
+                self._resume_paused(address)
+                if self.running_map[address] < self.limit_map[address]:
+                    break
+                self._cond.wait(1)
+            self.running_map[address] += 1
+
+    # 暂停超过max_pause秒的store恢复到1个并发，调用时需要持有self._cond
+    def _resume_paused(self, address):
+        pause_time = self.pause_time_map.get(address)
+        if pause_time is not None and time.time() - pause_time >= self.max_pause:
+            log.warning("store:%s,compact paused for more than %d seconds,resume with concurrency 1" % (
+                address, self.max_pause))
+            self._set_limit(address, 1)
+
+    def _set_limit(self, address, limit):
+        self.limit_map[address] = limit
+        if limit == 0:
+            self.pause_time_map.setdefault(address, time.time())
+        else:
+            self.pause_time_map.pop(address, None)
+
+    def release(self, address):
+        with self._cond:
+            self.running_map[address] -= 1
+            self._cond.notify_all()
+
+    def adjust(self, samples):
+        with self._cond:
+            for address, metrics in samples.items():
+                limit = self.limit_map[address]
+                over = [name for name, ceiling in self.ceilings.items() if name in metrics and metrics[name] > ceiling]
+                if len(over) != 0:
+                    new_limit = limit // 2
+                elif len(metrics) == 0:
+                    new_limit = max(limit, 1)
+                elif all([metrics[name] < ceiling * THROTTLE_HEADROOM for name, ceiling in self.ceilings.items()
+                          if name in metrics]):
+                    new_limit = min(self.max_concurrency, limit + 1)
+                else:
+                    new_limit = limit
+                if new_limit != limit:
+                    log.info("store:%s,compact concurrency:%d->%d,over ceiling:%s,metrics:%s" % (
+                        address, limit, new_limit, ",".join(over), ",".join(
+                            ["%s=%.3f" % (name, value) for name, value in sorted(metrics.items())])))
+                    if new_limit == 0:
+                        log.warning("store:%s is overloaded,compact paused" % (address))
+                self._set_limit(address, new_limit)
+            self._cond.notify_all()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.adjust(self.sampler.sample(list(self.limit_map)))
+            except Exception as e:
+                log.error("throttle sample error,message:%s" % (e))
+
+    # 按当前负载确定初始并发后启动采样线程
+    def start(self, addresses):
+        for address in addresses:
+            self._set_limit(address, 1)
+            self.running_map[address] = 0
+        self.adjust(self.sampler.sample(addresses))
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+# 按store分组调度compact任务
+# 不同store之间并发执行，每个store同时最多执行store_concurrency个tikv-ctl compact，避免单个节点被打满
+class StoreScheduler:
+    def __init__(self, cluster, threads=4, store_concurrency=1, journal=None, throttle=None):
+        self.cluster = cluster
+        self.journal = journal  # CompactJournal，为None时不记录断点
+        self.throttle = throttle  # CompactThrottle，为None时每个store固定store_concurrency个并发
+        self.threads = threads  # 每个tikv-ctl compact的--threads
+        self.store_concurrency = store_concurrency
+        self.store_task_map = {}  # key:store地址,value:Queue(CompactTask)
+        self.table_compact_err_count_map = {}  # 记录每张表一共执行多少次compact和失败了多少次
+        self.progress = None
+        self._lock = threading.Lock()
+
+    def add(self, task):
+        if task.address not in self.store_task_map:
+            self.store_task_map[task.address] = Queue()
+        self.store_task_map[task.address].put(task)
+
+    def task_count(self):
+        return sum([q.qsize() for q in self.store_task_map.values()])
+
+    def _record(self, task, total_compact_count, err_compact_count):
+        with self._lock:
+            count, err_count = self.table_compact_err_count_map.get(task.tabname, (0, 0))
+            self.table_compact_err_count_map[task.tabname] = (count + total_compact_count, err_count + err_compact_count)
+
+    def _worker(self, address):
+        task_queue = self.store_task_map[address]
+        while True:
+            try:
+                task = task_queue.get_nowait()
+            except Empty:
+                return
+            if self.throttle is not None:
+                self.throttle.acquire(address)
+            try:
+                total_compact_count, err_compact_count = self._compact(task)
+            finally:
+                if self.throttle is not None:
+                    self.throttle.release(address)
+            self._record(task, total_compact_count, err_compact_count)
+            self.progress.update(task, err_compact_count == 0)
+
+    def _compact(self, task):
+        total_compact_count, err_compact_count = 0, 0
+        # 逐个cf执行，每个cf完成后更新journal
+        for cf in task.column_families:
+            message = ""
+            try:
+                count, err_count = tiup_ctl_tikv_run(self.cluster, task.address, task.region_id, self.threads,
+                                                     task.key_range, max(1, len(task.region_ids)), [cf])
+            except Exception as e:
+                log.error("compact error! store:%s,%s,cf:%s,message:%s" % (task.address, task.describe(), cf, e))
+                count, err_count, message = 1, 1, str(e)
+            total_compact_count += count
+            err_compact_count += err_count
+            if self.journal is not None:
+                self.journal.update(task, cf, "done" if err_count == 0 else "failed", message)
+        return total_compact_count, err_compact_count
+
+    def run(self):
+        self.progress = CompactProgress(self.task_count())
+        log.info("compact tasks:%d,stores:%d,store concurrency:%d" % (
+            self.progress.total, len(self.store_task_map), self.store_concurrency))
+        if self.throttle is not None:
+            self.throttle.start(list(self.store_task_map))
+        workers = []
+        for address in self.store_task_map:
+            for i in range(self.store_concurrency):
+                t = threading.Thread(target=self._worker, args=(address,))
+                t.daemon = True
+                t.start()
+                workers.append(t)
+        for t in workers:
+            # join带超时，主线程可以响应Ctrl+C
+            while t.is_alive():
+                t.join(1)
+        if self.throttle is not None:
+            self.throttle.stop()
+        return self.table_compact_err_count_map
+
+
+# 规划一张表的compact任务，regions为需要compact的region
+# by_range为True时将表中首尾相接的region合并为key范围（不区分store），每个范围在包含其中任一region的peer的所有store上执行，
+# store上范围内其它region的key不包含这张表在该store上的数据；获取不到起止key的region按region_id在每个peer上执行
+# region_store_map不为空时只规划其中指定的store，key:region_id,value:set(store_id)，None表示所有peer
+def plan_compact_tasks(cluster, tabname, regions, store_address_map, by_range=True, max_range_regions=256,
+                       region_store_map=None):
+    tasks = []
+    regions = list(regions)
+    # 按region_id执行时也获取起止key，记录到journal中，恢复时用于判断分裂产生的新region是否属于未完成的任务
+    region_keys_map = cluster.get_regions_keys([region_info.region_id for region_info in regions])
+    region_keys = []  # [(start_key, end_key, region_id)]
+    region_stores_map = {}  # key:region_id,value:[store_id]
+    region_version_map = {}  # key:region_id,value:version
+    for region_info in regions:
+        region_version_map[region_info.region_id] = (region_info.version, region_info.conf_ver)
+        store_ids = None if region_store_map is None else region_store_map.get(region_info.region_id)
+        peers = []
+        for peer in region_info.peers:
+            if store_ids is not None and peer.store_id not in store_ids:
+                continue
+            if store_address_map.get(peer.store_id, "") == "":
+                log.warning("cannot find address,store_id:%d,region_id:%d,peer_id:%d" % (
+                    peer.store_id, peer.region_id, peer.peer_id))
+                continue
+            peers.append(peer)
+        if by_range and region_info.region_id in region_keys_map:
+            start_key, end_key = region_keys_map[region_info.region_id]
+            region_keys.append((start_key, end_key, region_info.region_id))
+            region_stores_map[region_info.region_id] = [peer.store_id for peer in peers]
+            continue
+        for peer in peers:
+            task = CompactTask()
+            task.tabname = tabname
+            task.region_id = peer.region_id
+            task.region_ids = [peer.region_id]
+            task.version_map = {peer.region_id: region_version_map[region_info.region_id]}
+            task.key_span = region_keys_map.get(region_info.region_id)
+            task.peer_id = peer.peer_id
+            task.store_id = peer.store_id
+            task.address = store_address_map[peer.store_id]
+            tasks.append(task)
+    if len(region_keys) != 0:
+        ranges = merge_key_ranges(region_keys, max_range_regions)
+        log.info("table:%s,region count:%d,merged key ranges:%d" % (tabname, len(region_keys), len(ranges)))
+        for start_key, end_key, region_ids in ranges:
+            store_ids = set()
+            for region_id in region_ids:
+                store_ids.update(region_stores_map[region_id])
+            for store_id in sorted(store_ids):
+                task = CompactTask()
+                task.tabname = tabname
+                task.region_id = region_ids[0]
+                task.region_ids = region_ids
+                task.version_map = dict([(region_id, region_version_map[region_id]) for region_id in region_ids])
+                task.store_id = store_id
+                task.address = store_address_map[store_id]
+                task.key_range = (start_key, end_key)
+                task.key_span = task.key_range
+                tasks.append(task)
+    return tasks
+
+
+# 规划之后region发生分裂或合并（version变化）、peer发生变化（conf_ver变化）、region已经不存在、
+# 或者任务中的region在该store上都已经没有peer时，任务需要重新规划
+def is_task_stale(task, region_map):
+    store_ids = set()
+    for region_id, epoch in task.version_map.items():
+        region = region_map.get(region_id)
+        if region is None or (region.version, region.conf_ver) != epoch:
+            return True
+        store_ids.update([peer.store_id for peer in region.peers])
+    return task.store_id not in store_ids
+
+
+# 从journal恢复表未完成的任务，过期的任务标记为stale并重新规划，已经完成的范围不重复compact：
+# 1. 过期任务中仍然存在的region在原来的store上重新规划，peer迁移到的新store也要规划；
+# 2. 规划之后新出现或者版本变化的region（分裂产生的新region、合并后范围变大的region），只有和过期任务的范围重叠时才重新规划，
+#    在重叠的过期任务的store以及还没有条目覆盖该范围的peer上执行；获取不到起止key时在所有peer上执行
+def resume_compact_tasks(cluster, journal, tabname, region_map, store_address_map, by_range=True,
+                         max_range_regions=256):
+    tasks = journal.unfinished_tasks(tabname)
+    stale_tasks = [task for task in tasks if is_task_stale(task, region_map)]
+    if len(stale_tasks) != 0:
+        journal.mark_stale(stale_tasks)
+        planned_epochs = journal.region_epochs(tabname)
+        planned_store_map, store_spans = journal.store_coverage(tabname)
+        region_store_map = {}  # key:region_id,value:set(store_id)或者None
+        for task in stale_tasks:
+            for region_id in task.version_map:
+                region = region_map.get(region_id)
+                if region is None:
+                    continue
+                store_ids = region_store_map.setdefault(region_id, set())
+                store_ids.add(task.store_id)
+                store_ids.update([peer.store_id for peer in region.peers
+                                  if peer.store_id not in planned_store_map.get(region_id, set())])
+        candidate_region_ids = [region_id for region_id, region in region_map.items() if
+                                region_id not in region_store_map and
+                                planned_epochs.get(region_id, (None, None))[0] != region.version]
+        if len(candidate_region_ids) != 0:
+            candidate_keys_map = cluster.get_regions_keys(candidate_region_ids)
+            for region_id in candidate_region_ids:
+                region_keys = candidate_keys_map.get(region_id)
+                if region_keys is None or len([task for task in stale_tasks if task.key_span is None]) != 0:
+                    region_store_map[region_id] = None
+                    continue
+                store_ids = set([task.store_id for task in stale_tasks if key_ranges_overlap(task.key_span, region_keys)])
+                if len(store_ids) == 0:
+                    continue
+                covered_store_ids = set([store_id for store_id, span in store_spans if key_ranges_overlap(span, region_keys)])
+                store_ids.update([peer.store_id for peer in region_map[region_id].peers
+                                  if peer.store_id not in covered_store_ids])
+                region_store_map[region_id] = store_ids
+        regions = [region_map[region_id] for region_id in sorted(region_store_map)]
+        new_tasks = plan_compact_tasks(cluster, tabname, regions, store_address_map, by_range, max_range_regions,
+                                       region_store_map)
+        journal.add(new_tasks)
+        log.warning("table:%s,%d unfinished compact tasks changed since planning,replan %d regions into %d tasks" % (
+            tabname, len(stale_tasks), len(regions), len(new_tasks)))
+        tasks = [task for task in tasks if task not in stale_tasks] + new_tasks
+    log.info("table:%s,resume %d unfinished compact tasks from journal" % (tabname, len(tasks)))
+    return tasks
+
+
+# journal_path为断点记录的sqlite3文件，restart为True时忽略上次未完成的记录重新规划
+# throttle为True时按prometheus中的store负载在0到store_concurrency之间调整每个store的并发，ceilings为指标上限
+def compact_tables(cluster_name, table_list, threads, store_concurrency=1, by_range=True, max_range_regions=256,
+                   journal_path=None, restart=False, throttle=False, ceilings=None, throttle_interval=30,
+                   max_pause=600):
     cluster = TiDBCluster(cluster_name)
     store_list = cluster.get_all_stores()
+    store_address_map = dict([(store.id, store.address) for store in store_list])
+    if journal_path is None:
+        journal_path = "%s_compact_journal.sqlite3" % (cluster_name)
+    journal = CompactJournal(journal_path)
+    compact_throttle = None
+    if throttle:
+        prometheus_node_id = cluster.get_prometheus_node_id()
+        if prometheus_node_id == "":
+            log.warning("cannot find prometheus,compact without throttle")
+        else:
+            sampler = StoreLoadSampler(prometheus_node_id, cluster.get_tikv_instance_map())
+            compact_throttle = CompactThrottle(sampler, store_concurrency, ceilings, throttle_interval, max_pause)
+    scheduler = StoreScheduler(cluster, threads, store_concurrency, journal, compact_throttle)
+    # 先获取所有表的region信息，再按store分组并发执行
     for each_table in table_list:
         tabschema, tablename = each_table.split(".")
         table_map = cluster.get_regions4tables(tabschema, [tablename])
         for table_info in table_map.values():
-            total_region_count = len(table_info.all_region_map)
-            log.info("table:%s,total region count:%d" % (each_table, total_region_count))
-            counter = 0
-            for region_info in table_info.all_region_map.values():
-                counter += 1
-                for peer in region_info.peers:
-                    address = ""
-                    for store in store_list:
-                        if store.id == peer.store_id:
-                            address = store.address
-                            break
-                    if address != "":
-                        log.info("start compact table:%s,total region count:%d, current region num:%d,region_id:%d,peer_id:%d" % (
-                            each_table, total_region_count, counter, peer.region_id, peer.peer_id))
-                        total_compact_count, err_compact_count = tiup_ctl_tikv_run(cluster, address, peer.region_id,
-                                                                                   threads)
-                        if each_table in table_compact_err_count_map:
-                            table_compact_err_count_map[each_table] = (
-                            table_compact_err_count_map[each_table][0] + total_compact_count,
-                            table_compact_err_count_map[each_table][1] + err_compact_count)
-                        else:
-                            table_compact_err_count_map[each_table] = (total_compact_count, err_compact_count)
-                    else:
-                        log.warning("cannot find address,store_id:%d,region_id:%d,peer_id:%d" % (
-                            peer.store_id, peer.region_id, peer.peer_id))
+            log.info("table:%s,total region count:%d" % (each_table, len(table_info.all_region_map)))
+            if restart:
+                journal.clear(each_table)
+            if journal.has_table(each_table):
+                tasks = resume_compact_tasks(cluster, journal, each_table, table_info.all_region_map,
+                                             store_address_map, by_range, max_range_regions)
+            else:
+                tasks = plan_compact_tasks(cluster, each_table, table_info.all_region_map.values(),
+                                           store_address_map, by_range, max_range_regions)
+                journal.add(tasks)
+            for task in tasks:
+                scheduler.add(task)
+    table_compact_err_count_map = scheduler.run()
+    # 全部完成的表清理journal，下次执行重新规划；有失败的表保留，下次执行只重试失败的条目
+    for each_table in table_list:
+        status_count = journal.status_count(each_table)
+        unfinished_count = status_count.get("pending", 0) + status_count.get("failed", 0)
+        if unfinished_count == 0:
+            journal.clear(each_table)
+        else:
+            log.warning("table:%s,unfinished compact items:%d,run again to resume,journal:%s" % (
+                each_table, unfinished_count, journal_path))
+    journal.close()
     return table_compact_err_count_map
 
 
@@ -985,13 +1737,46 @@ if __name__ == "__main__":
     arg_parser.add_argument('-t', '--tables', type=str, required=True,
                             help='table name,muti table should like this "schema1.t1,schema1.t2,schema2.t3"')
     arg_parser.add_argument('-p', '--parallel', default=4, type=int, help='region compact threads')
+    arg_parser.add_argument('--store-concurrency', default=1, type=int,
+                            help='max concurrent tikv-ctl compact per store, stores are compacted concurrently')
+    arg_parser.add_argument('--by-region', action='store_true',
+                            help='compact region by region instead of merging contiguous regions into key ranges')
+    arg_parser.add_argument('--max-range-regions', default=256, type=int,
+                            help='max regions in one merged key range compact')
+    arg_parser.add_argument('--journal', type=str, default=None,
+                            help='sqlite3 file recording compact progress, interrupted runs resume unfinished items '
+                                 '(default: <cluster>_compact_journal.sqlite3)')
+    arg_parser.add_argument('--restart', action='store_true',
+                            help='ignore unfinished items in the journal and plan all regions again')
+    arg_parser.add_argument('--throttle', action='store_true',
+                            help='adjust per store concurrency between 0 and --store-concurrency by tikv load '
+                                 'from prometheus')
+    arg_parser.add_argument('--max-disk-util', default=THROTTLE_CEILINGS["disk_util"], type=float,
+                            help='throttle ceiling of disk io util on the store host, 0-1')
+    arg_parser.add_argument('--max-pending-compaction-gb', type=float,
+                            default=THROTTLE_CEILINGS["pending_compaction_bytes"] / 1024.0 / 1024 / 1024,
+                            help='throttle ceiling of kv rocksdb pending compaction bytes(GB)')
+    arg_parser.add_argument('--max-scheduler-p99-ms', default=THROTTLE_CEILINGS["scheduler_p99"] * 1000, type=float,
+                            help='throttle ceiling of tikv scheduler command duration p99(ms)')
+    arg_parser.add_argument('--throttle-interval', default=30, type=int,
+                            help='seconds between two samples of tikv load')
+    arg_parser.add_argument('--max-pause', default=600, type=int,
+                            help='max seconds a store stays paused by the throttle before compacting with concurrency 1')
     args = arg_parser.parse_args()
     # log_filename = sys.argv[0] + ".log"
     # log.basicConfig(filename=log_filename, filemode='a', level=log.INFO, format='%(asctime)s - %(name)s-%(filename)s[line:%(lineno)d] - %(levelname)s - %(message)s')
     log.basicConfig(level=log.INFO,format='%(asctime)s - %(name)s-%(filename)s[line:%(lineno)d] - %(levelname)s - %(message)s')
     cname, tabnamelist, parallel = args.cluster, args.tables, args.parallel
     tables_list = tabnamelist.split(",")
-    table_compact_err_count_map = compact_tables(cname, tables_list, parallel)
+    ceilings = {
+        "disk_util": args.max_disk_util,
+        "pending_compaction_bytes": args.max_pending_compaction_gb * 1024 * 1024 * 1024,
+        "scheduler_p99": args.max_scheduler_p99_ms / 1000.0,
+    }
+    table_compact_err_count_map = compact_tables(cname, tables_list, parallel, args.store_concurrency,
+                                                 not args.by_region, args.max_range_regions, args.journal,
+                                                 args.restart, args.throttle, ceilings, args.throttle_interval,
+                                                 args.max_pause)
     for each_table in table_compact_err_count_map:
         log.info("tabname:%s, compact count:%d, error ccompact count:%d" % (each_table, table_compact_err_count_map[each_table][0], table_compact_err_count_map[each_table][1]))
     log.info("Complete")